@@ -17,6 +17,7 @@ sys.path.insert(0, current_dir)
 # Importar módulos del proyecto
 from src.transporte.reliable import start_server
 from src.app.cliente import send_file
+from src.transporte.storage import get_storage
 
 class ProgramaRedes:
     def __init__(self):
@@ -43,7 +44,7 @@ class ProgramaRedes:
                 try:
                     datos_archivo = await read_message(writer._transport._protocol._stream_reader)
                     ruta_archivo = self.directorio_recibidos / nombre_archivo
-                    ruta_archivo.write_bytes(datos_archivo)
+                    await get_storage().write_file(ruta_archivo, datos_archivo)
                     print(f"[Servidor] Archivo guardado: {ruta_archivo}")
                 except Exception as e:
                     print(f"[Servidor] Error al leer datos del archivo: {e}")
@@ -2,13 +2,17 @@ import asyncio
 import os
 import random
 import time
-import json
 from typing import Dict, Optional
 from PIL import Image
 import io
+from pathlib import Path
 
 from src.transporte.reliable import start_server, send_message, read_message, ReliableTransport, ReliableConfig
-from src.transporte.fragmentation import pack_chunk, unpack_chunk, Reassembler
+from src.transporte.fragmentation import count_chunks, parity_frames, get_pipeline, Reassembler, METADATA_TLV
+from src.transporte.tlv import parse_control, encode_control, is_binary_control
+from src.transporte.fec import FECConfig
+from src.transporte.chunk_tuning import get_tuner, resolve_chunk_size, parse_chunk_size
+from src.transporte.storage import get_storage
 
 RECV_DIR = os.path.join(os.path.dirname(__file__), '..', 'received')
 os.makedirs(RECV_DIR, exist_ok=True)
@@ -55,7 +59,9 @@ def _validate_partial_image(filepath: str, expected_size: int) -> bool:
 
 async def handle_client(reader, writer, mode='FIABLE', loss_rate=0.0, enable_fec=False):
     """
-    Maneja cliente con soporte mejorado para FIABLE y SEMI-FIABLE con FEC simulado
+    Maneja cliente con soporte mejorado para FIABLE y SEMI-FIABLE.
+    Con enable_fec, los chunks perdidos se reconstruyen a partir de la paridad
+    FEC que anuncie el cliente en img_meta.
     """
     peer = writer.get_extra_info('peername')
     print(f"[IMG SERVER] Conexión de {peer} - Modo: {mode}, Pérdida: {loss_rate*100:.1f}%")
@@ -68,7 +74,8 @@ async def handle_client(reader, writer, mode='FIABLE', loss_rate=0.0, enable_fec
         # Leer control/meta
         ctrl = await read_message(reader)
         meta = await read_message(reader)
-        meta_obj = json.loads(meta)
+        meta_obj = parse_control(meta)
+        binary_acks = is_binary_control(meta)
         
         if meta_obj.get('type') != 'img_meta':
             print("[IMG SERVER] Meta inesperado")
@@ -85,6 +92,10 @@ async def handle_client(reader, writer, mode='FIABLE', loss_rate=0.0, enable_fec
         # Timeout más largo para imágenes grandes
         timeout = max(10.0, total_chunks * 0.1)
         reassembler = Reassembler(size, total_chunks, timeout=timeout)
+        fec_config = FECConfig.from_fields(meta_obj) if enable_fec else None
+        if fec_config is not None:
+            reassembler.enable_fec(fec_config, meta_obj['chunk_size'])
+            print(f"[IMG SERVER] FEC {fec_config.scheme}: {fec_config.parity_count} paridades cada {fec_config.group_size} chunks")
         
         # Recibir chunks
         last_progress = 0
@@ -100,16 +111,11 @@ async def handle_client(reader, writer, mode='FIABLE', loss_rate=0.0, enable_fec
                 continue
                 
             try:
-                meta_c, payload = unpack_chunk(pkt)
+                meta_c, payload = await get_pipeline().unpack_one(pkt)
                 chunks_received += 1
                 
-                # Añadir chunk con metadatos
-                success = reassembler.add_chunk(
-                    meta_c['chunk_id'], 
-                    meta_c['offset'], 
-                    payload, 
-                    meta_c.get('metadata')
-                )
+                # Añadir chunk con metadatos (o paridad FEC)
+                success = reassembler.add_frame(meta_c, payload)
                 
                 if success:
                     # Mostrar progreso
@@ -119,12 +125,12 @@ async def handle_client(reader, writer, mode='FIABLE', loss_rate=0.0, enable_fec
                         last_progress = progress
                 
                 # Enviar ACK en modo FIABLE
-                if mode == 'FIABLE':
-                    ack = json.dumps({
+                if mode == 'FIABLE' and not meta_c['parity']:
+                    ack = encode_control({
                         "type": "ack", 
                         "chunk_id": meta_c['chunk_id'],
                         "timestamp": time.time()
-                    }).encode()
+                    }, binary_acks)
                     await send_message(writer, ack)
                     
                 if reassembler.is_complete():
@@ -142,34 +148,27 @@ async def handle_client(reader, writer, mode='FIABLE', loss_rate=0.0, enable_fec
         print(f"              Chunks recibidos: {chunks_received}/{total_chunks}")
         print(f"              Chunks perdidos: {chunks_lost}")
         
+        if fec_config is not None:
+            reassembler.recover_missing()
+            print(f"              Chunks reconstruidos con FEC: {len(reassembler.recovered_chunks)}")
+        
         # Intentar ensamblar
         assembled = reassembler.assemble()
         out_path = os.path.join(RECV_DIR, name)
         
+        # Escritura atómica y validación con Pillow en el pool de E/S, fuera del loop
+        storage = get_storage()
         if assembled is None:
-            # Imagen parcial: usar FEC simulado o guardar parcial
-            if enable_fec and mode == 'SEMI-FIABLE':
-                print("[IMG SERVER] Aplicando FEC simulado...")
-                # Simular reconstrucción con códigos de corrección
-                partial_data = reassembler.assemble_partial()
-                if partial_data:
-                    with open(out_path + '.fec_recovered', 'wb') as f:
-                        f.write(partial_data)
-                    print(f"[IMG SERVER] Imagen recuperada con FEC: {out_path}.fec_recovered")
-                    _validate_partial_image(out_path + '.fec_recovered', size)
-            else:
-                # Guardar imagen parcial
-                partial_data = reassembler.assemble_partial()
-                with open(out_path + '.partial', 'wb') as f:
-                    f.write(partial_data)
-                print(f"[IMG SERVER] Imagen parcial guardada: {out_path}.partial")
-                _validate_partial_image(out_path + '.partial', size)
+            # Imagen parcial: ni la paridad FEC (si la hay) alcanzó para completarla
+            partial_data = reassembler.assemble_partial()
+            await storage.write_file(out_path + '.partial', partial_data)
+            print(f"[IMG SERVER] Imagen parcial guardada: {out_path}.partial")
+            await storage.run(_validate_partial_image, out_path + '.partial', size)
         else:
             # Imagen completa
-            with open(out_path, 'wb') as f:
-                f.write(assembled)
+            await storage.write_file(out_path, assembled)
             print(f"[IMG SERVER] Imagen completa guardada: {out_path}")
-            _validate_complete_image(out_path)
+            await storage.run(_validate_complete_image, out_path)
         
         # Registrar estadísticas de rendimiento
         PERFORMANCE_REPORT["transfers"].append({
@@ -181,6 +180,7 @@ async def handle_client(reader, writer, mode='FIABLE', loss_rate=0.0, enable_fec
             "transfer_time": transfer_time,
             "chunks_received": chunks_received,
             "chunks_lost": chunks_lost,
+            "chunks_recovered": len(reassembler.recovered_chunks),
             "success_rate": chunks_received / (chunks_received + chunks_lost) if (chunks_received + chunks_lost) > 0 else 0,
             "throughput_bps": size / transfer_time if transfer_time > 0 else 0,
             "complete": assembled is not None
@@ -192,21 +192,25 @@ async def handle_client(reader, writer, mode='FIABLE', loss_rate=0.0, enable_fec
 
 
 async def client_send_image(host, port, filepath, mode='FIABLE', loss_rate=0.0, 
-                           chunk_size=1024, max_retries=5, ack_timeout=1.0, enable_compression=True):
+                           chunk_size=1024, max_retries=5, ack_timeout=1.0, enable_compression=True,
+                           binary_control=False, fec: Optional[FECConfig] = None):
     """
-    Cliente mejorado para envío de imágenes con soporte completo para ambos modos
+    Cliente mejorado para envío de imágenes con soporte completo para ambos modos.
+    Los metadatos de chunk viajan en TLV binario; binary_control=True usa también
+    TLV para los frames de control (control, img_meta y ACKs).
+    En SEMI-FIABLE, fec añade chunks de paridad tras cada grupo de datos.
+    chunk_size="auto" ajusta el tamaño con lo medido en envíos anteriores al mismo destino.
     """
     start_time = time.time()
+    tuner = get_tuner(host, port)
+    chunk_size = resolve_chunk_size(chunk_size, host, port)
     
     reader, writer = await asyncio.open_connection(host, port)
+    tuner.observe_rtt(time.time() - start_time)
     name = os.path.basename(filepath)
     
-    # Leer datos de imagen
-    with open(filepath, 'rb') as f:
-        data = f.read()
-    
-    total_len = len(data)
-    total_chunks = (total_len + chunk_size - 1) // chunk_size
+    total_len = os.path.getsize(filepath)
+    total_chunks = count_chunks(total_len, chunk_size)
     
     # Detectar formato de imagen
     image_format = "unknown"
@@ -227,7 +231,7 @@ async def client_send_image(host, port, filepath, mode='FIABLE', loss_rate=0.0,
     
     # Enviar control y metadatos
     ctrl = {"type": "control", "msg": f"send image {name}"}
-    await send_message(writer, json.dumps(ctrl).encode())
+    await send_message(writer, encode_control(ctrl, binary_control))
     
     meta = {
         "type": "img_meta", 
@@ -238,52 +242,59 @@ async def client_send_image(host, port, filepath, mode='FIABLE', loss_rate=0.0,
         "chunk_size": chunk_size,
         **img_info
     }
-    await send_message(writer, json.dumps(meta).encode())
+    
+    # Paridad FEC (solo SEMI-FIABLE: en FIABLE las pérdidas se reintentan)
+    data = await asyncio.to_thread(Path(filepath).read_bytes)
+    parity = {}
+    if fec is not None and mode == 'SEMI-FIABLE':
+        meta.update(fec.to_fields())
+        parity = await asyncio.to_thread(parity_frames, data, chunk_size, fec)
+    await send_message(writer, encode_control(meta, binary_control))
 
     # Estadísticas de envío
     chunks_sent = 0
     chunks_acked = 0
     total_retries = 0
     
+    # Metadatos específicos del chunk (solo viajan en el primero)
+    chunk_metadata = {
+        "format": image_format,
+        "total_size": total_len,
+        "compression": "gzip" if enable_compression else "none"
+    }
+    
+    # Empaquetar por lotes en el pool de workers (compresión opcional + hash)
+    frames = await get_pipeline().pack_async(data, chunk_size, compressed=enable_compression,
+                                              metadata=chunk_metadata, metadata_format=METADATA_TLV)
+    
     # Enviar chunks
-    for i in range(total_chunks):
-        offset = i * chunk_size
-        part = data[offset:offset + chunk_size]
-        
-        # Metadatos específicos del chunk (solo para el primero)
-        chunk_metadata = None
-        if i == 0:
-            chunk_metadata = {
-                "image_format": image_format,
-                "total_size": total_len,
-                "compression_enabled": enable_compression
-            }
-        
-        # Crear paquete con compresión opcional
-        pkt = pack_chunk(part, total_len, offset, i, total_chunks, 
-                        compressed=enable_compression, metadata=chunk_metadata)
-        
+    for i, pkt in enumerate(frames):
         if mode == 'FIABLE':
             # Modo confiable con ACK y reintentos
             retries = 0
             ack_received = False
             
             while retries < max_retries and not ack_received:
+                sent_at = time.time()
                 await send_message(writer, pkt)
                 chunks_sent += 1
                 
                 try:
                     # Esperar ACK con timeout
                     ack_raw = await asyncio.wait_for(read_message(reader), timeout=ack_timeout)
-                    ack = json.loads(ack_raw)
+                    ack = parse_control(ack_raw)
                     
                     if ack.get('type') == 'ack' and ack.get('chunk_id') == i:
                         chunks_acked += 1
                         ack_received = True
+                        if retries == 0:
+                            tuner.observe_rtt(time.time() - sent_at)
+                        tuner.observe_chunk(False, chunk_size)
                     
                 except asyncio.TimeoutError:
                     retries += 1
                     total_retries += 1
+                    tuner.observe_chunk(True, chunk_size)
                     print(f"[CLIENT] Timeout chunk {i}, reintento {retries}/{max_retries}")
                 except Exception as e:
                     print(f"[CLIENT] Error esperando ACK chunk {i}: {e}")
@@ -296,6 +307,8 @@ async def client_send_image(host, port, filepath, mode='FIABLE', loss_rate=0.0,
             # Modo SEMI-FIABLE: enviar una vez (el servidor simula pérdidas)
             await send_message(writer, pkt)
             chunks_sent += 1
+            for parity_pkt in parity.get(i, ()):
+                await send_message(writer, parity_pkt)
         
         # Mostrar progreso cada 10%
         if (i + 1) % max(1, total_chunks // 10) == 0:
@@ -314,8 +327,10 @@ async def client_send_image(host, port, filepath, mode='FIABLE', loss_rate=0.0,
     
     writer.close()
     await writer.wait_closed()
+    tuner.observe_throughput(total_len, transfer_time)
     
     return {
+        "chunk_size": chunk_size,
         "chunks_sent": chunks_sent,
         "chunks_acked": chunks_acked,
         "total_retries": total_retries,
@@ -352,7 +367,8 @@ async def run_demo(image_path, mode='FIABLE', loss_rate=0.1, chunk_size=1024, en
     try:
         client_stats = await client_send_image(
             host, port, image_path, mode, loss_rate, 
-            chunk_size=chunk_size, enable_compression=True
+            chunk_size=chunk_size, enable_compression=True,
+            fec=FECConfig() if enable_fec else None
         )
         
         # Esperar un poco para que el servidor termine de procesar
@@ -451,8 +467,9 @@ if __name__ == '__main__':
             print('  image_path  : Ruta al archivo de imagen (PNG/JPEG)')
             print('  modo        : FIABLE (default) | SEMI-FIABLE')
             print('  loss_rate   : Tasa de pérdida 0.0-1.0 (default: 0.1)')
-            print('  chunk_size  : Tamaño de chunk en bytes (default: 1024)')
+            print('  chunk_size  : Tamaño de chunk en bytes o "auto" (default: 1024)')
             print('  --benchmark : Ejecutar benchmark completo')
+            print('  --fec       : Enviar paridad FEC en modo SEMI-FIABLE')
             print('')
             print('Ejemplos:')
             print('  python pruebdemo_img_transfer.py imagen.png')
@@ -467,6 +484,6 @@ if __name__ == '__main__':
             # Ejecutar demo individual
             mode = sys.argv[2] if len(sys.argv) > 2 else 'FIABLE'
             lr = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
-            cs = int(sys.argv[4]) if len(sys.argv) > 4 else 1024
+            cs = parse_chunk_size(sys.argv[4]) if len(sys.argv) > 4 else 1024
             enable_fec = '--fec' in sys.argv
             asyncio.run(run_demo(path, mode, lr, chunk_size=cs, enable_fec=enable_fec))
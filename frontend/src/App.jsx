@@ -76,6 +76,7 @@ function App() {
   const [newMessage, setNewMessage] = useState('')
   const [selectedUser, setSelectedUser] = useState('')
   const messagesEndRef = useRef(null) // Para auto-scroll
+  const presenceVersion = useRef(null) // Versión de presencia aplicada (snapshot + deltas)
 
   // Estados para funcionalidad de imágenes y modo de envío
   const [uploadStatus, setUploadStatus] = useState('')
@@ -144,8 +145,9 @@ function App() {
         : `${wsProtocol}//${window.location.host}/api/ws`
       const ws = new WebSocket(wsUrl)
       ws.onopen = () => {
+        // Al registrarse el servidor envía un snapshot de presencia y luego deltas
+        presenceVersion.current = null
         ws.send(JSON.stringify({ type: 'register', username }))
-        ws.send(JSON.stringify({ type: 'list' }))
         setConnected(true)
         setSocket(ws)
         if (toast && toast.addToast) {
@@ -201,6 +203,43 @@ function App() {
               setIsSimulating(false);
             }, 2000);
           }
+        } else if (data.type === 'job_update') {
+          // Estado del envío en segundo plano de una imagen subida
+          if (data.state === 'done' && data.result) {
+            setTransferStats(data.result)
+          } else if (data.state === 'failed' && toast && toast.addToast) {
+            toast.addToast(`Error en el envío: ${data.error}`, 'error')
+          }
+        } else if (data.type === 'rate_limited') {
+          // El servidor descartó mensajes por exceder el límite
+          if (toast && toast.addToast) {
+            toast.addToast(`Demasiados mensajes, espera ${Math.ceil(data.retry_after)}s`, 'warning')
+          }
+        } else if (data.type === 'presence_snapshot') {
+          presenceVersion.current = data.version
+          setUsers(data.users || [])
+          setUserIPs(prev => ({ ...prev, ...(data.userIPs || {}) }))
+        } else if (data.type === 'presence_delta') {
+          const version = presenceVersion.current
+          if (version === null || data.version <= version) return
+          if (data.from_version > version) {
+            // Faltan versiones intermedias: pedir lo que falta
+            ws.send(JSON.stringify({ type: 'presence_sync', version }))
+            return
+          }
+          // Solo los cambios posteriores a la versión aplicada (pueden solaparse con el snapshot)
+          const changes = data.changes.filter(change => change.v > version)
+          presenceVersion.current = data.version
+          setUsers(prev => {
+            const next = new Set(prev)
+            changes.forEach(change => change.op === 'join' ? next.add(change.user) : next.delete(change.user))
+            return Array.from(next)
+          })
+          setUserIPs(prev => {
+            const next = { ...prev }
+            changes.forEach(change => { if (change.op === 'join') next[change.user] = change.ip })
+            return next
+          })
         } else if (data.type === 'list' || data.type === 'user_list') {
           const userList = data.users || [];
           setUsers(userList)
@@ -238,15 +277,6 @@ function App() {
     }
   }
   
-  // Actualizar lista de usuarios periódicamente
-  useEffect(() => {
-    if (!socket || !connected) return
-    const interval = setInterval(() => {
-      socket.send(JSON.stringify({ type: 'list' }))
-    }, 2000)
-    return () => clearInterval(interval)
-  }, [socket, connected])
-  
   // Enviar mensaje SOLO al usuario seleccionado
   const sendMessage = () => {
     if (socket && newMessage.trim() && selectedUser) {
@@ -318,6 +348,8 @@ function App() {
     formData.append('transfer_mode', transferMode)
     formData.append('chunk_size', '4096')
     formData.append('max_retries', '3')
+    // Con username el backend empuja el estado del trabajo por el WebSocket
+    formData.append('username', username)
     
     // Iniciar simulación
     setIsSimulating(true)
@@ -351,8 +383,10 @@ function App() {
         body: formData
       })
       const result = await response.json()
-      if (result.status === 'sent') {
-        setUploadStatus(`Imagen enviada: ${result.filename}`)
+      // El envío al servidor de transporte sigue como trabajo en segundo plano
+      // (status 'queued'/'running'); la imagen ya está guardada y se puede compartir
+      if (['sent', 'queued', 'running'].includes(result.status)) {
+        setUploadStatus(result.status === 'sent' ? `Imagen enviada: ${result.filename}` : `Imagen guardada, enviando: ${result.filename}`)
         setTransferStats(result.stats)
         if (toast && toast.addToast) {
           toast.addToast('Imagen enviada correctamente', 'success')
@@ -387,7 +421,9 @@ function App() {
           // Construir la URL de la imagen usando el mismo host de la API
           const baseUrl = ngrokUrl || ''
           const imageUrl = `${baseUrl}/api/received/${result.filename}`
-          const imageMsg = `<img src='${imageUrl}' alt='imagen' style='max-width:200px;max-height:200px;' />`
+          // Miniatura servida por /thumbs; el original se abre al hacer clic
+          const thumbUrl = result.thumbnail_url ? `${baseUrl}/api${result.thumbnail_url}` : imageUrl
+          const imageMsg = `<a href='${imageUrl}' target='_blank' rel='noopener'><img src='${thumbUrl}' alt='imagen' loading='lazy' style='max-width:200px;max-height:200px;' /></a>`
           socket.send(JSON.stringify({
             type: 'message',
             to: selectedUser,
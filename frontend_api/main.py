@@ -2,6 +2,7 @@
 from fastapi import Request
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, Response
 import asyncio
 import os
 import sys
@@ -13,7 +14,19 @@ project_root = os.path.abspath(os.path.join(current_dir, '..'))
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
-from src.app.cliente import send_file, send_image_fragmented_fiable
+from src.app.cliente import DEFAULT_WINDOW, send_file_stream, send_image_stream, send_image_dedup
+from src.app import jobs
+from src.app.jobs import JobManager
+from src.app.connections import ConnectionHub
+from src.app.rate_limit import RateLimiter, parse_limits
+from src.app.bus import open_chat_bus
+from src.app.relay import FileRelay
+from src.transporte.chunk_tuning import AUTO, parse_chunk_size, resolve_chunk_size
+from src.transporte.progress import ProgressTracker
+from src.transporte.admission import ServerBusy
+from src.transporte.thumbnails import ThumbnailPipeline
+from src.transporte.storage import get_storage
+from src.transporte.codec import JSON
 
 
 from fastapi.middleware.cors import CORSMiddleware
@@ -34,13 +47,121 @@ if not os.path.exists(received_dir):
     os.makedirs(received_dir)
 app.mount('/received', StaticFiles(directory=received_dir), name='received')
 
-# Registros en memoria: username -> websocket, mensajes no entregados y mapeo de IPs
-connections = {}
-undelivered = {}
-user_ips = {}  # Diccionario global para mantener las IPs de los usuarios
+# Miniaturas y variantes web de las imágenes recibidas (caché en disco, LRU)
+THUMBS = ThumbnailPipeline(os.path.join(received_dir, '.thumbs'),
+                           max_bytes=int(os.environ.get('THUMBS_CACHE_BYTES', 256 * 1024 * 1024)))
+
+# Trabajos de envío en segundo plano (los demás esperan en cola)
+JOBS = JobManager(max_concurrent=int(os.environ.get('FRONTEND_MAX_JOBS', 4)))
+# Copias temporales de los archivos que no son imágenes hasta que se envían
+spool_dir = os.path.join(project_root, 'frontend_api_tmp')
+
+# Estado del chat (presencia, enrutado y mensajes para usuarios desconectados)
+# detrás de un bus: CHAT_BUS=local lo mantiene en este proceso; con varios
+# workers de uvicorn, CHAT_BUS=unix:<socket> lo comparte a través de un broker
+# local. Los mensajes pendientes van a CHAT_STORE (SQLite por defecto,
+# "memory" para no persistir), con máximo por usuario y caducidad.
+BUS = open_chat_bus(
+    os.environ.get('CHAT_BUS', 'local'),
+    os.environ.get('CHAT_STORE', os.path.join(project_root, 'frontend_api_data', 'messages.db')),
+    max_per_user=int(os.environ.get('CHAT_MAX_OFFLINE', 1000)),
+    ttl=float(os.environ.get('CHAT_OFFLINE_TTL', 7 * 24 * 3600)),
+    debounce=float(os.environ.get('PRESENCE_DEBOUNCE_MS', 50)) / 1000)
+OFFLINE_PAGE = 100
+
+# Usuarios conectados y sus IPs (versionados: los clientes reciben un
+# snapshot al registrarse y luego solo deltas)
+user_ips = BUS.presence.members  # usuario -> IP
+
+
+# Tareas sueltas (guardar mensajes, avisos por el bus): se retienen aquí para
+# que el recolector no las destruya a medias y sus errores quedan en el log
+_background = set()
+
+
+def _spawn(coro, what: str):
+    task = asyncio.create_task(coro)
+    _background.add(task)
+
+    def done(t):
+        _background.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            print(f"[API] ERROR en {what}: {t.exception()!r}")
+    task.add_done_callback(done)
+    return task
+
+
+def _store_undelivered(user, msg):
+    """Mensaje que no llegó a enviarse por una conexión caída: vuelve al almacén"""
+    seq = msg.get('layerInfo', {}).get('sequence')
+    _spawn(BUS.store(user, msg, seq if isinstance(seq, int) else None), f"guardar mensaje para {user}")
+
+
+# Conexiones WebSocket de este proceso, cada una con su cola de salida
+# acotada (WS_OVERFLOW=drop tira lo descartable cuando se llena, close
+# desconecta siempre al cliente lento)
+connections = ConnectionHub(
+    max_queue=int(os.environ.get('WS_MAX_QUEUE', 256)),
+    on_undelivered=_store_undelivered,
+    overflow=os.environ.get('WS_OVERFLOW', 'drop'))
+
+# Límites de entrada por usuario y tipo de mensaje (token buckets, rate/burst
+# por segundo; "*" para los tipos no listados). Lo que excede se descarta y
+# quien insiste se desconecta.
+LIMITER = RateLimiter(
+    parse_limits(os.environ.get(
+        'WS_RATE_LIMITS',
+        'message=10/30,list=1/5,presence_sync=1/5,file_offer=2/10,file_accept=2/10,'
+        'file_resume=2/10,file_cancel=5/20,file_ack=200/400,*=5/20')),
+    close_after=int(os.environ.get('WS_RATE_CLOSE_AFTER', 200)))
+
+
+# Archivos entre usuarios por el WebSocket (frames binarios con créditos); si
+# el destinatario no está conectado aquí se guardan en disco hasta que los pida
+RELAY = FileRelay(
+    connections, BUS, os.path.join(project_root, 'frontend_api_data', 'relay'),
+    window=int(os.environ.get('RELAY_WINDOW', 1024 * 1024)),
+    max_size=int(os.environ.get('RELAY_MAX_BYTES', 1024 * 1024 * 1024)))
+
+
+def _notify_user(username, payload, droppable=False):
+    """Aviso sin garantía (progreso, trabajos) al usuario, esté en este worker o en otro"""
+    if not connections.send(username, payload, droppable=droppable):
+        _spawn(BUS.notify(username, payload), f"aviso a {username}")
+
+
+async def _deliver_offline(conn, username):
+    """Entrega por páginas los mensajes guardados mientras el usuario no estaba"""
+    after = 0
+    while not conn.closed:
+        page = await BUS.fetch_offline(username, after, OFFLINE_PAGE)
+        if not page:
+            return
+        for seq, msg in page:
+            conn.send_json(msg, durable=True)
+        # Borrar la página solo cuando salió por el socket; si la conexión cae
+        # antes, los mensajes siguen en el almacén
+        await conn.drained()
+        if conn.closed:
+            return
+        after = page[-1][0]
+        await BUS.ack_offline(username, after)
+
+
+@app.on_event('startup')
+async def _start_bus():
+    await BUS.start(connections.send, connections.broadcast)
+
+
+@app.on_event('shutdown')
+async def _close_bus():
+    await JOBS.shutdown()
+    # Lo que aún se está guardando o avisando termina antes de cerrar el bus
+    if _background:
+        await asyncio.wait(set(_background), timeout=5.0)
+    await BUS.close()
 
 from fastapi import WebSocket, WebSocketDisconnect
-import json
 
 from fastapi import Form
 from typing import Optional
@@ -53,31 +174,102 @@ async def send(
     port: int = 9001,
     mode: str = Form('FIABLE'),
     loss_rate: float = Form(0.1),
-    chunk_size: int = Form(1024),
-    enable_compression: bool = Form(True)
+    chunk_size: str = Form('1024'),
+    enable_compression: bool = Form(True),
+    dedup: bool = Form(True),
+    username: Optional[str] = Form(None),
+    wait: bool = Form(False)
 ):
-    return await _handle_upload(file, host, port, mode, loss_rate, chunk_size, enable_compression)
+    # image_server mantiene un almacén de deduplicación: en FIABLE solo se
+    # envían los bloques que no tenga; además aplica control de admisión
+    return await _handle_upload(file, host, port, mode, loss_rate, chunk_size, enable_compression, dedup,
+                                username, admission=True, wait=wait)
 
 # Nuevo endpoint para compatibilidad con el frontend
 @app.post('/upload-image')
 async def upload_image(
     file: UploadFile = File(...),
     transfer_mode: str = Form('FIABLE'),
-    chunk_size: int = Form(1024),
+    chunk_size: str = Form('1024'),
     max_retries: int = Form(3),
     host: str = '127.0.0.1',
     port: int = 9000,
     loss_rate: float = Form(0.1),
-    enable_compression: bool = Form(True)
+    enable_compression: bool = Form(True),
+    username: Optional[str] = Form(None),
+    wait: bool = Form(False)
 ):
     # Mapear los nombres de los campos del frontend a los del backend
     mode = transfer_mode
-    return await _handle_upload(file, host, port, mode, loss_rate, chunk_size, enable_compression)
+    return await _handle_upload(file, host, port, mode, loss_rate, chunk_size, enable_compression,
+                                username=username, wait=wait)
 
 # Lógica compartida para ambos endpoints
-async def _handle_upload(file, host, port, mode, loss_rate, chunk_size, enable_compression):
+async def _push_progress(tracker: ProgressTracker, username: str):
+    """Reenvía los eventos de progreso al WebSocket del usuario (coalescidos, sin polling)"""
+    async for event in tracker.subscribe():
+        _notify_user(username, {'type': 'transfer_progress', **event.to_dict()}, droppable=True)
+
+
+async def _upload_size(file: UploadFile) -> int:
+    """Tamaño del upload sin leerlo (Starlette lo conoce tras parsear el formulario)"""
+    if file.size is not None:
+        return file.size
+    size = file.file.seek(0, os.SEEK_END)
+    file.file.seek(0)
+    return size
+
+
+def _tee_to_disk(file: UploadFile, sink):
+    """Fuente read(n) sobre el upload que además escribe cada bloque en sink"""
+    offset = 0
+
+    async def read(n: int) -> bytes:
+        nonlocal offset
+        data = await file.read(n)
+        if data:
+            sink.submit(offset, data)
+            offset += len(data)
+            await sink.wait_capacity()
+        return data
+    return read
+
+
+async def _drain_upload(read, block_size: int = 256 * 1024):
+    """Consume lo que quede del upload (llega a disco por el tee)"""
+    while await read(block_size):
+        pass
+
+
+async def _spool_upload(file: UploadFile, path: str, size: int):
+    """Copia el upload a path por bloques (escritura incremental y atómica)"""
+    sink = get_storage().open_incremental(path, size)
+    try:
+        await _drain_upload(_tee_to_disk(file, sink))
+        await sink.finalize()
+    except BaseException:
+        await sink.abort()
+        raise
+
+
+def _file_reader(f):
+    """Fuente read(n) sobre un archivo local, leída fuera del event loop"""
+    storage = get_storage()
+
+    async def read(n: int) -> bytes:
+        return await storage.run(f.read, n)
+    return read
+
+
+async def _handle_upload(file, host, port, mode, loss_rate, chunk_size, enable_compression, dedup=False,
+                         username=None, admission=False, wait=False):
     """
-    Endpoint mejorado para envío de archivos con fragmentación configurable
+    Endpoint mejorado para envío de archivos con fragmentación configurable.
+    El upload se guarda en disco y el envío al servidor de transporte queda
+    como trabajo en segundo plano: la respuesta trae job_id y el estado se
+    consulta en /jobs/{id}. Si se indica username, el progreso y los cambios
+    de estado se empujan por su WebSocket ('transfer_progress' y 'job_update').
+    Con wait se espera al trabajo y se responde con sus estadísticas finales.
     """
     # Validar parámetros
     if mode not in ['FIABLE', 'SEMI-FIABLE']:
@@ -86,90 +278,205 @@ async def _handle_upload(file, host, port, mode, loss_rate, chunk_size, enable_c
     if not (0.0 <= loss_rate <= 1.0):
         raise HTTPException(status_code=400, detail="loss_rate debe estar entre 0.0 y 1.0")
     
-    if chunk_size < 64 or chunk_size > 65536:
-        raise HTTPException(status_code=400, detail="chunk_size debe estar entre 64 y 65536")
-    
-    # Guardar temporalmente el archivo
-    tmp_dir = Path(project_root) / 'frontend_api_tmp'
-    tmp_dir.mkdir(exist_ok=True)
-    tmp_path = tmp_dir / file.filename
-    
-
+    # chunk_size es un entero o "auto" (ajustado según lo medido hacia host:port)
     try:
-        contents = await file.read()
-        tmp_path.write_bytes(contents)
-        file_size = len(contents)
-        print(f"[API] Procesando {file.filename} ({file_size} bytes)")
-        print(f"      Modo: {mode}, Loss rate: {loss_rate}, Chunk size: {chunk_size}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error saving file: {e}")
+        requested_chunk_size = parse_chunk_size(chunk_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Los envíos FIABLES van con ventana: el tamaño "auto" se calcula para ella
+    chunk_size = resolve_chunk_size(requested_chunk_size, host, port,
+                                    DEFAULT_WINDOW if mode == 'FIABLE' else 1)
+    
+    file_size = await _upload_size(file)
+    print(f"[API] Procesando {file.filename} ({file_size} bytes)")
+    print(f"      Modo: {mode}, Loss rate: {loss_rate}, Chunk size: {chunk_size}")
 
     # Detectar tipo de archivo
     import mimetypes
-    mime, _ = mimetypes.guess_type(str(tmp_path))
+    mime, _ = mimetypes.guess_type(file.filename)
+    is_image = bool(mime and mime.startswith('image/'))
     
-    # Inicializar variables
+    # El upload se copia a disco por bloques antes de responder: el trabajo
+    # lo envía después desde ahí, sin cargarlo entero en memoria
     safe_name = file.filename
-    modo = mode
-    
+    thumbnail_url = None
     try:
-        import shutil
-        import uuid
-        if mime and mime.startswith('image/'):
+        if is_image:
             # Guardar imagen directamente en received para visualización inmediata
-            received_dir = os.path.abspath(os.path.join(project_root, 'received'))
-            if not os.path.exists(received_dir):
-                os.makedirs(received_dir)
             ext = os.path.splitext(file.filename)[1] or '.png'
             safe_name = f"img_{uuid.uuid4().hex}{ext}"
-            dest_path = os.path.join(received_dir, safe_name)
-            shutil.copy(str(tmp_path), dest_path)
-            print(f"[API] Imagen guardada localmente: {dest_path}")
+            source_path = os.path.join(received_dir, safe_name)
+            await _spool_upload(file, source_path, file_size)
+            print(f"[API] Imagen guardada localmente: {source_path}")
+            # Variantes en segundo plano (tras crear el trabajo); la URL versionada
+            # por hash se cachea sin revalidar
+            thumbnail_url = f"/thumbs/{safe_name}?v={(await THUMBS.content_hash(source_path))[:16]}"
+        else:
+            # Archivo normal: copia temporal que se borra al terminar el trabajo
+            os.makedirs(spool_dir, exist_ok=True)
+            source_path = os.path.join(spool_dir, uuid.uuid4().hex)
+            await _spool_upload(file, source_path, file_size)
+    except Exception as e:
+        print(f"[API] ERROR: Error al procesar archivo: {e}")
+        raise HTTPException(status_code=500, detail=f"Error processing file: {e}")
+
+    config = {
+        "mode": mode,
+        "loss_rate": loss_rate,
+        "chunk_size": chunk_size,
+        "chunk_size_auto": requested_chunk_size == AUTO,
+        "dedup": dedup,
+        "compression": enable_compression
+    }
+    info = {"filename": safe_name, "size": file_size, "thumbnail_url": thumbnail_url, "config": config}
+
+    async def run(job):
+        progress = job.progress
+        modo = mode
+        bytes_sent = file_size
+        retry_after = None
+        transport_error = None
+        if is_image:
             modo = f'{mode}-IMG-LOCAL'
-            
-            # Ahora intentar enviar al servidor de transporte (opcional, no bloqueante para el usuario)
             try:
-                if mode == 'FIABLE':
-                    from src.app.cliente import send_image_fragmented_fiable
-                    await send_image_fragmented_fiable(host, port, str(tmp_path), chunk_size=chunk_size, max_retries=5, ack_timeout=0.5)
-                    modo = f'{mode}-IMG-FRAGMENTED-ENVIADO'
-                    print(f"[API] Imagen también enviada al servidor de transporte en {host}:{port}")
-                elif mode == 'SEMI-FIABLE':
-                    from src.app.cliente import send_image_fragmented_semi_fiable
-                    await send_image_fragmented_semi_fiable(host, port, str(tmp_path), chunk_size=chunk_size, enable_compression=enable_compression)
+                if mode == 'FIABLE' and dedup:
+                    result = await send_image_dedup(host, port, source_path, chunk_size=chunk_size,
+                                                    max_retries=5, ack_timeout=0.5, progress=progress,
+                                                    admission=admission, name=file.filename)
+                    bytes_sent = result["bytes_sent"]
+                    modo = f'{mode}-IMG-DEDUP-ENVIADO'
+                    print(f"[API] Imagen enviada al servidor de transporte en {host}:{port} "
+                          f"({result['bytes_deduplicated']} bytes deduplicados)")
+                else:
+                    with open(source_path, 'rb') as f:
+                        await send_image_stream(host, port, _file_reader(f), file.filename, file_size,
+                                                mode=mode, chunk_size=chunk_size, max_retries=5,
+                                                ack_timeout=0.5, enable_compression=enable_compression,
+                                                progress=progress, admission=admission)
                     modo = f'{mode}-IMG-FRAGMENTED-ENVIADO'
                     print(f"[API] Imagen también enviada al servidor de transporte en {host}:{port}")
+            except ServerBusy as e:
+                retry_after = e.retry_after
+                bytes_sent = 0
+                modo = f'{mode}-IMG-LOCAL-SERVIDOR-OCUPADO'
+                print(f"[API] Servidor de transporte ocupado: {e} (la imagen está disponible localmente)")
             except Exception as e:
-                # Si falla el envío al servidor, la imagen ya está guardada localmente
+                # Si falla el envío al servidor, la imagen sigue disponible localmente
+                transport_error = str(e)
+                bytes_sent = 0
                 print(f"[API] ADVERTENCIA: No se pudo enviar al servidor de transporte: {e} (pero la imagen está disponible localmente)")
         else:
-            # Archivo normal
-            await send_file(host, port, str(tmp_path))
+            with open(source_path, 'rb') as f:
+                await send_file_stream(host, port, _file_reader(f), file.filename, file_size)
             modo = f'{mode}-NORMAL'
-    except Exception as e:
-        print(f"[API] ERROR: Error al procesar archivo: {e}")
-        raise HTTPException(status_code=500, detail=f"Error processing file: {e}")
+        return {
+            "status": "sent",
+            "filename": safe_name,
+            "mode": modo,
+            "size": file_size,
+            "bytes_sent": bytes_sent,
+            "retry_after": retry_after,
+            "transport_error": transport_error,
+            "thumbnail_url": thumbnail_url,
+            "chunks": (bytes_sent + chunk_size - 1) // chunk_size,
+            "config": config
+        }
 
-    # Limpiar archivo temporal
-    try:
-        tmp_path.unlink()
-    except Exception:
-        pass
+    async def cleanup(job):
+        if not is_image:
+            await get_storage().run(_remove_file, source_path)
+
+    progress = ProgressTracker(0, file_size, name=file.filename)
+    job = JOBS.submit(run, kind='image' if is_image else 'file', owner=username, progress=progress,
+                      info=info, on_finish=cleanup)
+    if is_image:
+        JOBS.attach(job, THUMBS.generate_all(source_path), "miniaturas")
+    if username:
+        JOBS.attach(job, _push_progress(progress, username), "envío de progreso")
+    print(f"[API] Trabajo {job.id} en cola para {host}:{port}")
+
+    if wait:
+        await JOBS.wait(job.id)
+        if job.state == jobs.FAILED:
+            raise HTTPException(status_code=500, detail=f"Error processing file: {job.error}")
+        if job.state == jobs.CANCELLED:
+            raise HTTPException(status_code=409, detail="Trabajo cancelado")
+        return {**job.result, "job_id": job.id}
 
     return {
-        "status": "sent", 
-        "filename": safe_name if mime and mime.startswith('image/') else file.filename, 
-        "mode": modo,
+        "status": job.state,
+        "job_id": job.id,
+        "job_url": f"/jobs/{job.id}",
+        "filename": safe_name,
+        "mode": mode,
         "size": file_size,
-        "chunks": (file_size + chunk_size - 1) // chunk_size,
-        "config": {
-            "mode": mode,
-            "loss_rate": loss_rate,
-            "chunk_size": chunk_size,
-            "compression": enable_compression
-        }
+        "thumbnail_url": thumbnail_url,
+        "config": config
     }
 
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _push_job_update(job):
+    """Listener de JOBS: empuja cada cambio de estado al WebSocket del dueño"""
+    if job.owner:
+        _notify_user(job.owner, {'type': 'job_update', **job.to_dict()})
+
+
+JOBS.add_listener(_push_job_update)
+
+
+@app.get('/jobs')
+async def list_jobs(username: Optional[str] = None):
+    return {"jobs": [job.to_dict() for job in JOBS.list(username)], "stats": JOBS.get_stats()}
+
+
+def _process_memory():
+    """RSS actual y máximo de este worker en bytes (None donde no hay /proc)"""
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024   # KB en Linux
+    except ImportError:
+        max_rss = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        rss = None
+    return {"pid": os.getpid(), "rss_bytes": rss, "max_rss_bytes": max_rss}
+
+
+@app.get('/chat/stats')
+async def chat_stats():
+    """Métricas del chat en este worker: colas de salida, límites, relay de archivos y memoria"""
+    return {"connections": connections.get_stats(), "rate_limit": LIMITER.get_stats(),
+            "relay": RELAY.get_stats(), "process": _process_memory()}
+
+
+@app.get('/jobs/{job_id}')
+async def get_job(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job.to_dict()
+
+
+@app.delete('/jobs/{job_id}')
+async def cancel_job(job_id: str):
+    """Cancela un trabajo en cola o en curso (cierra la conexión de transporte)"""
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if not JOBS.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"El trabajo ya terminó ({job.state})")
+    await JOBS.wait(job_id)
+    return job.to_dict()
+
 async def send_image_with_config(host: str, port: int, filepath: str, mode: str, 
                                loss_rate: float, chunk_size: int, enable_compression: bool) -> bool:
     """
@@ -192,15 +499,45 @@ async def send_image_with_config(host: str, port: int, filepath: str, mode: str,
         return False
 
 
+@app.get('/thumbs/{name}')
+async def thumbs(name: str, request: Request, variant: str = 'thumb', v: Optional[str] = None):
+    """
+    Sirve una variante (thumb o web) de una imagen recibida. Con ?v=<hash del
+    original> la respuesta es inmutable y se cachea un año; sin él se cachea
+    un día y se revalida con ETag.
+    """
+    root = Path(received_dir).resolve()
+    path = (root / name).resolve()
+    if path.parent != root or not path.is_file():
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+    if variant not in THUMBS.variants:
+        raise HTTPException(status_code=400, detail=f"Variante desconocida: {variant}")
+    try:
+        thumb_path, file_hash = await THUMBS.get(path, variant)
+    except Exception as e:
+        raise HTTPException(status_code=415, detail=f"No se pudo generar la miniatura: {e}")
+
+    etag = f'"{file_hash[:32]}-{variant}"'
+    if v and len(v) >= 8 and file_hash.startswith(v):
+        cache_control = 'public, max-age=31536000, immutable'
+    else:
+        cache_control = 'public, max-age=86400'
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(thumb_path, media_type=THUMBS.variants[variant].media_type, headers=headers)
+
+
 @app.websocket('/ws')
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     username = None
+    conn = None
     
     try:
         data = await websocket.receive_text()
         try:
-            packet = json.loads(data)
+            packet = JSON.loads(data)
         except Exception:
             await websocket.close(code=1003)
             return
@@ -211,7 +548,7 @@ async def websocket_endpoint(websocket: WebSocket):
 
         username = packet['username']
     # registrar conexión y actualizar IP
-        connections[username] = websocket
+        conn = connections.add(username, websocket)
         
         # Obtener y guardar IP del usuario
         headers = websocket.headers
@@ -223,46 +560,62 @@ async def websocket_endpoint(websocket: WebSocket):
         )
         
         # Guardar IP del usuario
-        user_ips[username] = client_ip
+        await BUS.join(username, client_ip)
         print(f"[WebSocket] Usuario {username} registrado con IP: {client_ip}")
         
         # Notificar IP asignada al usuario
-        await websocket.send_text(json.dumps({
+        conn.send_json({
             'type': 'ip_assigned',
             'ip': client_ip,
             'username': username
-        }))
+        })
         
-        # Notificar a todos los usuarios conectados la actualización de IPs
-        for ws in connections.values():
-            try:
-                await ws.send_text(json.dumps({
-                    'type': 'user_list_update',
-                    'users': list(connections.keys()),
-                    'userIPs': user_ips
-                }))
-            except Exception as e:
-                print(f"[WebSocket] Error al actualizar lista de usuarios: {e}")
+        # Snapshot de presencia para el nuevo usuario; a los demás les llega el
+        # alta como delta (agrupada con otros cambios cercanos)
+        conn.send_json(BUS.presence.snapshot())
 
     # entregar mensajes pendientes
-        pending = undelivered.pop(username, [])
-        for msg in pending:
-            await websocket.send_text(json.dumps(msg))
+        _spawn(_deliver_offline(conn, username), f"entrega offline a {username}")
 
     # bucle principal
         while True:
-            text = await websocket.receive_text()
+            frame = await websocket.receive()
+            if frame['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(frame.get('code', 1000))
+            if frame.get('bytes') is not None:
+                # Los frames binarios son chunks de archivos (ver src/app/relay.py)
+                await RELAY.on_frame(username, frame['bytes'])
+                continue
             try:
-                pkt = json.loads(text)
+                pkt = JSON.loads(frame.get('text') or '')
             except Exception:
+                pkt = None
+            kind = pkt.get('type') if isinstance(pkt, dict) and isinstance(pkt.get('type'), str) else '*'
+
+            # Un cliente ruidoso no debe acaparar el bucle ni el bus: lo que
+            # excede su límite se descarta sin procesarlo
+            retry_after = LIMITER.check(username, kind)
+            if retry_after:
+                if LIMITER.should_close(username):
+                    print(f"[WebSocket] {username} sigue excediendo el límite de mensajes, desconectando")
+                    await conn.close(code=1008)
+                    break
+                if LIMITER.should_notify(username, retry_after):
+                    conn.send_json({'type': 'rate_limited', 'kind': kind,
+                                    'retry_after': round(retry_after, 2)}, droppable=True)
+                continue
+            if not isinstance(pkt, dict):
                 # ignorar mensajes malformados
                 continue
 
+            if await RELAY.handle(username, pkt):
+                continue
+
             if pkt.get('type') == 'message':
                 to = pkt.get('to')
                 # Crear información de simulación de capas
                 session_id = str(uuid.uuid4())[:8]
-                sequence_number = len(undelivered.get(to, [])) + 1
+                sequence_number = await BUS.next_seq(to)
                 source_ip = user_ips.get(username, client_ip)
                 dest_ip = user_ips.get(to, "unknown")
                 
@@ -286,34 +639,38 @@ async def websocket_endpoint(websocket: WebSocket):
                     }
                 }
                 print(f"[WebSocket] Enviando mensaje con capas: {out['layerInfo']}")
-                ws_to = connections.get(to)
-                if ws_to:
-                    try:
-                        await ws_to.send_text(json.dumps(out))
-                    except Exception:
-                        # almacenar si falla el envío
-                        undelivered.setdefault(to, []).append(out)
-                else:
-                    undelivered.setdefault(to, []).append(out)
+                # Se entrega en el worker donde esté conectado; si no lo está (o la
+                # conexión cae antes de enviarlo) se almacena
+                await BUS.route(to, out, sequence_number)
+
+            elif pkt.get('type') == 'presence_sync' or (pkt.get('type') == 'list' and 'version' in pkt):
+                # Cliente con presencia versionada: solo lo que le falta desde su versión
+                # (o un snapshot si ya no está en el historial o la versión no es válida)
+                version = pkt.get('version')
+                conn.send_json(BUS.presence.sync(version if isinstance(version, int) else None))
 
             elif pkt.get('type') == 'list':
-                # devolver lista de usuarios activos y sus IPs
-                users = list(connections.keys())
+                # devolver lista de usuarios activos y sus IPs (de todos los
+                # workers: la presencia es la del bus, no solo las conexiones de aquí)
+                users = list(BUS.presence.members)
                 print(f"[WebSocket] Enviando lista de usuarios a {username}. IPs actuales: {user_ips}")
-                await websocket.send_text(json.dumps({
+                conn.send_json({
                     'type': 'list',
                     'users': users,
                     'userIPs': user_ips,
                     'currentUser': username
-                }))
+                })
 
     except WebSocketDisconnect:
-        if username and connections.get(username) is websocket:
-            del connections[username]
-            if username in user_ips:
-                del user_ips[username]
+        pass
     finally:
-        if username and connections.get(username) is websocket:
-            del connections[username]
-            if username in user_ips:
-                del user_ips[username]
+        if conn is not None:
+            # La baja es de esta sesión salvo que otra del mismo usuario la haya reemplazado
+            replaced = connections.get(username) not in (None, conn)
+            await conn.close()
+            if not replaced:
+                LIMITER.forget(username)
+                try:
+                    await BUS.leave(username)
+                except ConnectionError as e:
+                    print(f"[WebSocket] No se pudo dar de baja a {username}: {e}")
@@ -0,0 +1,454 @@
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import random
+import time
+import urllib.request
+from collections import Counter, deque
+from dataclasses import asdict, dataclass, field, replace
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import websockets
+
+from src.transporte.codec import JSON
+
+# Generador de carga para el chat (/ws).
+#
+# Conecta users clientes simulados (en rampa durante ramp segundos) y cada
+# uno hace operaciones a rate por segundo (llegadas de Poisson) repartidas
+# según mix: "message" envía a otro usuario simulado al azar, "list" pide la
+# lista de usuarios, "presence_sync" pide la presencia desde la versión que
+# tiene y "register" cierra la conexión y vuelve a registrarse.
+#
+# Los mensajes llevan en el texto quién los envía y cuándo (perf_counter_ns,
+# emisor y receptor están en este proceso), así que la latencia medida es la
+# de entrega extremo a extremo a través del servidor. "list" mide el ida y
+# vuelta hasta su respuesta. Durante la prueba se consulta /chat/stats para
+# seguir la memoria del worker (con varios workers cada consulta la atiende
+# uno cualquiera). lag_ms es el retraso del event loop de este proceso: si
+# crece, el cuello de botella es el generador y no el servidor; con
+# --processes los usuarios se reparten entre varios procesos (todos se
+# envían mensajes entre sí) y sus muestras se juntan al final.
+#
+#   python -m frontend_api.ws_load --users 2000 --duration 60 --rate 0.5 \
+#       --mix message=0.8,list=0.1,register=0.1 --size 32-512 --output carga.json
+
+MARK = "~lt"    # Prefijo de los mensajes de la prueba: ~lt<emisor>:<ns>|relleno
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """"message=0.8,list=0.2" -> pesos normalizados"""
+    weights = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        op, _, weight = item.partition('=')
+        op = op.strip()
+        if op not in ("message", "list", "presence_sync", "register"):
+            raise ValueError(f"Operación desconocida en el mix: {op}")
+        weights[op] = float(weight or 1)
+    total = sum(weights.values())
+    if total <= 0:
+        raise ValueError("El mix no tiene ninguna operación con peso")
+    return {op: w / total for op, w in weights.items()}
+
+
+def parse_size(spec: str) -> Tuple[int, int]:
+    """"256" o "32-1024" -> (mínimo, máximo) en bytes del texto del mensaje"""
+    low, _, high = spec.partition('-')
+    return int(low), int(high or low)
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Percentil p (0-100) por rango más cercano de una lista ordenada"""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def _latency_summary(samples: List[float]) -> Dict:
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else None,
+        "p50_ms": percentile(values, 50),
+        "p90_ms": percentile(values, 90),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1] if values else None,
+    }
+
+
+@dataclass
+class LoadConfig:
+    url: str = "ws://127.0.0.1:8000/ws"
+    users: int = 100
+    duration: float = 30.0
+    rate: float = 1.0                   # Operaciones por segundo y usuario
+    mix: Dict[str, float] = field(default_factory=lambda: {"message": 1.0})
+    size: Tuple[int, int] = (64, 64)
+    ramp: float = 5.0                   # Segundos para conectar a todos
+    drain: float = 3.0                  # Espera final a los mensajes en vuelo
+    prefix: str = "load"
+    stats_url: Optional[str] = None     # None: /chat/stats del mismo host
+    stats_interval: float = 1.0
+    seed: Optional[int] = None
+    shard: int = 0                      # Este proceso simula los usuarios i con i % shards == shard
+    shards: int = 1
+
+
+class LoadStats:
+    def __init__(self):
+        self.ops: Counter = Counter()           # Operaciones enviadas por tipo
+        self.received: Counter = Counter()      # Mensajes recibidos por tipo
+        self.delivery_ms: List[float] = []
+        self.list_rtt_ms: List[float] = []
+        self.connect_ms: List[float] = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors: Counter = Counter()
+        self.lag_ms: List[float] = []
+        self.memory: List[Dict] = []            # Muestras de /chat/stats
+        self.connected = 0
+        self.connect_seconds = 0.0
+        self.elapsed = 0.0
+
+    def merge(self, other: "LoadStats"):
+        """Suma las muestras de otro proceso del generador"""
+        for name in ("ops", "received", "errors"):
+            getattr(self, name).update(getattr(other, name))
+        for name in ("delivery_ms", "list_rtt_ms", "connect_ms", "lag_ms", "memory"):
+            getattr(self, name).extend(getattr(other, name))
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.connected += other.connected
+        self.connect_seconds = max(self.connect_seconds, other.connect_seconds)
+        self.elapsed = max(self.elapsed, other.elapsed)
+
+
+class _User:
+    def __init__(self, name: str, cfg: LoadConfig, stats: LoadStats, names: List[str], rng: random.Random):
+        self.name = name
+        self.cfg = cfg
+        self.stats = stats
+        self.names = names
+        self.rng = rng
+        self.ws = None
+        self.version: Optional[int] = None
+        self.pending_lists: deque = deque()
+        self.reader: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        start = time.perf_counter()
+        self.ws = await websockets.connect(self.cfg.url, max_size=None, open_timeout=30)
+        await self._send({"type": "register", "username": self.name})
+        self.stats.connect_ms.append((time.perf_counter() - start) * 1000)
+        self.pending_lists.clear()
+        self.reader = asyncio.create_task(self._read_loop(self.ws))
+
+    async def disconnect(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+    async def _send(self, payload: Dict):
+        text = JSON.dumps_text(payload)
+        self.stats.bytes_sent += len(text)
+        await self.ws.send(text)
+
+    async def _read_loop(self, ws):
+        stats = self.stats
+        try:
+            async for frame in ws:
+                now = time.perf_counter_ns()
+                stats.bytes_received += len(frame)
+                if isinstance(frame, bytes):
+                    stats.received["binary"] += 1
+                    continue
+                data = JSON.loads(frame)
+                kind = data.get("type")
+                stats.received[kind] += 1
+                if kind == "message":
+                    text = data.get("msg", "")
+                    if text.startswith(MARK):
+                        sent = int(text[len(MARK):text.index('|')].rsplit(':', 1)[1])
+                        stats.delivery_ms.append((now - sent) / 1e6)
+                elif kind == "list" and self.pending_lists:
+                    stats.list_rtt_ms.append((now - self.pending_lists.popleft()) / 1e6)
+                elif kind in ("presence_snapshot", "presence_delta"):
+                    self.version = max(self.version or 0, data.get("version", 0))
+        except websockets.ConnectionClosed as e:
+            if e.rcvd is not None and e.rcvd.code not in (1000, 1001):
+                stats.errors[f"closed_{e.rcvd.code}"] += 1
+
+    def _message(self) -> str:
+        low, high = self.cfg.size
+        head = f"{MARK}{self.name}:{time.perf_counter_ns()}|"
+        return head + "x" * max(0, self.rng.randint(low, high) - len(head))
+
+    async def run(self, stop: asyncio.Event):
+        ops, weights = list(self.cfg.mix), list(self.cfg.mix.values())
+        while not stop.is_set():
+            delay = self.rng.expovariate(self.cfg.rate) if self.cfg.rate > 0 else self.cfg.duration
+            try:
+                await asyncio.wait_for(stop.wait(), delay)
+                return
+            except asyncio.TimeoutError:
+                pass
+            op = self.rng.choices(ops, weights)[0]
+            try:
+                if op == "message":
+                    to = self.rng.choice(self.names)
+                    while to == self.name and len(self.names) > 1:
+                        to = self.rng.choice(self.names)
+                    await self._send({"type": "message", "to": to, "msg": self._message()})
+                elif op == "list":
+                    self.pending_lists.append(time.perf_counter_ns())
+                    await self._send({"type": "list"})
+                elif op == "presence_sync":
+                    await self._send({"type": "presence_sync", "version": self.version or 0})
+                elif op == "register":
+                    await self.disconnect()
+                    await self.connect()
+                self.stats.ops[op] += 1
+            except (websockets.ConnectionClosed, OSError) as e:
+                self.stats.errors[type(e).__name__] += 1
+                # El servidor cerró (límite, cola llena...): reconectar y seguir
+                try:
+                    await self.disconnect()
+                    await self.connect()
+                except (websockets.WebSocketException, OSError, asyncio.TimeoutError) as e:
+                    self.stats.errors[f"reconnect_{type(e).__name__}"] += 1
+                    return
+
+
+def _stats_url(cfg: LoadConfig) -> str:
+    if cfg.stats_url:
+        return cfg.stats_url
+    parts = urlsplit(cfg.url)
+    scheme = "https" if parts.scheme == "wss" else "http"
+    return f"{scheme}://{parts.netloc}/chat/stats"
+
+
+def _fetch_stats(url: str) -> Dict:
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read())
+
+
+async def _sample_server(cfg: LoadConfig, stats: LoadStats, stop: asyncio.Event):
+    url = _stats_url(cfg)
+    while True:
+        try:
+            sample = await asyncio.to_thread(_fetch_stats, url)
+            sample["t"] = time.monotonic()
+            stats.memory.append(sample)
+        except (OSError, ValueError) as e:
+            stats.errors["stats_unavailable"] += 1
+            if not stats.memory:
+                print(f"[LOAD] No se pudo consultar {url}: {e}")
+                return
+        try:
+            await asyncio.wait_for(stop.wait(), cfg.stats_interval)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _monitor_lag(stats: LoadStats, stop: asyncio.Event, interval: float = 0.1):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        stats.lag_ms.append((loop.time() - start - interval) * 1000)
+
+
+def _memory_summary(samples: List[Dict]) -> Optional[Dict]:
+    rss = [s["process"]["rss_bytes"] for s in samples if s.get("process", {}).get("rss_bytes")]
+    if not rss:
+        return None
+    last = samples[-1]
+    return {
+        "rss_start_bytes": rss[0],
+        "rss_end_bytes": rss[-1],
+        "rss_peak_bytes": max(rss),
+        "rss_growth_bytes": rss[-1] - rss[0],
+        "samples": len(rss),
+        "server": {key: last.get(key) for key in ("connections", "rate_limit")},
+    }
+
+
+async def _run_shard(cfg: LoadConfig) -> LoadStats:
+    """Simula los usuarios de este proceso y retorna sus muestras"""
+    rng = random.Random(None if cfg.seed is None else cfg.seed + cfg.shard)
+    stats = LoadStats()
+    names = [f"{cfg.prefix}{i}" for i in range(cfg.users)]
+    mine = names[cfg.shard::cfg.shards]
+    users = [_User(name, cfg, stats, names, random.Random(rng.random())) for name in mine]
+    stop = asyncio.Event()
+    # La memoria del servidor la sigue un solo proceso
+    sampler = asyncio.create_task(_sample_server(cfg, stats, stop)) if cfg.shard == 0 else None
+    lag = asyncio.create_task(_monitor_lag(stats, stop))
+
+    # Rampa de conexiones: users repartidos en ramp segundos
+    connect_start = time.perf_counter()
+    connected: List[_User] = []
+
+    async def connect(user: _User, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await user.connect()
+            connected.append(user)
+        except (websockets.WebSocketException, OSError, asyncio.TimeoutError) as e:
+            stats.errors[f"connect_{type(e).__name__}"] += 1
+
+    await asyncio.gather(*(connect(user, cfg.ramp * i / len(users)) for i, user in enumerate(users)))
+    stats.connected = len(connected)
+    stats.connect_seconds = time.perf_counter() - connect_start
+    print(f"[LOAD] {len(connected)}/{len(users)} usuarios conectados en {stats.connect_seconds:.1f}s")
+
+    start = time.perf_counter()
+    workers = [asyncio.create_task(user.run(stop)) for user in connected]
+    await asyncio.sleep(cfg.duration)
+    stop.set()
+    await asyncio.gather(*workers, return_exceptions=True)
+    stats.elapsed = time.perf_counter() - start
+    # Los mensajes en vuelo todavía pueden llegar
+    await asyncio.sleep(cfg.drain)
+    await asyncio.gather(*(t for t in (sampler, lag) if t is not None), return_exceptions=True)
+    await asyncio.gather(*(user.disconnect() for user in connected), return_exceptions=True)
+    return stats
+
+
+def _shard_main(cfg: LoadConfig) -> LoadStats:
+    _raise_fd_limit(cfg.users // cfg.shards + 1)
+    return asyncio.run(_run_shard(cfg))
+
+
+def _summarize(cfg: LoadConfig, stats: LoadStats) -> Dict:
+    elapsed = stats.elapsed
+    sent = stats.ops["message"]
+    delivered = len(stats.delivery_ms)
+    config = asdict(cfg)
+    del config["shard"]
+    return {
+        "config": {**config, "size": list(cfg.size)},
+        "connected": stats.connected,
+        "connect_seconds": round(stats.connect_seconds, 3),
+        "connect_latency": _latency_summary(stats.connect_ms),
+        "duration_seconds": round(elapsed, 3),
+        "ops": dict(stats.ops),
+        "ops_per_second": round(sum(stats.ops.values()) / elapsed, 1) if elapsed else None,
+        "messages": {
+            "sent": sent,
+            "delivered": delivered,
+            "delivered_per_second": round(delivered / elapsed, 1) if elapsed else None,
+            # Incluye los que el servidor guardó para usuarios reconectando
+            # y los descartados por los límites de entrada
+            "undelivered": sent - delivered,
+            "latency": _latency_summary(stats.delivery_ms),
+        },
+        "list_rtt": _latency_summary(stats.list_rtt_ms),
+        "received": dict(stats.received),
+        "bytes_sent": stats.bytes_sent,
+        "bytes_received": stats.bytes_received,
+        "errors": dict(stats.errors),
+        "client_lag_ms": {"p99": percentile(sorted(stats.lag_ms), 99),
+                          "max": max(stats.lag_ms) if stats.lag_ms else None},
+        "server_memory": _memory_summary(stats.memory),
+    }
+
+
+async def run_load(cfg: LoadConfig) -> Dict:
+    """Ejecuta la prueba en este proceso y retorna el resultado (lo que se exporta en JSON)"""
+    return _summarize(cfg, await _run_shard(replace(cfg, shard=0, shards=1)))
+
+
+def run_load_processes(cfg: LoadConfig, processes: int) -> Dict:
+    """Como run_load con los usuarios repartidos entre processes procesos"""
+    shards = [replace(cfg, shard=i, shards=processes) for i in range(processes)]
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        results = pool.map(_shard_main, shards)
+    stats = results[0]
+    for other in results[1:]:
+        stats.merge(other)
+    return _summarize(replace(cfg, shards=processes), stats)
+
+
+def _raise_fd_limit(users: int):
+    """Cada usuario es un socket: subir el límite blando de descriptores hasta el duro"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = users + 64
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new, hard))
+        if new < wanted:
+            print(f"[LOAD] ADVERTENCIA: límite de descriptores {new}, insuficiente para {users} usuarios")
+
+
+def _print_summary(result: Dict):
+    msgs = result["messages"]
+    lat = msgs["latency"]
+    print(f"[LOAD] {result['connected']} usuarios, {result['duration_seconds']}s, "
+          f"{result['ops_per_second']} ops/s")
+    print(f"[LOAD] Mensajes: {msgs['sent']} enviados, {msgs['delivered']} entregados "
+          f"({msgs['delivered_per_second']}/s)")
+    if lat["count"]:
+        print(f"[LOAD] Latencia de entrega: p50={lat['p50_ms']:.2f}ms p99={lat['p99_ms']:.2f}ms "
+              f"max={lat['max_ms']:.2f}ms")
+    if result["list_rtt"]["count"]:
+        print(f"[LOAD] Ida y vuelta de list: p50={result['list_rtt']['p50_ms']:.2f}ms "
+              f"p99={result['list_rtt']['p99_ms']:.2f}ms")
+    memory = result["server_memory"]
+    if memory:
+        print(f"[LOAD] Memoria del servidor: {memory['rss_start_bytes'] / 2**20:.1f} -> "
+              f"{memory['rss_end_bytes'] / 2**20:.1f} MB (pico {memory['rss_peak_bytes'] / 2**20:.1f} MB)")
+    if result["errors"]:
+        print(f"[LOAD] Errores: {result['errors']}")
+    lag = result["client_lag_ms"]["max"]
+    if lag is not None and lag > 100:
+        print(f"[LOAD] ADVERTENCIA: el generador va saturado (retraso del event loop {lag:.0f}ms)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga del WebSocket del chat")
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws")
+    parser.add_argument("--users", type=int, default=100, help="Usuarios simultáneos")
+    parser.add_argument("--duration", type=float, default=30.0, help="Segundos de carga")
+    parser.add_argument("--rate", type=float, default=1.0, help="Operaciones por segundo y usuario")
+    parser.add_argument("--mix", default="message=1", help="Pesos de operación: message,list,presence_sync,register")
+    parser.add_argument("--size", default="64", help="Bytes del texto de cada mensaje: N o MIN-MAX")
+    parser.add_argument("--ramp", type=float, default=5.0, help="Segundos para conectar a todos")
+    parser.add_argument("--drain", type=float, default=3.0, help="Espera final a mensajes en vuelo")
+    parser.add_argument("--prefix", default="load", help="Prefijo de los nombres de usuario")
+    parser.add_argument("--stats-url", default=None, help="URL de /chat/stats (por defecto la del mismo host)")
+    parser.add_argument("--processes", type=int, default=1, help="Procesos del generador (para miles de usuarios)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="Archivo JSON con los resultados")
+    args = parser.parse_args(argv)
+
+    cfg = LoadConfig(url=args.url, users=args.users, duration=args.duration, rate=args.rate,
+                     mix=parse_mix(args.mix), size=parse_size(args.size), ramp=args.ramp,
+                     drain=args.drain, prefix=args.prefix, stats_url=args.stats_url, seed=args.seed)
+    if args.processes > 1:
+        result = run_load_processes(cfg, args.processes)
+    else:
+        _raise_fd_limit(cfg.users)
+        result = asyncio.run(run_load(cfg))
+    _print_summary(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"[LOAD] Resultados en {args.output}")
+    return result
+
+
+if __name__ == "__main__":
+    main()
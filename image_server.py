@@ -1,20 +1,285 @@
 import asyncio
-import json
 import os
+import time
 from pathlib import Path
+from typing import Optional, Union
 
-from src.transporte.reliable import start_server, read_message, send_message
-from src.transporte.fragmentation import unpack_chunk, Reassembler
+from src.transporte.reliable import start_server, read_message, read_messages, send_message
+from src.transporte.fragmentation import get_pipeline
+from src.transporte.reassembly import ReassemblyManager, SpillReassembler, TransferRejected
+from src.transporte.tlv import parse_control, encode_control, control_format
+from src.transporte.codec import JSON, Codec, UnsupportedCodec, available
+from src.transporte.fec import FECConfig
+from src.transporte.chunk_store import ChunkStore, Manifest
+from src.transporte.acks import AckBatcher
+from src.transporte.storage import IncrementalFile, get_storage
+from src.transporte.admission import AdmissionController, FairScheduler, Flow, ServerBusy
 
 SAVE_DIR = Path("received")
 SAVE_DIR.mkdir(exist_ok=True)
 
+# Transferencias en curso: presupuesto global de memoria; lo que no cabe se
+# reensambla en disco (dentro de SAVE_DIR para poder mover el archivo final)
+MANAGER = ReassemblyManager(
+    memory_budget=int(os.environ.get("IMG_SERVER_MEMORY_BUDGET", 256 * 1024 * 1024)),
+    spill_dir=SAVE_DIR / ".spill",
+    max_transfer_size=int(os.environ.get("IMG_SERVER_MAX_TRANSFER_BYTES", 4 * 1024 ** 3)),
+    spill_budget=int(os.environ.get("IMG_SERVER_SPILL_BUDGET", 8 * 1024 ** 3)),
+)
+
+# Almacén direccionado por contenido: las subidas repetidas solo envían los
+# bloques que el servidor no tiene
+STORE = ChunkStore(SAVE_DIR / ".store")
+
+# E/S de disco (escrituras, fsync, renombrados) fuera del event loop
+STORAGE = get_storage()
+
+# Admisión: transferencias activas globales y por cliente; el resto espera en
+# cola o recibe "busy" con un retry_after
+ADMISSION = AdmissionController(
+    max_active=int(os.environ.get("IMG_SERVER_MAX_ACTIVE", 8)),
+    max_per_client=int(os.environ.get("IMG_SERVER_MAX_PER_CLIENT", 2)),
+    max_queued=int(os.environ.get("IMG_SERVER_MAX_QUEUED", 32)),
+)
+# Reparto justo (DRR) del procesamiento de chunks entre transferencias activas
+SCHEDULER = FairScheduler()
+
+
+async def _receive_chunks(reader, writer, reassembler, binary_acks: Union[bool, Codec], send_acks: bool = True,
+                          batcher: Optional[AckBatcher] = None, sink: Optional[IncrementalFile] = None,
+                          flow: Optional[Flow] = None):
+    """
+    Lee chunks hasta completar la imagen o hasta que se cierre la conexión.
+    Con batcher los ACKs se agrupan; sin send_acks (SEMI-FIABLE) no se confirma nada.
+    Con sink se deja de leer mientras el disco va retrasado. Con flow cada
+    chunk espera su turno en SCHEDULER antes de procesarse (y de confirmarse).
+    Los chunks que ya están en el buffer del socket se leen juntos y se
+    verifican como un lote (en el pool si el lote es grande).
+    """
+    pipeline = get_pipeline()
+    while not reassembler.is_complete():
+        try:
+            batch = await read_messages(reader, pipeline.batch_size)
+        except Exception:
+            # Conexión cerrada o lectura incompleta
+            break
+        if MANAGER.get(reassembler.transfer_id) is not reassembler:
+            # Transferencia expirada mientras esperábamos datos
+            break
+
+        for pkt_bytes, unpacked in zip(batch, await pipeline.unpack_many(batch)):
+            if flow is not None:
+                await SCHEDULER.acquire(flow, len(pkt_bytes))
+            try:
+                meta_c = await _process_chunk(reassembler, unpacked, sink)
+            finally:
+                if flow is not None:
+                    SCHEDULER.release()
+            if meta_c is None or meta_c["parity"]:
+                continue
+
+            if batcher is not None:
+                batcher.on_chunk(meta_c["chunk_id"])
+            elif send_acks:
+                # Cliente sin ACKs por lotes: un ACK por chunk
+                ack = encode_control({"type": "ack", "chunk_id": meta_c["chunk_id"]}, binary_acks)
+                await send_message(writer, ack)
+
+            if reassembler.is_complete():
+                break
+
+    if batcher is not None:
+        batcher.close()
+
+
+async def _process_chunk(reassembler, unpacked, sink: Optional[IncrementalFile]) -> Optional[dict]:
+    """Agrega un chunk desempaquetado (o paridad FEC); None si el chunk es inválido"""
+    if isinstance(unpacked, ValueError):
+        print(f"[IMG SERVER] Chunk inválido: {unpacked}")
+        return None
+    meta_c, payload = unpacked
+    try:
+        reassembler.add_frame(meta_c, payload)
+    except ValueError as e:
+        print(f"[IMG SERVER] Chunk inválido: {e}")
+        return None
+    if sink is not None:
+        await sink.wait_capacity()
+    return meta_c
+
+
+async def _receive_image(pkt: dict, data: bytes, writer, finish, sink_path: Optional[Path] = None) -> bool:
+    """
+    Recibe los chunks anunciados por un img_meta y llama a finish(reassembler, sink)
+    al terminar, con la imagen completa o parcial. Con sink_path los chunks se
+    escriben a disco según llegan (sink) y finish solo tiene que publicarlo.
+    Retorna False si la transferencia se rechazó o expiró.
+    """
+    name = pkt.get("name", "imagen_recibida.bin")
+    size = int(pkt.get("size", 0))
+    total_chunks = int(pkt.get("total_chunks", 0))
+    # Los ACKs se responden en el mismo formato que usó el cliente (TLV, JSON o msgpack)
+    binary_acks = control_format(data)
+    print(f"[IMG SERVER] Preparando recepción de {name} ({size} bytes, {total_chunks} chunks)")
+
+    # Admisión: esperar hueco o rechazar con retry_after. Solo esperan en cola
+    # los clientes que piden "admission" (no envían chunks hasta recibir
+    # "admit"); los demás ya están enviando, así que reciben "busy" enseguida
+    client = (writer.get_extra_info("peername") or ("desconocido",))[0]
+    try:
+        await ADMISSION.acquire(client, wait=bool(pkt.get("admission")))
+    except ServerBusy as e:
+        print(f"[IMG SERVER] {name} rechazada: {e}")
+        await send_message(writer, encode_control(
+            {"type": "busy", "retry_after": e.retry_after, "msg": e.reason}, binary_acks))
+        return False
+    admitted_at = time.monotonic()
+
+    # Crear reensamblador con timeout de inactividad proporcional;
+    # si expira se cierra la conexión para desbloquear la lectura
+    timeout = max(10.0, total_chunks * 0.2)
+    try:
+        # El id lo genera el servidor: uno elegido por el cliente podría
+        # chocar con el de otra transferencia
+        reassembler = MANAGER.open(None, size, total_chunks, timeout=timeout, on_expire=writer.close,
+                                   chunk_size=int(pkt.get("chunk_size") or 0) or None)
+    except (TransferRejected, ValueError) as e:
+        ADMISSION.release(client)
+        print(f"[IMG SERVER] Transferencia rechazada: {e}")
+        await send_message(writer, encode_control({"type": "error", "msg": str(e)}, binary_acks))
+        return False
+    transfer_id = reassembler.transfer_id
+    # Progreso como eventos coalescidos (uno por segundo como mucho)
+    reassembler.progress.name = name
+    reassembler.progress.min_interval = 1.0
+    reassembler.progress.add_listener(
+        lambda e: print(f"[IMG SERVER] Progreso {e.name}: {e.percent:.1f}% ({e.rate / 1024:.1f} KB/s)"))
+    fec_config = FECConfig.from_fields(pkt)
+    if fec_config is not None:
+        reassembler.enable_fec(fec_config, int(pkt["chunk_size"]))
+
+    # El cliente declara en img_meta si espera ACKs y si los acepta por lotes
+    send_acks = pkt.get("mode", "FIABLE") != "SEMI-FIABLE"
+    ack_every = int(pkt.get("ack_every", 0))
+    batcher = AckBatcher(writer, ack_every) if send_acks and ack_every > 0 else None
+
+    # En memoria, cada chunk se escribe además en un temporal junto al destino
+    # según llega; el reensamblado en disco (spill) ya está en su archivo
+    sink = None
+    if sink_path is not None and not isinstance(reassembler, SpillReassembler):
+        sink = STORAGE.open_incremental(sink_path, size)
+        reassembler.on_store = sink.submit
+
+    # Obtener reader desde writer (patrón usado en este proyecto)
+    reader = writer._transport._protocol._stream_reader
+
+    flow = SCHEDULER.register(transfer_id)
+    try:
+        if pkt.get("admission"):
+            await send_message(writer, encode_control({"type": "admit", "transfer_id": transfer_id}, binary_acks))
+        await _receive_chunks(reader, writer, reassembler, binary_acks, send_acks, batcher, sink, flow)
+
+        if MANAGER.get(transfer_id) is not reassembler:
+            # Expirada por inactividad: el gestor ya liberó sus recursos
+            return False
+
+        reassembler.recover_missing()
+        await finish(reassembler, sink)
+        return True
+    finally:
+        reassembler.progress.finish()
+        SCHEDULER.unregister(flow)
+        MANAGER.release(transfer_id)
+        ADMISSION.release(client, time.monotonic() - admitted_at)
+        if sink is not None:
+            await sink.abort()
+
+
+async def _save_image(reassembler, sink: Optional[IncrementalFile], name: str):
+    """Guarda la imagen recibida y la incorpora al almacén de deduplicación"""
+    out_path = SAVE_DIR / name
+    partial_path = SAVE_DIR / f"{name}.partial"
+    complete = reassembler.is_complete()
+    if sink is not None:
+        # Los chunks ya están en disco: solo queda fsync + rename atómico
+        await sink.finalize(out_path if complete else partial_path)
+    elif complete:
+        await STORAGE.run(reassembler.save, out_path)
+    elif isinstance(reassembler, SpillReassembler):
+        # Los huecos del archivo de spill ya son ceros: basta con renombrarlo
+        await STORAGE.run(reassembler.save_partial, partial_path)
+    else:
+        # Vista sobre el buffer parcial: se escribe sin copiarlo
+        await STORAGE.write_file(partial_path, reassembler.partial_view())
+
+    if complete:
+        print(f"[IMG SERVER] Imagen guardada: {out_path}")
+        # Pillow lee el archivo entero: en el pool de STORAGE, no en el loop
+        if not await STORAGE.validate_image(out_path):
+            print(f"[IMG SERVER] ADVERTENCIA: {out_path} no es una imagen válida")
+        await asyncio.to_thread(STORE.add_file, out_path)
+    else:
+        print(f"[IMG SERVER] Imagen parcial guardada: {partial_path}")
+
+
+async def _receive_manifest(pkt: dict, data: bytes, writer):
+    """
+    Responde al manifiesto con los hashes de bloques que faltan en el almacén;
+    si falta alguno, el cliente los envía concatenados como una imagen
+    normal (img_meta con "delta") y el archivo se reconstruye con el almacén.
+    """
+    name = pkt.get("name", "imagen_recibida.bin")
+    binary = control_format(data)
+    try:
+        manifest = Manifest.from_fields(pkt)
+    except (KeyError, ValueError) as e:
+        await send_message(writer, encode_control({"type": "error", "msg": f"Manifiesto inválido: {e}"}, binary))
+        return
+
+    missing = await asyncio.to_thread(STORE.missing, manifest)
+    await send_message(writer, encode_control(
+        {"type": "manifest_ack", "file_hash": manifest.file_hash, "missing": b"".join(missing).hex()}, binary))
+    lengths = dict(manifest.blocks)
+    print(f"[IMG SERVER] Manifiesto de {name}: faltan {len(missing)}/{len(manifest.blocks)} bloques "
+          f"({sum(lengths[d] for d in missing)}/{manifest.size} bytes)")
+
+    new_blocks = {}
+    if missing:
+        reader = writer._transport._protocol._stream_reader
+        meta_raw = await read_message(reader)
+        meta = parse_control(meta_raw)
+        if meta.get("type") != "img_meta" or meta.get("delta") != manifest.file_hash:
+            print(f"[IMG SERVER] Se esperaba el delta de {name}: {meta}")
+            return
+        if int(meta.get("size", 0)) != sum(lengths[d] for d in missing):
+            await send_message(writer, encode_control({"type": "error", "msg": "Tamaño de delta incorrecto"}, binary))
+            return
+
+        async def collect(reassembler, sink):
+            delta = reassembler.assemble()
+            if delta is None:
+                return
+            offset = 0
+            for digest in missing:
+                new_blocks[digest] = delta[offset:offset + lengths[digest]]
+                offset += lengths[digest]
+
+        if not await _receive_image(meta, meta_raw, writer, collect) or not new_blocks:
+            print(f"[IMG SERVER] Delta de {name} incompleto; no se puede reconstruir")
+            return
+
+    out_path = SAVE_DIR / name
+    if await asyncio.to_thread(STORE.materialize, manifest, new_blocks, out_path):
+        print(f"[IMG SERVER] Imagen reconstruida desde el almacén: {out_path}")
+    else:
+        print(f"[IMG SERVER] No se pudo reconstruir {name}: bloques corruptos o ausentes")
+
 
 async def on_message(data: bytes, writer, transport):
     """Handler que soporta recepción de imágenes fragmentadas y archivos simples."""
-    # Intentar JSON primero
+    # Intentar frame de control primero (JSON o binario TLV)
     try:
-        pkt = json.loads(data.decode("utf-8"))
+        pkt = parse_control(data)
         ptype = pkt.get("type")
 
         # Mensaje de control
@@ -25,59 +290,13 @@ async def on_message(data: bytes, writer, transport):
         # Metadatos de imagen: iniciar recepción de chunks
         if ptype == "img_meta":
             name = pkt.get("name", "imagen_recibida.bin")
-            size = int(pkt.get("size", 0))
-            total_chunks = int(pkt.get("total_chunks", 0))
-            print(f"[IMG SERVER] Preparando recepción de {name} ({size} bytes, {total_chunks} chunks)")
-
-            # Crear reensamblador con timeout proporcional
-            timeout = max(10.0, total_chunks * 0.2)
-            reassembler = Reassembler(size, total_chunks, timeout=timeout)
-
-            # Obtener reader desde writer (patrón usado en este proyecto)
-            reader = writer._transport._protocol._stream_reader
-
-            last_progress = 0
-            while True:
-                try:
-                    pkt_bytes = await read_message(reader)
-                except Exception:
-                    # Conexión cerrada o lectura incompleta
-                    break
-
-                # Intentar desempaquetar chunk
-                try:
-                    meta_c, payload = unpack_chunk(pkt_bytes)
-                except ValueError as e:
-                    print(f"[IMG SERVER] Chunk inválido: {e}")
-                    continue
-
-                # Agregar chunk
-                reassembler.add_chunk(meta_c["chunk_id"], meta_c["offset"], payload, meta_c.get("metadata"))
-
-                # Enviar ACK de chunk (siempre, clientes FIABLE lo esperan; SEMI-FIABLE lo ignora)
-                ack = json.dumps({"type": "ack", "chunk_id": meta_c["chunk_id"]}).encode()
-                await send_message(writer, ack)
-
-                # Progreso
-                progress = reassembler.get_progress()
-                if progress - last_progress >= 10:
-                    print(f"[IMG SERVER] Progreso: {progress:.1f}%")
-                    last_progress = progress
-
-                if reassembler.is_complete():
-                    break
-
-            # Ensamblar y guardar
-            assembled = reassembler.assemble()
-            out_path = SAVE_DIR / name
-            if assembled is None:
-                partial = reassembler.assemble_partial()
-                (SAVE_DIR / f"{name}.partial").write_bytes(partial)
-                print(f"[IMG SERVER] Imagen parcial guardada: {out_path}.partial")
-            else:
-                out_path.write_bytes(assembled)
-                print(f"[IMG SERVER] Imagen guardada: {out_path}")
+            await _receive_image(pkt, data, writer, lambda r, sink: _save_image(r, sink, name),
+                                 sink_path=SAVE_DIR / name)
+            return
 
+        # Manifiesto de deduplicación: solo se reciben los bloques desconocidos
+        if ptype == "img_manifest":
+            await _receive_manifest(pkt, data, writer)
             return
 
         # Archivo normal (no fragmentado)
@@ -87,7 +306,7 @@ async def on_message(data: bytes, writer, transport):
             # Leer siguiente mensaje con datos
             reader = writer._transport._protocol._stream_reader
             filedata = await read_message(reader)
-            (SAVE_DIR / filename).write_bytes(filedata)
+            await STORAGE.write_file(SAVE_DIR / filename, filedata)
             print(f"[IMG SERVER] Archivo guardado: {SAVE_DIR/filename} ({size} bytes)")
             return
 
@@ -95,7 +314,14 @@ async def on_message(data: bytes, writer, transport):
         print(f"[IMG SERVER] Mensaje JSON no reconocido: {pkt}")
         return
 
-    except (json.JSONDecodeError, UnicodeDecodeError):
+    except UnsupportedCodec as e:
+        # El cliente habla un formato que aquí no está instalado: se le
+        # responde en JSON con los que sí, para que elija otro
+        print(f"[IMG SERVER] {e}")
+        await send_message(writer, encode_control({"type": "error", "msg": str(e), "codecs": available()}, JSON))
+        return
+
+    except ValueError:
         # Datos binarios inesperados; ignorar o registrar
         print(f"[IMG SERVER] Datos binarios recibidos ({len(data)} bytes) sin contexto de meta")
         return
@@ -105,6 +331,7 @@ async def main():
     host = "127.0.0.1"
     port = 9001
     print(f"[IMG SERVER] Iniciando en {host}:{port}...")
+    MANAGER.start()
     await start_server(host, port, on_message)
 
 
@@ -0,0 +1,436 @@
+import argparse
+import asyncio
+import itertools
+import os
+import subprocess
+import sys
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from src.app.message_store import MessageStore, open_message_store
+from src.app.presence import PresenceRegistry
+from src.transporte.codec import JSON, Codec, available, decode, get_codec, negotiate
+from src.transporte.reliable import read_message, write_message
+
+# Bus del chat: enrutado de mensajes, presencia y cola offline.
+#
+# frontend_api solo habla con el bus, así que el estado compartido (quién
+# está conectado y dónde, la versión de la presencia, los mensajes
+# pendientes) puede vivir fuera del proceso:
+#
+# - LocalBus lo guarda todo en el propio proceso (un solo worker).
+# - BrokerBus lo delega en un ChatBroker, un proceso local que atiende a
+#   todos los workers por un socket Unix (mensajes con prefijo de longitud,
+#   en JSON o msgpack según negocien con un "hello" al conectar). El broker
+#   sabe en qué worker está cada usuario y le reenvía sus mensajes; la
+#   presencia la versiona el broker y cada worker mantiene una réplica para
+#   responder snapshots y resyncs sin preguntarle. El primer worker que no
+#   encuentra el broker lo lanza; un lock de archivo evita que arranquen dos.
+#
+# Los workers entregan primero en local: un mensaje entre usuarios del mismo
+# worker no pasa por el broker.
+
+# deliver(usuario, mensaje, duradero) -> True si el usuario está en este proceso
+Deliver = Callable[[str, Dict, bool], bool]
+OnPresence = Callable[[Dict], None]
+
+
+class ChatBus:
+    """Interfaz común de los buses"""
+    presence: PresenceRegistry
+
+    async def start(self, deliver: Deliver, on_presence: OnPresence):
+        raise NotImplementedError
+
+    async def join(self, user: str, ip: str):
+        raise NotImplementedError
+
+    async def leave(self, user: str):
+        raise NotImplementedError
+
+    async def next_seq(self, user: str) -> int:
+        raise NotImplementedError
+
+    async def route(self, to: str, message: Dict, seq: int):
+        """Entrega message a to donde esté conectado o lo guarda para cuando vuelva"""
+        raise NotImplementedError
+
+    async def notify(self, to: str, message: Dict):
+        """Como route pero sin garantía: si to no está conectado se descarta"""
+        raise NotImplementedError
+
+    async def store(self, user: str, message: Dict, seq: Optional[int] = None):
+        raise NotImplementedError
+
+    async def fetch_offline(self, user: str, after: int = 0, limit: int = 100) -> List[Tuple[int, Dict]]:
+        raise NotImplementedError
+
+    async def ack_offline(self, user: str, upto: int):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalBus(ChatBus):
+    def __init__(self, store: MessageStore, debounce: float = 0.05):
+        self.message_store = store
+        self.debounce = debounce
+        self.presence = PresenceRegistry()
+        self._deliver: Deliver = lambda user, message, durable: False
+        self._on_presence: OnPresence = lambda message: None
+        self._presence_task: Optional[asyncio.Task] = None
+        self.presence_broadcasts = 0
+
+    async def start(self, deliver: Deliver, on_presence: OnPresence):
+        self._deliver = deliver
+        self._on_presence = on_presence
+
+    async def join(self, user: str, ip: str):
+        self.presence.join(user, ip)
+        self._schedule_presence()
+
+    async def leave(self, user: str):
+        self.presence.leave(user)
+        self._schedule_presence()
+
+    def _schedule_presence(self):
+        # Los cambios dentro de la ventana de debounce salen en un único delta
+        if self._presence_task is None or self._presence_task.done():
+            self._presence_task = asyncio.create_task(self._flush_presence())
+
+    async def _flush_presence(self):
+        await asyncio.sleep(self.debounce)
+        # A partir de aquí un cambio nuevo programa otro envío
+        self._presence_task = None
+        message = self.presence.flush()
+        if message is not None:
+            self.presence_broadcasts += 1
+            self._on_presence(message)
+
+    async def next_seq(self, user: str) -> int:
+        return await self.message_store.next_seq(user)
+
+    async def route(self, to: str, message: Dict, seq: int):
+        if not self._deliver(to, message, True):
+            await self.message_store.append(to, message, seq)
+
+    async def notify(self, to: str, message: Dict):
+        self._deliver(to, message, False)
+
+    async def store(self, user: str, message: Dict, seq: Optional[int] = None):
+        await self.message_store.append(user, message, seq)
+
+    async def fetch_offline(self, user: str, after: int = 0, limit: int = 100) -> List[Tuple[int, Dict]]:
+        return await self.message_store.fetch(user, after, limit)
+
+    async def ack_offline(self, user: str, upto: int):
+        await self.message_store.delete(user, upto)
+
+    async def close(self):
+        if self._presence_task is not None:
+            self._presence_task.cancel()
+        await self.message_store.close()
+
+
+class ChatBroker:
+    """Proceso que comparte un LocalBus entre los workers conectados por socket Unix"""
+
+    def __init__(self, path: str, store: MessageStore, debounce: float = 0.05):
+        self.path = path
+        self.bus = LocalBus(store, debounce)
+        self.workers: Dict[asyncio.StreamWriter, Codec] = {}     # worker -> codec negociado
+        self.owners: Dict[str, asyncio.StreamWriter] = {}   # usuario -> worker
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        await self.bus.start(self._forward, self._broadcast)
+        if os.path.exists(self.path):
+            os.unlink(self.path)     # Socket de un broker anterior (el lock garantiza que no vive)
+        self._server = await asyncio.start_unix_server(self._handle, self.path)
+        print(f"[BUS] Broker escuchando en {self.path}")
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def _forward(self, user: str, message: Dict, durable: bool, seq: Optional[int] = None) -> bool:
+        writer = self.owners.get(user)
+        if writer is None:
+            return False
+        codec = self.workers.get(writer, JSON)
+        write_message(writer, codec.dumps({"op": "deliver", "user": user, "message": message,
+                                           "durable": durable, "seq": seq}))
+        return True
+
+    def _broadcast(self, message: Dict):
+        encoded: Dict[str, bytes] = {}     # Se serializa una vez por codec
+        for writer, codec in list(self.workers.items()):
+            if codec.name not in encoded:
+                encoded[codec.name] = codec.dumps({"op": "presence", "message": message})
+            write_message(writer, encoded[codec.name])
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        mine: Set[str] = set()
+        try:
+            # Saludo: el worker ofrece sus codecs (en JSON) y se usa el primero
+            # que el broker también tenga; un worker sin saludo habla JSON
+            req = decode(await read_message(reader))
+            codec = JSON
+            if req.get("op") == "hello":
+                codec = negotiate(req.get("codecs"))
+                write_message(writer, JSON.dumps({"op": "hello", "codec": codec.name}))
+                req = None
+            self.workers[writer] = codec
+            write_message(writer, codec.dumps({"op": "presence", "message": self.bus.presence.snapshot()}))
+            while True:
+                if req is None:
+                    req = decode(await read_message(reader))
+                op = req["op"]
+                result = None
+                if op == "join":
+                    self.owners[req["user"]] = writer
+                    mine.add(req["user"])
+                    await self.bus.join(req["user"], req["ip"])
+                elif op == "leave":
+                    mine.discard(req["user"])
+                    if self.owners.get(req["user"]) is writer:
+                        del self.owners[req["user"]]
+                        await self.bus.leave(req["user"])
+                elif op == "next_seq":
+                    result = await self.bus.next_seq(req["user"])
+                elif op == "route":
+                    if not self._forward(req["to"], req["message"], True, req["seq"]):
+                        await self.bus.store(req["to"], req["message"], req["seq"])
+                elif op == "notify":
+                    self._forward(req["to"], req["message"], False)
+                elif op == "store":
+                    await self.bus.store(req["user"], req["message"], req.get("seq"))
+                elif op == "fetch":
+                    result = await self.bus.fetch_offline(req["user"], req["after"], req["limit"])
+                elif op == "ack":
+                    await self.bus.ack_offline(req["user"], req["upto"])
+                if "id" in req:
+                    write_message(writer, codec.dumps({"op": "reply", "id": req["id"], "result": result}))
+                await writer.drain()
+                req = None
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # Los usuarios de un worker caído se dan de baja
+            self.workers.pop(writer, None)
+            for user in mine:
+                if self.owners.get(user) is writer:
+                    del self.owners[user]
+                    await self.bus.leave(user)
+            writer.close()
+
+
+class BrokerBus(ChatBus):
+    def __init__(self, path: str, autostart: bool = True, broker_args: Optional[List[str]] = None,
+                 connect_timeout: float = 5.0):
+        self.path = path
+        self.autostart = autostart
+        self.broker_args = broker_args or []
+        self.connect_timeout = connect_timeout
+        self.presence = PresenceRegistry()     # Réplica de la del broker
+        self._deliver: Deliver = lambda user, message, durable: False
+        self._on_presence: OnPresence = lambda message: None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._codec: Codec = JSON
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._joined: Dict[str, str] = {}      # Usuarios de este worker (para reconectar)
+        self._read_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def start(self, deliver: Deliver, on_presence: OnPresence):
+        self._deliver = deliver
+        self._on_presence = on_presence
+        await self._connect()
+        self._read_task = asyncio.create_task(self._read_loop())
+
+    def _spawn_broker(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        subprocess.Popen([sys.executable, "-m", "src.app.bus", self.path, *self.broker_args],
+                         cwd=root, start_new_session=True)
+        print(f"[BUS] Broker lanzado en {self.path}")
+
+    async def _connect(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.connect_timeout
+        spawned = False
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() > deadline:
+                    raise ConnectionError(f"No se pudo conectar al broker en {self.path}")
+                if self.autostart and not spawned:
+                    self._spawn_broker()
+                    spawned = True
+                await asyncio.sleep(0.05)
+        # Saludo: se ofrecen los codecs de este proceso y el broker elige
+        write_message(writer, JSON.dumps({"op": "hello", "codecs": available()}))
+        try:
+            reply = decode(await asyncio.wait_for(read_message(reader), self.connect_timeout))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            writer.close()
+            raise ConnectionError(f"El broker en {self.path} no respondió al saludo: {e!r}")
+        if reply.get("op") == "hello":
+            self._codec = get_codec(reply["codec"])
+        else:
+            # Broker anterior sin saludo: habla JSON y empieza por el snapshot
+            self._codec = JSON
+            self.presence.apply(reply["message"])
+            self._on_presence(reply["message"])
+        self._reader, self._writer = reader, writer
+
+    async def _read_loop(self):
+        while not self._closing:
+            try:
+                while True:
+                    raw = await read_message(self._reader)
+                    try:
+                        self._dispatch(decode(raw))
+                    except Exception as e:
+                        # Un frame mal formado (o que falla al entregarse) se
+                        # descarta; la lectura sigue con el siguiente
+                        print(f"[BUS] Mensaje del broker descartado: {e!r}")
+            except Exception as e:
+                # Cualquier salida de la lectura (no solo un cierre limpio) reconecta
+                if self._closing:
+                    return
+                print(f"[BUS] Conexión con el broker perdida ({e!r}), reconectando")
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("Broker desconectado"))
+                self._pending.clear()
+                if self._writer is not None:
+                    self._writer.close()
+                self._writer = None
+                try:
+                    await self._connect()
+                except Exception as e:
+                    print(f"[BUS] {e}")
+                    await asyncio.sleep(1.0)
+                    continue
+                # El broker nuevo no conoce a los usuarios de este worker
+                for user, ip in self._joined.items():
+                    self._send({"op": "join", "user": user, "ip": ip})
+
+    def _dispatch(self, msg: Dict):
+        op = msg["op"]
+        if op == "reply":
+            future = self._pending.pop(msg["id"], None)
+            if future is not None and not future.done():
+                future.set_result(msg["result"])
+        elif op == "presence":
+            self.presence.apply(msg["message"])
+            self._on_presence(msg["message"])
+        elif op == "deliver":
+            if not self._deliver(msg["user"], msg["message"], msg["durable"]) and msg["durable"]:
+                # El usuario se fue de este worker: que lo guarde el broker
+                self._send({"op": "store", "user": msg["user"], "message": msg["message"],
+                            "seq": msg["seq"]})
+
+    def _send(self, message: Dict):
+        if self._writer is None:
+            raise ConnectionError("Broker desconectado")
+        write_message(self._writer, self._codec.dumps(message))
+
+    async def _request(self, message: Dict):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._send({**message, "id": request_id})
+            await self._writer.drain()
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _post(self, message: Dict):
+        self._send(message)
+        await self._writer.drain()
+
+    async def join(self, user: str, ip: str):
+        self._joined[user] = ip
+        await self._post({"op": "join", "user": user, "ip": ip})
+
+    async def leave(self, user: str):
+        self._joined.pop(user, None)
+        await self._post({"op": "leave", "user": user})
+
+    async def next_seq(self, user: str) -> int:
+        return await self._request({"op": "next_seq", "user": user})
+
+    async def route(self, to: str, message: Dict, seq: int):
+        if not self._deliver(to, message, True):
+            await self._post({"op": "route", "to": to, "message": message, "seq": seq})
+
+    async def notify(self, to: str, message: Dict):
+        if not self._deliver(to, message, False):
+            await self._post({"op": "notify", "to": to, "message": message})
+
+    async def store(self, user: str, message: Dict, seq: Optional[int] = None):
+        await self._post({"op": "store", "user": user, "message": message, "seq": seq})
+
+    async def fetch_offline(self, user: str, after: int = 0, limit: int = 100) -> List[Tuple[int, Dict]]:
+        rows = await self._request({"op": "fetch", "user": user, "after": after, "limit": limit})
+        return [(seq, message) for seq, message in rows]
+
+    async def ack_offline(self, user: str, upto: int):
+        await self._post({"op": "ack", "user": user, "upto": upto})
+
+    async def close(self):
+        self._closing = True
+        if self._read_task is not None:
+            self._read_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+def open_chat_bus(spec: str, store_spec: str, max_per_user: int = 1000, ttl: float = 7 * 24 * 3600,
+                  debounce: float = 0.05) -> ChatBus:
+    """
+    'local' para un bus en el proceso; 'unix:<ruta>' para compartir el estado
+    entre workers a través de un broker en ese socket (se lanza si no existe).
+    """
+    if spec.startswith("unix:"):
+        args = ["--store", store_spec, "--max-per-user", str(max_per_user), "--ttl", str(ttl),
+                "--debounce", str(debounce)]
+        return BrokerBus(spec[len("unix:"):], broker_args=args)
+    return LocalBus(open_message_store(store_spec, max_per_user=max_per_user, ttl=ttl), debounce)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker del chat para varios workers de frontend_api")
+    parser.add_argument("socket", help="Ruta del socket Unix")
+    parser.add_argument("--store", default="memory", help="'memory' o ruta del SQLite de mensajes")
+    parser.add_argument("--max-per-user", type=int, default=1000)
+    parser.add_argument("--ttl", type=float, default=7 * 24 * 3600)
+    parser.add_argument("--debounce", type=float, default=0.05)
+    args = parser.parse_args()
+
+    import fcntl     # Solo POSIX, como los sockets Unix
+
+    # Un solo broker por socket: si otro tiene el lock, este sobra
+    lock = open(args.socket + ".lock", "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f"[BUS] Ya hay un broker en {args.socket}")
+        return
+    store = open_message_store(args.store, max_per_user=args.max_per_user, ttl=args.ttl)
+    broker = ChatBroker(args.socket, store, args.debounce)
+    try:
+        asyncio.run(broker.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,113 +1,500 @@
-async def send_image_fragmented_semi_fiable(host, port, filepath, chunk_size=1024, enable_compression=False):
-    """Envía una imagen fragmentada en modo SEMI-FIABLE (sin ACKs ni reintentos)."""
+async def send_image_fragmented_semi_fiable(host, port, filepath, chunk_size=1024, enable_compression=False,
+                                            binary_control=False, fec=None, progress=None, admission=False):
+    """
+    Envía una imagen fragmentada en modo SEMI-FIABLE (sin ACKs ni reintentos).
+    Si se pasa un FECConfig, cada grupo de chunks va seguido de su paridad.
+    chunk_size="auto" elige el tamaño según lo medido hacia este destino.
+    progress (ProgressTracker opcional) recibe el avance de envío.
+    admission=True espera a que el servidor admita la transferencia (image_server);
+    lanza ServerBusy si está ocupado.
+    """
     import mimetypes
     filename = os.path.basename(filepath)
     mime, _ = mimetypes.guess_type(filename)
     if not (mime and mime.startswith('image/')):
         raise ValueError("Solo se permite enviar imágenes con este método")
 
+    tuner = get_tuner(host, port)
+    chunk_size = resolve_chunk_size(chunk_size, host, port)
+    start = time.perf_counter()
     reader, writer = await asyncio.open_connection(host, port)
-    with open(filepath, 'rb') as f:
-        data = f.read()
-    total_len = len(data)
-    total_chunks = (total_len + chunk_size - 1) // chunk_size
+    tuner.observe_rtt(time.perf_counter() - start)
+    total_len = os.path.getsize(filepath)
+    total_chunks = count_chunks(total_len, chunk_size)
 
     # Enviar control
     ctrl = {"type": "control", "msg": f"send image {filename}"}
-    await send_message(writer, json.dumps(ctrl).encode())
+    await send_message(writer, encode_control(ctrl, binary_control))
 
     # Enviar metadatos
-    meta = {"type": "img_meta", "name": filename, "size": total_len, "total_chunks": total_chunks}
-    await send_message(writer, json.dumps(meta).encode())
+    meta = {"type": "img_meta", "name": filename, "size": total_len, "total_chunks": total_chunks,
+            "chunk_size": chunk_size, "mode": "SEMI-FIABLE"}
+    if admission:
+        meta["admission"] = True
+    # Empaquetado (compresión + hash) y paridad FEC fuera del event loop
+    data = await asyncio.to_thread(Path(filepath).read_bytes)
+    frames = await get_pipeline().pack_async(data, chunk_size, compressed=enable_compression)
+    parity = {}
+    if fec is not None:
+        meta.update(fec.to_fields())
+        parity = await asyncio.to_thread(parity_frames, data, chunk_size, fec)
+    await send_message(writer, encode_control(meta, binary_control))
+    if admission:
+        try:
+            await _await_admission(reader)
+        except Exception:
+            writer.close()
+            raise
 
     # Enviar chunks sin ACK ni reintentos
-    for i in range(total_chunks):
-        offset = i * chunk_size
-        part = data[offset:offset + chunk_size]
-        pkt = pack_chunk(part, total_len, offset, i, total_chunks, compressed=enable_compression)
+    progress = _prepare_progress(progress, filename, total_chunks, total_len)
+    for i, pkt in enumerate(frames):
         await send_message(writer, pkt)
+        progress.update(i + 1, min((i + 1) * chunk_size, total_len))
+        for parity_pkt in parity.get(i, ()):
+            await send_message(writer, parity_pkt)
 
     writer.close()
     await writer.wait_closed()
+    tuner.observe_throughput(total_len, time.perf_counter() - start)
+    progress.finish()
+    return {"chunk_size": chunk_size, "total_chunks": total_chunks}
 import asyncio
-import json
+import mmap
 import os
 import mimetypes
-from src.transporte.reliable import send_message, read_message
-from src.transporte.fragmentation import pack_chunk
+import time
+from pathlib import Path
+from src.transporte.reliable import send_message, read_message, write_message, send_message_stream
+from src.transporte.fragmentation import count_chunks, parity_frames, get_pipeline, CHUNKING_CDC
+from src.transporte.tlv import encode_control, parse_control
+from src.transporte.chunk_tuning import get_tuner, resolve_chunk_size
+from src.transporte.progress import ProgressTracker
+from src.transporte.acks import is_batch_ack, decode_batch_ack
+from src.transporte.chunk_store import DEFAULT_BLOCK_SIZE, DIGEST_SIZE, build_manifest, delta_reader
+from src.transporte.admission import ServerBusy
+
+# Chunks sin confirmar por defecto en los envíos FIABLES con ventana
+DEFAULT_WINDOW = 32
+
+
+def _check_busy(reply: dict):
+    """
+    Un servidor sin hueco contesta "busy" al img_meta aunque no se pidiera
+    admisión; llega donde se esperaba un ACK y no tiene sentido reintentar.
+    """
+    if reply.get('type') == 'busy':
+        raise ServerBusy(float(reply.get('retry_after', 1.0)), reply.get('msg', "Servidor ocupado"))
+
+
+async def _await_admission(reader, timeout=30.0):
+    """
+    Espera la respuesta de admisión a un img_meta con "admission": "admit"
+    para empezar a enviar o "busy" (lanza ServerBusy con el retry_after del servidor).
+    """
+    reply = parse_control(await asyncio.wait_for(read_message(reader), timeout=timeout))
+    _check_busy(reply)
+    if reply.get('type') != 'admit':
+        raise Exception(f"El servidor rechazó la transferencia: {reply.get('msg', reply)}")
+
+
+def _prepare_progress(progress, name, total_chunks, total_len):
+    """Usa el ProgressTracker del llamador (ajustando totales) o crea uno propio"""
+    if progress is None:
+        return ProgressTracker(total_chunks, total_len, name=name)
+    progress.name = progress.name or name
+    progress.total_chunks = total_chunks
+    progress.total_bytes = total_len
+    return progress
 
-async def send_image_fragmented_fiable(host, port, filepath, chunk_size=1024, max_retries=5, ack_timeout=0.5):
-    """Envía una imagen fragmentada en modo FIABLE (con ACKs y reintentos por chunk)."""
+
+async def _aiter(frames):
+    """Recorre frames tanto si es una lista como un iterador asíncrono (pack_stream)"""
+    if hasattr(frames, '__aiter__'):
+        async for frame in frames:
+            yield frame
+    else:
+        for frame in frames:
+            yield frame
+
+
+async def _send_frames_fiable(reader, writer, frames, tuner, chunk_size, max_retries, ack_timeout, progress):
+    """Envía los frames uno a uno esperando el ACK de cada chunk, con reintentos"""
+    i = -1
+    async for pkt in _aiter(frames):
+        i += 1
+        retries = 0
+        while retries < max_retries:
+            sent_at = time.perf_counter()
+            await send_message(writer, pkt)
+            try:
+                ack_raw = await asyncio.wait_for(read_message(reader), timeout=ack_timeout)
+                ack = parse_control(ack_raw)
+                _check_busy(ack)
+                if ack.get('type') == 'ack' and ack.get('chunk_id') == i:
+                    # Solo se mide el RTT en el primer intento (algoritmo de Karn)
+                    if retries == 0:
+                        tuner.observe_rtt(time.perf_counter() - sent_at)
+                    tuner.observe_chunk(False, chunk_size)
+                    progress.update(i + 1, min((i + 1) * chunk_size, progress.total_bytes))
+                    break
+            except ServerBusy:
+                raise
+            except asyncio.TimeoutError:
+                retries += 1
+                tuner.observe_chunk(True, chunk_size)
+                progress.update(retransmits=1)
+                print(f"[Cliente] Timeout esperando ACK chunk {i}, reintento {retries}/{max_retries}")
+            except Exception as e:
+                retries += 1
+                progress.update(retransmits=1)
+                print(f"[Cliente] Error esperando ACK chunk {i}: {e}, reintento {retries}/{max_retries}")
+        else:
+            raise ConnectionError(f"Chunk {i} no fue ACKeado tras {max_retries} intentos")
+
+async def _read_acks(reader, queue: asyncio.Queue):
+    """Lee ACKs en su propia tarea para no cancelar lecturas a medias con timeouts"""
+    try:
+        while True:
+            await queue.put(await read_message(reader))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        await queue.put(None)
+
+
+async def _send_frames_windowed(reader, writer, frames, tuner, chunk_size, window, max_retries, ack_timeout,
+                                progress):
+    """
+    Envía hasta window chunks sin confirmar y procesa ACKs por lotes
+    (acumulativo + bitmap selectivo). Cada ráfaga se escribe con un solo
+    drain(); tras ack_timeout sin noticias se reenvían los chunks vencidos.
+    Los frames se toman de la fuente a medida que hay hueco en la ventana y
+    solo se retienen los no confirmados, así que con una fuente asíncrona
+    (pack_stream) la memoria no depende del tamaño del archivo.
+    """
+    source = _aiter(frames)
+    inflight = {}       # chunk_id -> frame pendiente de confirmar
+    sent_at = {}
+    retries = {}
+    base = next_id = confirmed = 0
+    exhausted = False
+    queue: asyncio.Queue = asyncio.Queue()
+    ack_task = asyncio.create_task(_read_acks(reader, queue))
+    try:
+        while True:
+            # Llenar la ventana
+            burst = False
+            while not exhausted and next_id < base + window:
+                try:
+                    frame = bytes(await source.__anext__())
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                inflight[next_id] = frame
+                write_message(writer, frame)
+                sent_at[next_id] = time.perf_counter()
+                next_id += 1
+                burst = True
+            if burst:
+                await writer.drain()
+            if exhausted and not inflight:
+                break
+
+            try:
+                raw = await asyncio.wait_for(queue.get(), timeout=ack_timeout)
+            except asyncio.TimeoutError:
+                raw = b''
+            if raw is None:
+                raise ConnectionError("El servidor cerró la conexión antes de confirmar todos los chunks")
+
+            now = time.perf_counter()
+            newly = []
+            if raw and is_batch_ack(raw):
+                cumulative, selective = decode_batch_ack(raw)
+                newly = [i for i in range(base, min(cumulative, next_id)) if i in inflight]
+                newly += [i for i in selective if i in inflight and i >= cumulative]
+            elif raw:
+                # Servidor sin ACKs por lotes: un ACK de control por chunk
+                try:
+                    ack = parse_control(raw)
+                except ValueError:
+                    ack = {}
+                _check_busy(ack)
+                if ack.get('type') == 'ack' and ack.get('chunk_id') in inflight:
+                    newly = [ack['chunk_id']]
+            if newly:
+                for i in newly:
+                    del inflight[i]
+                    confirmed += 1
+                    tuner.observe_chunk(False, chunk_size)
+                # RTT del chunk más reciente confirmado sin reintentos (Karn)
+                clean = [i for i in newly if not retries.get(i)]
+                if clean:
+                    tuner.observe_rtt(now - sent_at[max(clean)])
+            # Reenviar los chunks sin confirmar cuyo último envío venció
+            for i in list(inflight):
+                if now - sent_at[i] < ack_timeout:
+                    continue
+                retries[i] = retries.get(i, 0) + 1
+                tuner.observe_chunk(True, chunk_size)
+                progress.update(retransmits=1)
+                if retries[i] > max_retries:
+                    raise ConnectionError(f"Chunk {i} no fue ACKeado tras {max_retries} intentos")
+                write_message(writer, inflight[i])
+                sent_at[i] = now
+            await writer.drain()
+            # Avanzar la base y olvidar lo ya confirmado
+            while base < next_id and base not in inflight:
+                sent_at.pop(base, None)
+                retries.pop(base, None)
+                base += 1
+            progress.update(confirmed, min(confirmed * chunk_size, progress.total_bytes))
+    finally:
+        ack_task.cancel()
+
+
+def _ack_fields(window):
+    """Campos de img_meta que piden ACKs por lotes (uno cada cuarto de ventana)"""
+    return {"ack_every": max(1, window // 4)} if window > 1 else {}
+
+
+async def _send_frames(reader, writer, frames, tuner, chunk_size, window, max_retries, ack_timeout, progress):
+    if window > 1:
+        await _send_frames_windowed(reader, writer, frames, tuner, chunk_size, window, max_retries,
+                                    ack_timeout, progress)
+    else:
+        await _send_frames_fiable(reader, writer, frames, tuner, chunk_size, max_retries, ack_timeout, progress)
+
+
+async def send_image_fragmented_fiable(host, port, filepath, chunk_size=1024, max_retries=5, ack_timeout=0.5,
+                                       binary_control=False, progress=None, window=DEFAULT_WINDOW, admission=False):
+    """
+    Envía una imagen fragmentada en modo FIABLE (con ACKs y reintentos por chunk).
+    chunk_size="auto" elige el tamaño según el RTT y las pérdidas medidas hacia este destino.
+    progress (ProgressTracker opcional) recibe chunks/bytes confirmados y reintentos.
+    Con window > 1 se mantienen hasta window chunks en vuelo y el servidor
+    confirma por lotes; window=1 usa el modo clásico de un ACK por chunk.
+    admission=True espera a que el servidor admita la transferencia antes de
+    enviar chunks; lanza ServerBusy si está ocupado, y ConnectionError si
+    algún chunk no se confirma tras max_retries reintentos.
+    Retorna el tamaño de chunk usado y el número de chunks.
+    """
     filename = os.path.basename(filepath)
     mime, _ = mimetypes.guess_type(filename)
     if not (mime and mime.startswith('image/')):
         raise ValueError("Solo se permite enviar imágenes con este método")
     
+    tuner = get_tuner(host, port)
+    chunk_size = resolve_chunk_size(chunk_size, host, port, window)
     try:
+        start = time.perf_counter()
         reader, writer = await asyncio.open_connection(host, port)
+        tuner.observe_rtt(time.perf_counter() - start)
         
-        with open(filepath, 'rb') as f:
-            data = f.read()
+        total_len = os.path.getsize(filepath)
+        total_chunks = count_chunks(total_len, chunk_size)
         
-        total_len = len(data)
-        total_chunks = (total_len + chunk_size - 1) // chunk_size
-        
-        print(f"[Cliente] Conectado a {host}:{port}, enviando {filename} ({total_chunks} chunks)")
+        print(f"[Cliente] Conectado a {host}:{port}, enviando {filename} ({total_chunks} chunks de {chunk_size} bytes)")
         
         # Enviar control
         ctrl = {"type": "control", "msg": f"send image {filename}"}
-        await send_message(writer, json.dumps(ctrl).encode())
+        await send_message(writer, encode_control(ctrl, binary_control))
         
         # Enviar metadatos
-        meta = {"type": "img_meta", "name": filename, "size": total_len, "total_chunks": total_chunks}
-        await send_message(writer, json.dumps(meta).encode())
-
-        # Enviar chunks con ACK
-        for i in range(total_chunks):
-            offset = i * chunk_size
-            part = data[offset:offset + chunk_size]
-            pkt = pack_chunk(part, total_len, offset, i, total_chunks, compressed=False)
-            
-            retries = 0
-            while retries < max_retries:
-                await send_message(writer, pkt)
-                try:
-                    ack_raw = await asyncio.wait_for(read_message(reader), timeout=ack_timeout)
-                    ack = json.loads(ack_raw)
-                    if ack.get('type') == 'ack' and ack.get('chunk_id') == i:
-                        break
-                except asyncio.TimeoutError:
-                    retries += 1
-                    print(f"[Cliente] Timeout esperando ACK chunk {i}, reintento {retries}/{max_retries}")
-                except Exception as e:
-                    retries += 1
-                    print(f"[Cliente] Error esperando ACK chunk {i}: {e}, reintento {retries}/{max_retries}")
-            else:
-                print(f"[Cliente] ADVERTENCIA: Chunk {i} no fue ACKeado tras {max_retries} intentos")
+        meta = {"type": "img_meta", "name": filename, "size": total_len, "total_chunks": total_chunks,
+                "mode": "FIABLE", **_ack_fields(window)}
+        if admission:
+            meta["admission"] = True
+        await send_message(writer, encode_control(meta, binary_control))
+        if admission:
+            await _await_admission(reader)
+
+        # Enviar chunks con ACK (empaquetados en el pool de workers)
+        frames = await get_pipeline().pack_async(filepath, chunk_size, compressed=False)
+        progress = _prepare_progress(progress, filename, total_chunks, total_len)
+        await _send_frames(reader, writer, frames, tuner, chunk_size, window, max_retries, ack_timeout, progress)
+        progress.finish()
         
         print(f"[Cliente] Imagen {filename} enviada completamente")
         writer.close()
         await writer.wait_closed()
+        tuner.observe_throughput(total_len, time.perf_counter() - start)
+        return {"chunk_size": chunk_size, "total_chunks": total_chunks}
         
     except ConnectionRefusedError:
         raise Exception(f"No se pudo conectar al servidor en {host}:{port}. ¿Está corriendo el servidor de imágenes?")
+    except ServerBusy as e:
+        print(f"[Cliente] {e}")
+        writer.close()
+        raise
     except Exception as e:
         print(f"[Cliente] Error enviando imagen: {e}")
         raise
 
+async def send_image_dedup(host, port, filepath, chunk_size=1024, block_size=DEFAULT_BLOCK_SIZE,
+                           max_retries=5, ack_timeout=0.5, binary_control=False, chunking=CHUNKING_CDC,
+                           progress=None, window=DEFAULT_WINDOW, admission=False, name=None):
+    """
+    Envía una imagen en modo FIABLE enviando solo lo que el servidor no tiene.
+    Primero se manda el manifiesto (hashes de bloques de block_size, por defecto
+    con fronteras definidas por contenido para que una edición no desplace el
+    resto de bloques); el servidor
+    responde con los hashes que le faltan y solo esos bloques se transfieren,
+    concatenados, como una imagen fragmentada normal.
+    progress (ProgressTracker opcional) sigue el envío de los bloques que faltan.
+    admission=True espera a que el servidor admita el envío de esos bloques
+    (lanza ServerBusy si está ocupado). name es el nombre anunciado al
+    servidor (por defecto el del archivo).
+    Retorna el tamaño de chunk usado y los bytes realmente enviados.
+    """
+    filename = name or os.path.basename(filepath)
+    mime, _ = mimetypes.guess_type(filename)
+    if not (mime and mime.startswith('image/')):
+        raise ValueError("Solo se permite enviar imágenes con este método")
+
+    tuner = get_tuner(host, port)
+    chunk_size = resolve_chunk_size(chunk_size, host, port, window)
+    # Mapeado en memoria: los datos viven en la caché de páginas, no en el heap
+    data = await asyncio.to_thread(_map_file, filepath)
+    manifest = await asyncio.to_thread(build_manifest, data, block_size, chunking)
+
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    tuner.observe_rtt(time.perf_counter() - start)
+    try:
+        ctrl = {"type": "control", "msg": f"send image {filename}"}
+        await send_message(writer, encode_control(ctrl, binary_control))
+        await send_message(writer, encode_control(
+            {"type": "img_manifest", "name": filename, **manifest.to_fields()}, binary_control))
+
+        reply = parse_control(await asyncio.wait_for(read_message(reader), timeout=max(ack_timeout, 5.0)))
+        if reply.get('type') != 'manifest_ack':
+            raise Exception(f"El servidor rechazó el manifiesto: {reply.get('msg', reply)}")
+        raw = bytes.fromhex(reply.get('missing', ''))
+        missing = [raw[i:i + DIGEST_SIZE] for i in range(0, len(raw), DIGEST_SIZE)]
+
+        sent = 0
+        total_chunks = 0
+        if missing:
+            lengths = dict(manifest.blocks)
+            delta_len = sum(lengths[d] for d in missing)
+            total_chunks = count_chunks(delta_len, chunk_size)
+            meta = {"type": "img_meta", "name": filename, "size": delta_len, "total_chunks": total_chunks,
+                    "delta": manifest.file_hash, "mode": "FIABLE", **_ack_fields(window)}
+            if admission:
+                meta["admission"] = True
+            await send_message(writer, encode_control(meta, binary_control))
+            if admission:
+                await _await_admission(reader)
+            # Los bloques que faltan se empaquetan según se envían
+            frames = get_pipeline().pack_stream(delta_reader(data, manifest, missing), delta_len, chunk_size)
+            progress = _prepare_progress(progress, filename, total_chunks, delta_len)
+            await _send_frames(reader, writer, frames, tuner, chunk_size, window, max_retries, ack_timeout,
+                               progress)
+            sent = delta_len
+            tuner.observe_throughput(sent, time.perf_counter() - start)
+
+        if progress is not None:
+            if not missing:
+                # Nada que enviar: el archivo ya estaba en el servidor
+                _prepare_progress(progress, filename, 0, 0)
+            progress.finish()
+        print(f"[Cliente] Imagen {filename}: enviados {sent}/{manifest.size} bytes "
+              f"({len(missing)}/{len(manifest.blocks)} bloques nuevos)")
+        return {"chunk_size": chunk_size, "total_chunks": total_chunks, "bytes_sent": sent,
+                "bytes_deduplicated": manifest.size - sent}
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+def _map_file(filepath):
+    """Mapea un archivo en solo lectura (b'' si está vacío, que mmap no admite)"""
+    with open(filepath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+async def send_image_stream(host, port, read, name, size, mode="FIABLE", chunk_size=1024, max_retries=5,
+                            ack_timeout=0.5, enable_compression=False, binary_control=False, progress=None,
+                            window=DEFAULT_WINDOW, admission=False):
+    """
+    Envía una imagen leída de una fuente asíncrona (await read(n), p. ej.
+    UploadFile.read) sin cargarla entera: los chunks se empaquetan por lotes a
+    medida que se leen. size es el tamaño total, que va en img_meta.
+    mode "FIABLE" usa la ventana con ACKs; "SEMI-FIABLE" envía sin ACKs y sin
+    FEC (la paridad necesita el archivo completo).
+    """
+    tuner = get_tuner(host, port)
+    chunk_size = resolve_chunk_size(chunk_size, host, port, window if mode == "FIABLE" else 1)
+    total_chunks = count_chunks(size, chunk_size)
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    tuner.observe_rtt(time.perf_counter() - start)
+    try:
+        print(f"[Cliente] Conectado a {host}:{port}, enviando {name} en streaming "
+              f"({total_chunks} chunks de {chunk_size} bytes)")
+        ctrl = {"type": "control", "msg": f"send image {name}"}
+        await send_message(writer, encode_control(ctrl, binary_control))
+
+        meta = {"type": "img_meta", "name": name, "size": size, "total_chunks": total_chunks,
+                "chunk_size": chunk_size, "mode": mode}
+        if mode == "FIABLE":
+            meta.update(_ack_fields(window))
+        if admission:
+            meta["admission"] = True
+        await send_message(writer, encode_control(meta, binary_control))
+        if admission:
+            await _await_admission(reader)
+
+        compressed = enable_compression and mode != "FIABLE"
+        frames = get_pipeline().pack_stream(read, size, chunk_size, compressed=compressed)
+        progress = _prepare_progress(progress, name, total_chunks, size)
+        if mode == "FIABLE":
+            await _send_frames(reader, writer, frames, tuner, chunk_size, window, max_retries, ack_timeout,
+                               progress)
+        else:
+            i = 0
+            async for pkt in frames:
+                await send_message(writer, pkt)
+                i += 1
+                progress.update(i, min(i * chunk_size, size))
+        progress.finish()
+        tuner.observe_throughput(size, time.perf_counter() - start)
+        print(f"[Cliente] Imagen {name} enviada completamente")
+        return {"chunk_size": chunk_size, "total_chunks": total_chunks}
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def send_file_stream(host, port, read, name, size):
+    """Como send_file, leyendo el contenido por bloques con await read(n)"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        ctrl = {"type": "control", "msg": f"Inicio de envío: {name}"}
+        await send_message(writer, encode_control(ctrl))
+        meta = {"type": "file", "name": name, "size": size}
+        await send_message(writer, encode_control(meta))
+        await send_message_stream(writer, read, size)
+        print(f"[App] Archivo {name} enviado ({size} bytes).")
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
 async def send_file(host, port, filepath):
     reader, writer = await asyncio.open_connection(host, port)
     filename = os.path.basename(filepath)
 
     # 1. Enviar mensaje de control
     ctrl = {"type": "control", "msg": f"Inicio de envío: {filename}"}
-    await send_message(writer, json.dumps(ctrl).encode())
+    await send_message(writer, encode_control(ctrl))
 
     # 2. Enviar archivo en un solo bloque (avance 1 = simple)
     with open(filepath, "rb") as f:
         data = f.read()
     meta = {"type": "file", "name": filename, "size": len(data)}
-    await send_message(writer, json.dumps(meta).encode())
+    await send_message(writer, encode_control(meta))
     await send_message(writer, data)
 
     print(f"[App] Archivo {filename} enviado ({len(data)} bytes).")
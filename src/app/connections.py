@@ -0,0 +1,189 @@
+import asyncio
+from collections import deque
+from typing import Callable, Dict, Optional, Union
+
+from src.transporte.codec import JSON
+
+# Envío a WebSockets sin que un cliente lento frene a los demás.
+#
+# Cada conexión tiene su propia cola de salida y una tarea escritora, así que
+# enviar a un usuario es solo encolar (no se espera a su socket) y un fan-out
+# a N usuarios son N encolados; los envíos reales ocurren en paralelo en las
+# tareas escritoras. La cola está acotada. Con la cola llena, los mensajes
+# descartables (deltas de presencia, progreso: el siguiente los reemplaza o el
+# cliente los recupera con presence_sync) se tiran; cualquier otro mensaje
+# desconecta al cliente lento (overflow="close" desconecta siempre) y sus
+# mensajes pendientes "duraderos" se devuelven al hub para guardarlos como no
+# entregados. Un broadcast (p. ej. un delta de presencia) se serializa una
+# sola vez y el mismo texto se comparte entre las colas.
+
+
+class Connection:
+    def __init__(self, hub: "ConnectionHub", username: str, websocket, max_queue: int = 256):
+        self.hub = hub
+        self.username = username
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.closed = False
+        self._overflowed = False
+        self._queue: deque = deque()            # (texto o bytes, mensaje duradero o None)
+        self._wake = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def send_text(self, text: Union[str, bytes], durable: Optional[dict] = None,
+                  droppable: bool = False) -> bool:
+        """
+        Encola un texto ya serializado. durable es el mensaje original si debe
+        guardarse como no entregado cuando la conexión se pierde antes de
+        enviarlo; droppable indica que puede descartarse si la cola está llena.
+        Retorna False si la conexión está cerrada.
+        """
+        if self.closed:
+            return False
+        if len(self._queue) >= self.max_queue:
+            if droppable and self.hub.overflow == "drop":
+                self.hub.dropped += 1
+                return True
+            if durable is not None:
+                self._queue.append((text, durable))
+            if not self._overflowed:
+                print(f"[WebSocket] Cola de salida llena para {self.username}, desconectando")
+                self._overflowed = True
+                self.hub.overflow_closes += 1
+                self.hub._close_later(self, code=1013)
+            return durable is not None
+        self._queue.append((text, durable))
+        self._drained.clear()
+        self._wake.set()
+        return True
+
+    def send_json(self, payload: dict, durable: bool = False, droppable: bool = False) -> bool:
+        return self.send_text(JSON.dumps_text(payload), payload if durable else None, droppable)
+
+    def send_bytes(self, data: bytes) -> bool:
+        """Encola un frame binario (mismas reglas de cola que send_text)"""
+        return self.send_text(data)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._wake.wait()
+                self._wake.clear()
+                while self._queue:
+                    data, _ = self._queue[0]
+                    if isinstance(data, str):
+                        await self.websocket.send_text(data)
+                    else:
+                        await self.websocket.send_bytes(data)
+                    self._queue.popleft()
+                self._drained.set()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[WebSocket] Error enviando a {self.username}: {e}")
+            await self.close(code=1011)
+
+    async def drained(self):
+        """Espera a que la cola de salida se vacíe (o a que se cierre la conexión)"""
+        await self._drained.wait()
+
+    async def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        self._drained.set()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        pending = [durable for _, durable in self._queue if durable is not None]
+        self._queue.clear()
+        self.hub._detach(self, pending)
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
+class ConnectionHub:
+    def __init__(self, max_queue: int = 256, on_undelivered: Optional[Callable[[str, dict], None]] = None,
+                 overflow: str = "drop"):
+        """
+        on_undelivered(usuario, mensaje) recibe los mensajes duraderos que no
+        llegaron a enviarse. overflow es la política con la cola llena: "drop"
+        descarta los mensajes descartables, "close" desconecta siempre.
+        """
+        if overflow not in ("drop", "close"):
+            raise ValueError(f"Política de desborde desconocida: {overflow}")
+        self.max_queue = max_queue
+        self.on_undelivered = on_undelivered
+        self.overflow = overflow
+        self.connections: Dict[str, Connection] = {}
+        self.dropped = 0            # Mensajes descartables tirados por cola llena
+        self.overflow_closes = 0    # Conexiones cerradas por cola llena
+        self._closing: set = set()  # Cierres en curso lanzados desde código síncrono
+
+    def add(self, username: str, websocket) -> Connection:
+        old = self.connections.get(username)
+        conn = Connection(self, username, websocket, self.max_queue)
+        self.connections[username] = conn
+        if old is not None:
+            # Una sesión nueva del mismo usuario reemplaza a la anterior
+            self._close_later(old, code=1000)
+        return conn
+
+    def _close_later(self, conn: Connection, code: int):
+        """Cierra conn en segundo plano, reteniendo la tarea hasta que termine"""
+        task = asyncio.create_task(conn.close(code=code))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def _detach(self, conn: Connection, pending):
+        current = self.connections.get(conn.username)
+        if current is conn:
+            del self.connections[conn.username]
+            current = None
+        for msg in pending:
+            # Si el usuario ya tiene otra sesión, lo pendiente pasa a ella
+            if current is not None and current.send_json(msg, durable=True):
+                continue
+            if self.on_undelivered is not None:
+                self.on_undelivered(conn.username, msg)
+
+    def get(self, username: str) -> Optional[Connection]:
+        return self.connections.get(username)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.connections
+
+    def users(self):
+        return list(self.connections.keys())
+
+    def send(self, username: str, payload: dict, durable: bool = False, droppable: bool = False) -> bool:
+        """Encola payload para username; False si no está conectado"""
+        conn = self.connections.get(username)
+        return conn is not None and conn.send_json(payload, durable, droppable)
+
+    def broadcast(self, payload: dict):
+        """
+        Serializa una vez y encola el mismo texto en todas las conexiones. Es
+        descartable: un cliente con la cola llena se lo pierde y lo recupera
+        pidiendo presence_sync al ver el salto de versión.
+        """
+        text = JSON.dumps_text(payload)
+        for conn in list(self.connections.values()):
+            conn.send_text(text, droppable=True)
+
+    def get_stats(self) -> Dict:
+        return {
+            "connections": len(self.connections),
+            "queued": sum(len(conn._queue) for conn in self.connections.values()),
+            "dropped": self.dropped,
+            "overflow_closes": self.overflow_closes,
+        }
+
+    async def close_all(self):
+        for conn in list(self.connections.values()):
+            await conn.close(code=1001)
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
@@ -0,0 +1,182 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from src.transporte.progress import ProgressTracker
+
+# Trabajos de transferencia en segundo plano.
+#
+# La API registra cada envío como un Job y responde enseguida con su id; el
+# envío corre en una tarea asyncio limitada por un semáforo (max_concurrent
+# trabajos a la vez, el resto espera en estado "queued"). El estado, el
+# progreso y el resultado se consultan por id y los cambios de estado se
+# notifican a los listeners (p. ej. para empujarlos por WebSocket).
+# Cancelar un trabajo cancela su tarea, lo que cierra la conexión de transporte,
+# y las tareas auxiliares que se le asociaron con attach() (miniaturas, envío
+# de progreso...). shutdown() hace lo mismo con todos al parar el servidor.
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    owner: Optional[str]
+    progress: ProgressTracker
+    info: Dict = field(default_factory=dict)      # Datos conocidos al crear el trabajo
+    state: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[Dict] = None
+    error: Optional[str] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+    side_tasks: Set[asyncio.Task] = field(default_factory=set, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    def to_dict(self) -> Dict:
+        event = self.progress.last_event or self.progress.snapshot()
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "owner": self.owner,
+            "state": self.state,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": event.to_dict(),
+            "info": self.info,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    def __init__(self, max_concurrent: int = 4, max_finished: int = 500):
+        self.max_concurrent = max_concurrent
+        self.max_finished = max_finished       # Trabajos terminados que se recuerdan
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._listeners: List[Callable[[Job], None]] = []
+
+    def submit(self, run: Callable[[Job], Awaitable[Dict]], kind: str = "transfer",
+               owner: Optional[str] = None, progress: Optional[ProgressTracker] = None,
+               info: Optional[Dict] = None,
+               on_finish: Optional[Callable[[Job], Awaitable[None]]] = None) -> Job:
+        """
+        Registra un trabajo y lo lanza en segundo plano. run(job) hace el
+        trabajo y retorna el resultado; on_finish(job) se ejecuta siempre al
+        final (p. ej. para limpiar archivos), también si se canceló.
+        """
+        job_id = uuid.uuid4().hex
+        progress = progress or ProgressTracker(0, 0)
+        progress.transfer_id = job_id
+        job = Job(job_id, kind, owner, progress, dict(info or {}))
+        self.jobs[job_id] = job
+        job.task = asyncio.create_task(self._run(job, run, on_finish))
+        self._notify(job)
+        return job
+
+    def attach(self, job: Job, coro: Awaitable, what: str = "tarea") -> asyncio.Task:
+        """Lanza coro como tarea auxiliar de job: se cancela con el trabajo y al parar"""
+        task = asyncio.ensure_future(coro)
+        job.side_tasks.add(task)
+
+        def done(t):
+            job.side_tasks.discard(t)
+            if not t.cancelled() and t.exception() is not None:
+                print(f"[JOBS] Error en {what} de {job.id}: {t.exception()!r}")
+        task.add_done_callback(done)
+        return task
+
+    async def _run(self, job: Job, run, on_finish):
+        try:
+            async with self._semaphore:
+                job.state = RUNNING
+                job.started_at = time.time()
+                self._notify(job)
+                job.result = await run(job)
+                job.state = DONE
+        except asyncio.CancelledError:
+            job.state = CANCELLED
+        except Exception as e:
+            job.state = FAILED
+            job.error = str(e)
+            print(f"[JOBS] Trabajo {job.id} falló: {e}")
+        finally:
+            job.finished_at = time.time()
+            job.progress.finish()
+            if on_finish is not None:
+                try:
+                    await on_finish(job)
+                except Exception as e:
+                    print(f"[JOBS] Error finalizando {job.id}: {e}")
+            self._notify(job)
+            self._prune()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def list(self, owner: Optional[str] = None) -> List[Job]:
+        return [j for j in self.jobs.values() if owner is None or j.owner == owner]
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancela un trabajo en cola o en curso; False si no existe o ya terminó"""
+        job = self.jobs.get(job_id)
+        if job is None or job.finished or job.task is None:
+            return False
+        job.task.cancel()
+        for task in list(job.side_tasks):
+            task.cancel()
+        return True
+
+    async def shutdown(self):
+        """Cancela los trabajos pendientes y todas las tareas auxiliares, y espera a que terminen"""
+        tasks = []
+        for job in self.jobs.values():
+            if job.task is not None and not job.task.done():
+                tasks.append(job.task)
+            tasks.extend(job.side_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def wait(self, job_id: str) -> Job:
+        job = self.jobs[job_id]
+        if job.task is not None:
+            await asyncio.gather(job.task, return_exceptions=True)
+        return job
+
+    def add_listener(self, callback: Callable[[Job], None]):
+        """callback(job) en cada cambio de estado"""
+        self._listeners.append(callback)
+
+    def _notify(self, job: Job):
+        for listener in list(self._listeners):
+            try:
+                listener(job)
+            except Exception as e:
+                print(f"[JOBS] Error en listener: {e}")
+
+    def _prune(self):
+        finished = [j.id for j in self.jobs.values() if j.finished]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def get_stats(self) -> Dict:
+        counts: Dict[str, int] = {}
+        for job in self.jobs.values():
+            counts[job.state] = counts.get(job.state, 0) + 1
+        return {"max_concurrent": self.max_concurrent, **counts}
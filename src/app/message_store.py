@@ -0,0 +1,221 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from src.transporte.codec import JSON
+
+# Almacén de mensajes de chat no entregados.
+#
+# Los mensajes para usuarios desconectados se guardan por destinatario con un
+# número de secuencia propio de ese destinatario (persistente, no depende de
+# cuántos mensajes haya pendientes). Cada usuario tiene un máximo de mensajes
+# (se descartan los más viejos) y los mensajes caducan tras ttl segundos, así
+# que el almacén no crece sin límite con usuarios que no vuelven. Al
+# reconectar, los mensajes se leen por páginas en orden de secuencia y se
+# borran cuando ya se enviaron.
+#
+# SQLiteMessageStore (por defecto) sobrevive a reinicios: usa WAL y agrupa las
+# escrituras de batch_interval segundos en una sola transacción.
+# MemoryMessageStore tiene la misma interfaz y sirve para pruebas o para no
+# persistir nada.
+
+
+class MessageStore:
+    """Interfaz común de los almacenes de mensajes"""
+
+    async def next_seq(self, user: str) -> int:
+        raise NotImplementedError
+
+    async def append(self, user: str, message: Dict, seq: Optional[int] = None) -> int:
+        """Guarda message para user; sin seq se le asigna la siguiente. Retorna la secuencia"""
+        raise NotImplementedError
+
+    async def fetch(self, user: str, after: int = 0, limit: int = 100) -> List[Tuple[int, Dict]]:
+        """Hasta limit mensajes de user con secuencia mayor que after, en orden"""
+        raise NotImplementedError
+
+    async def delete(self, user: str, upto: int):
+        """Borra los mensajes de user con secuencia hasta upto (ya entregados)"""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def get_stats(self) -> Dict:
+        return {}
+
+
+class MemoryMessageStore(MessageStore):
+    def __init__(self, max_per_user: int = 1000, ttl: float = 7 * 24 * 3600):
+        self.max_per_user = max_per_user
+        self.ttl = ttl
+        self._messages: Dict[str, deque] = {}      # usuario -> deque[(seq, creado, mensaje)]
+        self._seqs: Dict[str, int] = {}
+        self.dropped = 0
+
+    async def next_seq(self, user: str) -> int:
+        self._seqs[user] = self._seqs.get(user, 0) + 1
+        return self._seqs[user]
+
+    async def append(self, user: str, message: Dict, seq: Optional[int] = None) -> int:
+        if seq is None:
+            seq = await self.next_seq(user)
+        queue = self._messages.setdefault(user, deque(maxlen=self.max_per_user))
+        if len(queue) == queue.maxlen:
+            self.dropped += 1
+        queue.append((seq, time.time(), message))
+        return seq
+
+    async def fetch(self, user: str, after: int = 0, limit: int = 100) -> List[Tuple[int, Dict]]:
+        queue = self._messages.get(user)
+        if not queue:
+            return []
+        cutoff = time.time() - self.ttl
+        while queue and queue[0][1] < cutoff:
+            queue.popleft()
+        page = sorted((seq, msg) for seq, _, msg in queue if seq > after)
+        return page[:limit]
+
+    async def delete(self, user: str, upto: int):
+        queue = self._messages.get(user)
+        if queue is None:
+            return
+        kept = [item for item in queue if item[0] > upto]
+        if kept:
+            self._messages[user] = deque(kept, maxlen=self.max_per_user)
+        else:
+            del self._messages[user]
+
+    def get_stats(self) -> Dict:
+        return {"backend": "memory", "users": len(self._messages),
+                "messages": sum(len(q) for q in self._messages.values()), "dropped": self.dropped}
+
+
+class SQLiteMessageStore(MessageStore):
+    def __init__(self, path: str, max_per_user: int = 1000, ttl: float = 7 * 24 * 3600,
+                 batch_size: int = 256, batch_interval: float = 0.05, expire_interval: float = 60.0):
+        self.path = path
+        self.max_per_user = max_per_user
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.expire_interval = expire_interval
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        # Se usa desde hilos (asyncio.to_thread); el lock serializa el acceso
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            CREATE TABLE IF NOT EXISTS messages (
+                user TEXT NOT NULL, seq INTEGER NOT NULL, created REAL NOT NULL, payload TEXT NOT NULL,
+                PRIMARY KEY (user, seq)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS messages_created ON messages (created);
+            CREATE TABLE IF NOT EXISTS sequences (user TEXT PRIMARY KEY, last_seq INTEGER NOT NULL);
+        """)
+        self._pending: List[Tuple[str, int, float, str]] = []   # Escrituras sin confirmar
+        self._seqs: Dict[str, int] = {}      # Secuencias asignadas aún no guardadas
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_expire = 0.0
+        self.dropped = 0
+        self.expired = 0
+
+    async def next_seq(self, user: str) -> int:
+        return await asyncio.to_thread(self._next_seq, user)
+
+    def _next_seq(self, user: str) -> int:
+        with self._lock:
+            seq = self._seqs.get(user)
+            if seq is None:
+                row = self._db.execute("SELECT last_seq FROM sequences WHERE user = ?", (user,)).fetchone()
+                seq = row[0] if row else 0
+            self._seqs[user] = seq + 1
+            return seq + 1
+
+    async def append(self, user: str, message: Dict, seq: Optional[int] = None) -> int:
+        if seq is None:
+            seq = await self.next_seq(user)
+        payload = JSON.dumps_text(message)
+        with self._lock:
+            self._pending.append((user, seq, time.time(), payload))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            await asyncio.to_thread(self._flush)
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return seq
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.batch_interval)
+        await asyncio.to_thread(self._flush)
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            seqs, self._seqs = self._seqs, {}
+            now = time.time()
+            with self._db:
+                if pending:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO messages (user, seq, created, payload) VALUES (?, ?, ?, ?)", pending)
+                if seqs:
+                    self._db.executemany(
+                        "INSERT INTO sequences (user, last_seq) VALUES (?, ?) "
+                        "ON CONFLICT (user) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq)",
+                        seqs.items())
+                # Límite por usuario: quedan los max_per_user más recientes
+                for user in {item[0] for item in pending}:
+                    cur = self._db.execute(
+                        "DELETE FROM messages WHERE user = ? AND seq <= ("
+                        " SELECT seq FROM messages WHERE user = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                        (user, user, self.max_per_user))
+                    self.dropped += cur.rowcount
+                if now - self._last_expire >= self.expire_interval:
+                    self._last_expire = now
+                    cur = self._db.execute("DELETE FROM messages WHERE created < ?", (now - self.ttl,))
+                    self.expired += cur.rowcount
+
+    async def fetch(self, user: str, after: int = 0, limit: int = 100) -> List[Tuple[int, Dict]]:
+        return await asyncio.to_thread(self._fetch, user, after, limit)
+
+    def _fetch(self, user: str, after: int, limit: int) -> List[Tuple[int, Dict]]:
+        # Lo pendiente de escribir también tiene que verse
+        self._flush()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, payload FROM messages WHERE user = ? AND seq > ? AND created >= ? "
+                "ORDER BY seq LIMIT ?", (user, after, time.time() - self.ttl, limit)).fetchall()
+        return [(seq, JSON.loads(payload)) for seq, payload in rows]
+
+    async def delete(self, user: str, upto: int):
+        await asyncio.to_thread(self._delete, user, upto)
+
+    def _delete(self, user: str, upto: int):
+        self._flush()
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM messages WHERE user = ? AND seq <= ?", (user, upto))
+
+    async def close(self):
+        await asyncio.to_thread(self._flush)
+        with self._lock:
+            self._db.close()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            users, messages = self._db.execute(
+                "SELECT COUNT(DISTINCT user), COUNT(*) FROM messages").fetchone()
+            pending = len(self._pending)
+        return {"backend": "sqlite", "users": users, "messages": messages, "pending_writes": pending,
+                "dropped": self.dropped, "expired": self.expired}
+
+
+def open_message_store(spec: str, **kwargs) -> MessageStore:
+    """'memory' para un almacén en memoria; cualquier otro valor es la ruta del SQLite"""
+    if spec == "memory":
+        return MemoryMessageStore(**{k: v for k, v in kwargs.items() if k in ("max_per_user", "ttl")})
+    return SQLiteMessageStore(spec, **kwargs)
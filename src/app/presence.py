@@ -0,0 +1,94 @@
+from collections import deque
+from typing import Dict, List, Optional
+
+# Presencia versionada: usuarios conectados y sus IPs.
+#
+# Cada alta o baja incrementa la versión y queda en un historial acotado. Los
+# clientes reciben un snapshot completo una vez (al registrarse) y después
+# solo deltas {from_version, version, changes}; cada cambio lleva su versión y
+# se aplica si es mayor que la que tiene el cliente, así que aplicar un delta
+# que se solapa con el snapshot no tiene efecto. Si un cliente ve un salto
+# (from_version mayor que su versión) pide presence_sync con su versión y
+# recibe los cambios que le faltan o, si ya no están en el historial, un
+# snapshot nuevo.
+#
+# Los cambios de un mismo usuario dentro de un delta se agrupan: solo cuenta
+# el último (un alta seguida de baja es una baja).
+
+
+class PresenceRegistry:
+    def __init__(self, history: int = 1024):
+        self.version = 0
+        self.members: Dict[str, str] = {}       # usuario -> IP
+        self._history: deque = deque(maxlen=history)   # (versión, op, usuario, ip)
+        self._flushed = 0                       # Versión del último delta difundido
+
+    def join(self, user: str, ip: str):
+        self.version += 1
+        self.members[user] = ip
+        self._history.append((self.version, "join", user, ip))
+
+    def leave(self, user: str):
+        if user not in self.members:
+            return
+        self.version += 1
+        del self.members[user]
+        self._history.append((self.version, "leave", user, None))
+
+    def snapshot(self) -> Dict:
+        return {"type": "presence_snapshot", "version": self.version,
+                "users": list(self.members), "userIPs": dict(self.members)}
+
+    def changes_since(self, version: int) -> Optional[List[Dict]]:
+        """Cambios posteriores a version (uno por usuario) o None si el historial no alcanza"""
+        if version > self.version:
+            return None
+        oldest = self._history[0][0] if self._history else self.version + 1
+        if version < oldest - 1:
+            return None
+        latest: Dict[str, Dict] = {}
+        for v, op, user, ip in self._history:
+            if v > version:
+                change = {"op": op, "user": user, "v": v}
+                if ip is not None:
+                    change["ip"] = ip
+                latest.pop(user, None)
+                latest[user] = change
+        return list(latest.values())
+
+    def sync(self, version: Optional[int]) -> Dict:
+        """Respuesta a un cliente con version: delta si es posible, si no snapshot"""
+        changes = self.changes_since(version) if version is not None else None
+        if changes is None:
+            return self.snapshot()
+        return {"type": "presence_delta", "from_version": version, "version": self.version, "changes": changes}
+
+    def apply(self, message: Dict):
+        """
+        Aplica un snapshot o delta de otro registro (réplica en un worker que
+        recibe la presencia del broker). members se actualiza en el sitio.
+        """
+        if message["type"] == "presence_snapshot":
+            self.members.clear()
+            self.members.update(message["userIPs"])
+            self._history.clear()
+            self.version = message["version"]
+        else:
+            for change in message["changes"]:
+                if change["v"] <= self.version:
+                    continue
+                if change["op"] == "join":
+                    self.members[change["user"]] = change["ip"]
+                else:
+                    self.members.pop(change["user"], None)
+                self._history.append((change["v"], change["op"], change["user"], change.get("ip")))
+            self.version = max(self.version, message["version"])
+        self._flushed = self.version
+
+    def flush(self) -> Optional[Dict]:
+        """Delta con los cambios desde el último flush (None si no hubo cambios)"""
+        if self.version == self._flushed:
+            return None
+        message = self.sync(self._flushed)
+        self._flushed = self.version
+        return message
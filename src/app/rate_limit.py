@@ -0,0 +1,145 @@
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+# Límites de entrada por usuario en el WebSocket del chat.
+#
+# Cada usuario tiene un token bucket por tipo de mensaje (message, list,
+# file_offer...) con rate tokens por segundo y ráfagas de hasta burst; los
+# tipos sin límite propio (incluidos los desconocidos) comparten el bucket
+# "*". Un mensaje que no encuentra token se descarta sin procesarlo (no
+# llega al bus ni a otros usuarios) y al cliente se le avisa con rate_limited
+# una vez por ráfaga, no por cada mensaje descartado. Las métricas cuentan
+# los descartes por bucket, no por el tipo que envió el cliente (que podría
+# inventar tipos sin fin). Si un cliente sigue enviando sin respetar el límite
+# (close_after descartes seguidos) se cierra su conexión.
+#
+# Los frames binarios del relay de archivos no pasan por aquí: su ritmo ya lo
+# marcan los créditos que concede el servidor (ver src/app/relay.py).
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """
+    "message=5/20,file_offer=1/5,*=30/60" -> {tipo: (rate, burst)}. "*" es el
+    límite de los tipos no listados; un burst omitido vale lo mismo que rate.
+    """
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        kind, _, value = item.partition('=')
+        rate, _, burst = value.partition('/')
+        try:
+            limits[kind.strip()] = (float(rate), float(burst or rate))
+        except ValueError:
+            raise ValueError(f"Límite inválido: {item!r} (se espera tipo=rate/burst)")
+    return limits
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, n: float = 1.0, now: Optional[float] = None) -> float:
+        """Toma n tokens; retorna 0 si había, si no los segundos hasta que los haya"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class _UserLimits:
+    def __init__(self):
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.strikes = 0                # Descartes seguidos desde el último mensaje aceptado
+        self.notified_until = 0.0       # No repetir el aviso rate_limited antes de esto
+
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Tuple[float, float]], close_after: int = 200):
+        self.limits = limits
+        self.close_after = close_after
+        self.users: Dict[str, _UserLimits] = {}
+        self._gone: set = set()                 # Usuarios desconectados con estado pendiente
+        self.allowed = 0
+        self.throttled: Counter = Counter()     # bucket (tipo configurado o "*") -> mensajes descartados
+        self.closed = 0
+
+    def _bucket(self, state: _UserLimits, kind: str, now: float) -> Optional[TokenBucket]:
+        bucket = state.buckets.get(kind)
+        if bucket is None and kind in self.limits:
+            rate, burst = self.limits[kind]
+            bucket = state.buckets[kind] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def check(self, username: str, kind: str, now: Optional[float] = None) -> float:
+        """
+        Retorna 0 si el mensaje de username de tipo kind puede procesarse; si
+        no, los segundos hasta que haya token (el mensaje debe descartarse).
+        """
+        now = time.monotonic() if now is None else now
+        state = self.users.get(username)
+        if state is None:
+            state = self.users[username] = _UserLimits()
+        self._gone.discard(username)
+        key = kind if kind in self.limits else '*'
+        bucket = self._bucket(state, key, now)
+        wait = bucket.consume(1, now) if bucket is not None else 0.0
+        if wait:
+            state.strikes += 1
+            self.throttled[key] += 1
+        else:
+            state.strikes = 0
+            self.allowed += 1
+        return wait
+
+    def should_notify(self, username: str, retry_after: float, now: Optional[float] = None) -> bool:
+        """True para el primer descarte de una ráfaga (el aviso no debe amplificar el abuso)"""
+        now = time.monotonic() if now is None else now
+        state = self.users.get(username)
+        if state is None or now < state.notified_until:
+            return False
+        state.notified_until = now + max(retry_after, 1.0)
+        return True
+
+    def should_close(self, username: str) -> bool:
+        state = self.users.get(username)
+        if state is None or state.strikes < self.close_after:
+            return False
+        self.closed += 1
+        return True
+
+    def forget(self, username: str, now: Optional[float] = None):
+        """
+        Se desconectó username. Su estado se conserva hasta que sus buckets se
+        rellenen: reconectar no debe servir para saltarse el límite.
+        """
+        now = time.monotonic() if now is None else now
+        self._gone.add(username)
+        for user in list(self._gone):
+            state = self.users.get(user)
+            if state is None or all(b.full(now) for b in state.buckets.values()):
+                self.users.pop(user, None)
+                self._gone.discard(user)
+
+    def get_stats(self) -> Dict:
+        return {
+            "users": len(self.users),
+            "allowed": self.allowed,
+            "throttled": sum(self.throttled.values()),
+            "throttled_by_type": dict(self.throttled),
+            "closed": self.closed,
+        }
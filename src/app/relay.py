@@ -0,0 +1,353 @@
+import asyncio
+import os
+import struct
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from src.transporte.codec import JSON
+from src.transporte.storage import IncrementalFile, get_storage
+
+# Envío de archivos entre usuarios del chat por el propio WebSocket.
+#
+# El emisor ofrece el archivo (file_offer) y lo manda en frames binarios
+# [file_id (16 bytes) | offset (8 bytes) | datos] que el servidor reenvía tal
+# cual al destinatario, sin guardarlos: una sola pasada de emisor a receptor.
+#
+# Control de flujo por créditos: el servidor indica al emisor hasta qué byte
+# puede enviar (file_credit.limit); el límite avanza cuando el destinatario
+# confirma lo recibido (file_ack), así que un receptor lento frena al emisor
+# en lugar de llenar colas. Un file_credit con offset pide además reenviar
+# desde ese byte: así se reanuda tras una desconexión de cualquiera de los dos
+# (file_resume del emisor, file_accept con offset del destinatario). Cuando
+# llega el último byte el servidor manda file_end al destinatario y, cuando
+# este confirma todo, file_complete al emisor.
+#
+# Si el destinatario no está conectado a este proceso, el archivo se guarda en
+# disco (store-and-forward) y al terminar se le manda un file_offer duradero
+# por el bus; cuando lo acepta se le envía desde disco con el mismo protocolo.
+# Los archivos guardados llevan sus metadatos al lado, así que cualquier
+# worker puede servirlos.
+
+FRAME_HEADER = struct.Struct("!16sQ")
+LIVE = "live"
+STORE = "store"
+
+
+def pack_frame(file_id: str, offset: int, data: bytes) -> bytes:
+    return FRAME_HEADER.pack(uuid.UUID(hex=file_id).bytes, offset) + data
+
+
+def unpack_frame(frame: bytes) -> Tuple[str, int, memoryview]:
+    if len(frame) < FRAME_HEADER.size:
+        raise ValueError("Frame binario demasiado corto")
+    raw_id, offset = FRAME_HEADER.unpack_from(frame)
+    return uuid.UUID(bytes=raw_id).hex, offset, memoryview(frame)[FRAME_HEADER.size:]
+
+
+class RelayError(Exception):
+    pass
+
+
+@dataclass
+class RelaySession:
+    file_id: str
+    sender: str
+    recipient: str
+    name: str
+    size: int
+    mime: Optional[str]
+    mode: str
+    received: int = 0            # Bytes contiguos recibidos del emisor
+    delivered: int = 0           # Bytes confirmados por el destinatario
+    limit: int = 0               # Crédito concedido al emisor (byte máximo)
+    accepted: bool = False
+    complete: bool = False       # Guardado entero en disco
+    updated: float = field(default_factory=time.monotonic)
+    sink: Optional[IncrementalFile] = field(default=None, repr=False)
+    pump: Optional[asyncio.Task] = field(default=None, repr=False)
+    acked: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    def meta(self) -> Dict:
+        return {"file_id": self.file_id, "sender": self.sender, "recipient": self.recipient,
+                "name": self.name, "size": self.size, "mime": self.mime}
+
+
+class FileRelay:
+    def __init__(self, hub, bus, root: str, window: int = 1024 * 1024, chunk_size: int = 64 * 1024,
+                 max_size: int = 1024 * 1024 * 1024, ttl: float = 600.0, stored_ttl: float = 7 * 24 * 3600):
+        """
+        hub es el ConnectionHub del proceso y bus el ChatBus (para los avisos
+        duraderos de archivos guardados). window es el crédito en bytes que
+        puede estar en vuelo por transferencia; ttl, cuánto espera una
+        transferencia interrumpida a que la reanuden, y stored_ttl, cuánto se
+        guarda un archivo que su destinatario no descarga.
+        """
+        self.hub = hub
+        self.bus = bus
+        self.root = root
+        self.window = window
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stored_ttl = stored_ttl
+        self._last_sweep = 0.0
+        self.sessions: Dict[str, RelaySession] = {}
+        self.storage = get_storage()
+        self.bytes_relayed = 0
+        self.bytes_stored = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, file_id: str) -> str:
+        return os.path.join(self.root, file_id)
+
+    def _send(self, user: str, payload: Dict) -> bool:
+        conn = self.hub.get(user)
+        return conn is not None and conn.send_json(payload)
+
+    def _grant(self, session: RelaySession, base: int, rewind: bool = False):
+        """Concede crédito al emisor hasta base + window; con rewind le pide reenviar desde base"""
+        limit = min(session.size, base + self.window)
+        if limit <= session.limit and not rewind:
+            return
+        session.limit = limit
+        message = {"type": "file_credit", "file_id": session.file_id, "limit": limit}
+        if rewind:
+            message["offset"] = base
+        self._send(session.sender, message)
+
+    async def handle(self, username: str, pkt: Dict) -> bool:
+        """Procesa un mensaje de control file_*; retorna False si no es del relay"""
+        handler = {
+            "file_offer": self._offer,
+            "file_accept": self._accept,
+            "file_ack": self._ack,
+            "file_resume": self._resume,
+            "file_cancel": self._cancel,
+        }.get(pkt.get("type"))
+        if handler is None:
+            return False
+        try:
+            await handler(username, pkt)
+        except (RelayError, OSError) as e:
+            self._send(username, {"type": "file_error", "file_id": pkt.get("file_id"), "error": str(e)})
+        return True
+
+    def _session(self, pkt: Dict) -> RelaySession:
+        session = self.sessions.get(str(pkt.get("file_id")))
+        if session is None:
+            raise RelayError("Transferencia desconocida")
+        session.updated = time.monotonic()
+        return session
+
+    async def _offer(self, username: str, pkt: Dict):
+        await self.expire()
+        to, size = pkt.get("to"), pkt.get("size")
+        if not to or not isinstance(size, int) or not (0 <= size <= self.max_size):
+            raise RelayError(f"Oferta inválida (tamaño máximo {self.max_size} bytes)")
+        conn = self.hub.get(to)
+        mode = LIVE if conn is not None and not conn.closed else STORE
+        session = RelaySession(uuid.uuid4().hex, username, to, os.path.basename(str(pkt.get("name", "archivo"))),
+                               size, pkt.get("mime"), mode)
+        self.sessions[session.file_id] = session
+        self._send(username, {"type": "file_offer_ack", "file_id": session.file_id, "mode": mode,
+                              "client_ref": pkt.get("client_ref")})
+        if mode == LIVE:
+            conn.send_json({"type": "file_offer", "from": username, "stored": False, **session.meta()})
+        else:
+            session.sink = self.storage.open_incremental(self._path(session.file_id), size)
+            self._grant(session, 0)
+            if size == 0:
+                await self._store_complete(session)
+
+    async def _accept(self, username: str, pkt: Dict):
+        session = self.sessions.get(str(pkt.get("file_id")))
+        if session is None:
+            session = await self._load_stored(str(pkt.get("file_id")))
+        if session.recipient != username:
+            raise RelayError("La transferencia no es para este usuario")
+        session.updated = time.monotonic()
+        offset = pkt.get("offset", 0)
+        offset = min(max(offset, 0), session.size) if isinstance(offset, int) else 0
+        session.accepted = True
+        session.delivered = offset
+        if session.mode == LIVE:
+            # Lo que el emisor mandó más allá de offset se perdió: que lo repita
+            session.received = offset
+            self._grant(session, offset, rewind=True)
+            if offset == session.size:
+                self._send(username, {"type": "file_end", "file_id": session.file_id})
+        elif not session.complete:
+            raise RelayError("El archivo todavía se está recibiendo")
+        else:
+            if session.pump is not None:
+                session.pump.cancel()
+            session.pump = asyncio.create_task(self._pump(session))
+
+    async def _load_stored(self, file_id: str) -> RelaySession:
+        """Sesión de un archivo guardado por otro worker (o antes de reiniciar)"""
+        try:
+            file_id = uuid.UUID(hex=file_id).hex
+            meta = JSON.loads(await self.storage.read_file(self._path(file_id) + ".json"))
+        except (ValueError, OSError):
+            raise RelayError("Transferencia desconocida")
+        session = RelaySession(meta["file_id"], meta["sender"], meta["recipient"], meta["name"],
+                               meta["size"], meta.get("mime"), STORE, received=meta["size"], complete=True)
+        self.sessions[file_id] = session
+        return session
+
+    async def on_frame(self, username: str, frame: bytes):
+        """Frame binario del emisor"""
+        try:
+            file_id, offset, data = unpack_frame(frame)
+        except ValueError:
+            return
+        session = self.sessions.get(file_id)
+        if session is None or session.sender != username:
+            return
+        session.updated = time.monotonic()
+        end = offset + len(data)
+        if offset != session.received or end > session.limit:
+            # Duplicado, desordenado o sin crédito: se descarta y se indica desde dónde seguir
+            self._grant(session, session.received, rewind=True)
+            return
+        if session.mode == LIVE:
+            conn = self.hub.get(session.recipient)
+            if conn is None or not session.accepted or not conn.send_bytes(frame):
+                return
+            session.received = end
+            self.bytes_relayed += len(data)
+            if end == session.size:
+                conn.send_json({"type": "file_end", "file_id": session.file_id})
+        else:
+            session.sink.submit(offset, data)
+            await session.sink.wait_capacity()
+            session.received = end
+            self.bytes_stored += len(data)
+            if end == session.size:
+                await self._store_complete(session)
+            # Crédito en saltos de un cuarto de ventana para no mandar uno por frame
+            elif session.received + self.window - session.limit >= self.window // 4:
+                self._grant(session, session.received)
+
+    async def _ack(self, username: str, pkt: Dict):
+        session = self._session(pkt)
+        offset = pkt.get("offset")
+        if session.recipient != username or not isinstance(offset, int):
+            return
+        session.delivered = max(session.delivered, min(offset, session.size))
+        if session.delivered >= session.size:
+            await self._finish(session)
+        elif session.mode == LIVE:
+            self._grant(session, session.delivered)
+        else:
+            session.acked.set()
+
+    async def _store_complete(self, session: RelaySession):
+        await session.sink.finalize()
+        await self.storage.write_file(self._path(session.file_id) + ".json", JSON.dumps(session.meta()))
+        session.complete = True
+        self._send(session.sender, {"type": "file_stored", "file_id": session.file_id})
+        # Desde aquí lo sirve desde disco el worker que reciba el file_accept
+        self.sessions.pop(session.file_id, None)
+        # Aviso duradero: llega ahora si está conectado (aquí o en otro worker) o al volver
+        offer = {"type": "file_offer", "from": session.sender, "stored": True, **session.meta()}
+        await self.bus.route(session.recipient, offer, await self.bus.next_seq(session.recipient))
+
+    async def _resume(self, username: str, pkt: Dict):
+        session = self._session(pkt)
+        if session.sender != username:
+            raise RelayError("La transferencia no es de este usuario")
+        if session.mode == LIVE:
+            session.received = session.delivered
+            connected = self.hub.get(session.recipient) is not None and session.accepted
+            # Sin destinatario no hay crédito: se concede cuando acepte
+            session.limit = session.delivered
+            self._send(username, {"type": "file_credit", "file_id": session.file_id,
+                                  "offset": session.delivered, "limit": session.delivered})
+            if connected:
+                self._grant(session, session.delivered)
+        else:
+            self._grant(session, session.received, rewind=True)
+
+    async def _pump(self, session: RelaySession):
+        """Envía al destinatario un archivo guardado, al ritmo de sus confirmaciones"""
+        fd = await self.storage.run(os.open, self._path(session.file_id), os.O_RDONLY)
+        try:
+            sent = session.delivered
+            while True:
+                conn = self.hub.get(session.recipient)
+                if conn is None or conn.closed:
+                    return      # Se reanuda con el próximo file_accept
+                limit = min(session.size, session.delivered + self.window)
+                while sent < limit:
+                    n = min(self.chunk_size, limit - sent)
+                    data = await self.storage.run(os.pread, fd, n, sent)
+                    conn.send_bytes(pack_frame(session.file_id, sent, data))
+                    sent += len(data)
+                    self.bytes_relayed += len(data)
+                if sent >= session.size:
+                    conn.send_json({"type": "file_end", "file_id": session.file_id})
+                    return
+                session.acked.clear()
+                await session.acked.wait()
+                sent = max(sent, session.delivered)
+        finally:
+            await self.storage.run(os.close, fd)
+
+    async def _finish(self, session: RelaySession):
+        self.sessions.pop(session.file_id, None)
+        if session.mode == STORE:
+            await self._discard(session)
+        complete = {"type": "file_complete", "file_id": session.file_id}
+        if not self._send(session.sender, complete):
+            await self.bus.notify(session.sender, complete)
+
+    async def _cancel(self, username: str, pkt: Dict):
+        session = self._session(pkt)
+        if username not in (session.sender, session.recipient):
+            return
+        self.sessions.pop(session.file_id, None)
+        await self._discard(session)
+        other = session.recipient if username == session.sender else session.sender
+        self._send(other, {"type": "file_cancel", "file_id": session.file_id})
+
+    async def _discard(self, session: RelaySession):
+        if session.pump is not None:
+            session.pump.cancel()
+        if session.sink is not None:
+            await session.sink.abort()
+        for path in (self._path(session.file_id), self._path(session.file_id) + ".json"):
+            try:
+                await self.storage.run(os.remove, path)
+            except FileNotFoundError:
+                pass
+
+    async def expire(self):
+        """Descarta las transferencias que nadie reanudó en ttl segundos y los archivos caducados"""
+        now = time.monotonic()
+        for session in [s for s in self.sessions.values() if s.updated < now - self.ttl]:
+            self.sessions.pop(session.file_id, None)
+            if session.complete:
+                # Descarga de un archivo guardado abandonada: el archivo sigue en disco
+                if session.pump is not None:
+                    session.pump.cancel()
+            else:
+                await self._discard(session)
+        if now - self._last_sweep >= 60.0:
+            self._last_sweep = now
+            await self.storage.run(self._sweep_stored, time.time() - self.stored_ttl)
+
+    def _sweep_stored(self, cutoff: float):
+        for entry in os.scandir(self.root):
+            if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                for path in (entry.path, entry.path[:-len(".json")]):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def get_stats(self) -> Dict:
+        return {"sessions": len(self.sessions), "bytes_relayed": self.bytes_relayed,
+                "bytes_stored": self.bytes_stored}
@@ -1,5 +1,5 @@
-import json
 import uuid
+from src.transporte.codec import default_codec
 from src.transporte.reliable import send_message
 
 class Session:
@@ -13,5 +13,5 @@ class Session:
             "type": msg_type,
             "payload": payload
         }
-        data = json.dumps(packet).encode('utf-8')
+        data = default_codec().dumps(packet)
         await send_message(self.writer, data)
@@ -0,0 +1,100 @@
+import asyncio
+import struct
+from typing import Optional, Set, Tuple
+
+from src.transporte.reliable import write_message
+
+# ACKs por lotes para transferencias FIABLES con ventana.
+#
+# En vez de un frame de control por chunk, el receptor confirma cada
+# ack_every chunks (o tras ack_delay segundos si llegan menos) con un frame
+# binario de tamaño fijo más un bitmap selectivo:
+#   magic (4) 'IMGA' | cumulative (4) | bitmap_len (2) | bitmap
+# cumulative es el siguiente chunk_id esperado en orden (todos los anteriores
+# llegaron) y el bit k del bitmap indica que llegó el chunk cumulative + 1 + k.
+# El frame se escribe con writer.write sin esperar drain() por cada ACK.
+
+ACK_MAGIC = b'IMGA'
+_ACK = struct.Struct("!4sIH")
+MAX_BITMAP_BYTES = 64               # Hasta 512 chunks fuera de orden por ACK
+
+
+def is_batch_ack(data: bytes) -> bool:
+    return data[:4] == ACK_MAGIC
+
+
+def encode_batch_ack(cumulative: int, received: Set[int]) -> bytes:
+    """Codifica un ACK acumulativo con los chunks recibidos fuera de orden"""
+    mask = 0
+    for chunk_id in received:
+        k = chunk_id - cumulative - 1
+        if 0 <= k < MAX_BITMAP_BYTES * 8:
+            mask |= 1 << k
+    bitmap = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+    return _ACK.pack(ACK_MAGIC, cumulative, len(bitmap)) + bitmap
+
+
+def decode_batch_ack(data: bytes) -> Tuple[int, Set[int]]:
+    """Retorna (cumulative, chunk_ids fuera de orden confirmados)"""
+    if len(data) < _ACK.size or not is_batch_ack(data):
+        raise ValueError("ACK por lotes inválido")
+    _, cumulative, bitmap_len = _ACK.unpack_from(data)
+    bitmap = data[_ACK.size:_ACK.size + bitmap_len]
+    if len(bitmap) != bitmap_len:
+        raise ValueError("Bitmap de ACK truncado")
+    mask = int.from_bytes(bitmap, 'little')
+    received = set()
+    k = 0
+    while mask:
+        if mask & 1:
+            received.add(cumulative + 1 + k)
+        mask >>= 1
+        k += 1
+    return cumulative, received
+
+
+class AckBatcher:
+    """
+    Acumula las confirmaciones de una transferencia y las envía como un único
+    ACK binario cada ack_every chunks o, si llegan menos, tras ack_delay.
+    Los duplicados también cuentan: indican que el emisor perdió un ACK.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, ack_every: int = 16, ack_delay: float = 0.01):
+        self.writer = writer
+        self.ack_every = max(1, ack_every)
+        self.ack_delay = ack_delay
+        self.cumulative = 0
+        self.out_of_order: Set[int] = set()
+        self.pending = 0
+        self.acks_sent = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def on_chunk(self, chunk_id: int):
+        if chunk_id == self.cumulative:
+            self.cumulative += 1
+            while self.cumulative in self.out_of_order:
+                self.out_of_order.remove(self.cumulative)
+                self.cumulative += 1
+        elif chunk_id > self.cumulative:
+            self.out_of_order.add(chunk_id)
+        self.pending += 1
+        if self.pending >= self.ack_every:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.ack_delay, self.flush)
+
+    def flush(self):
+        """Envía el ACK pendiente (síncrono: solo encola en el transporte)"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending or self.writer.is_closing():
+            return
+        frame = encode_batch_ack(self.cumulative, self.out_of_order)
+        write_message(self.writer, frame)
+        self.pending = 0
+        self.acks_sent += 1
+
+    def close(self):
+        self.flush()
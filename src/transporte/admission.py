@@ -0,0 +1,219 @@
+import asyncio
+from collections import Counter, deque
+from typing import Deque, Dict, Hashable, Optional, Tuple
+
+# Control de admisión y reparto justo para servidores con muchas subidas.
+#
+# AdmissionController limita las transferencias activas (globales y por
+# cliente). Las que no caben esperan en una cola FIFO acotada; si la cola está
+# llena o la espera supera queue_timeout se rechazan con ServerBusy, que lleva
+# una estimación de cuándo reintentar (frame de control "busy"). Solo esperan
+# en cola quienes pueden hacerlo (wait=True: clientes que pidieron admisión y
+# no envían chunks hasta recibir "admit"); al resto se le rechaza enseguida.
+#
+# FairScheduler reparte el trabajo por chunk (desempaquetar, reensamblar,
+# escribir a disco) entre las transferencias admitidas con Deficit Round
+# Robin: cada flujo recibe quantum * weight bytes por ronda, así que una
+# subida enorme no retrasa los chunks de una pequeña más de una ronda. Como
+# el ACK de un chunk sale después de procesarlo, un emisor que recibe menos
+# turnos también recibe menos ACKs y frena su ventana.
+
+
+class ServerBusy(Exception):
+    """El servidor no puede admitir la transferencia ahora; reintentar tras retry_after segundos"""
+
+    def __init__(self, retry_after: float, msg: str = "Servidor ocupado"):
+        super().__init__(f"{msg}, reintentar en {retry_after:.1f}s")
+        self.reason = msg
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, max_active: int = 8, max_per_client: int = 2, max_queued: int = 32,
+                 queue_timeout: float = 10.0, alpha: float = 0.2):
+        self.max_active = max_active
+        self.max_per_client = max_per_client
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.alpha = alpha
+        self.active = 0
+        self.per_client: Counter = Counter()
+        self._waiting: Deque[Tuple[Hashable, asyncio.Future]] = deque()
+        self.avg_duration: Optional[float] = None   # Duración media de una transferencia (EWMA)
+        self.admitted = 0
+        self.rejected = 0
+
+    def _can_admit(self, client: Hashable) -> bool:
+        return self.active < self.max_active and self.per_client[client] < self.max_per_client
+
+    def _grant(self, client: Hashable):
+        self.active += 1
+        self.per_client[client] += 1
+        self.admitted += 1
+
+    def retry_after(self) -> float:
+        """Estimación de cuándo habrá hueco: lo que tardan en salir los que esperan"""
+        duration = self.avg_duration if self.avg_duration is not None else 1.0
+        rounds = (len(self._waiting) + 1) / max(1, self.max_active)
+        return round(max(0.5, min(60.0, duration * rounds)), 1)
+
+    def queue_position(self, client: Hashable) -> int:
+        return sum(1 for c, _ in self._waiting if c == client)
+
+    async def acquire(self, client: Hashable, wait: bool = True):
+        """
+        Admite una transferencia de client, esperando turno si hace falta.
+        Lanza ServerBusy si la cola está llena o la espera excede queue_timeout,
+        o enseguida si no hay hueco y wait es False.
+        """
+        # Sin adelantar a los que ya esperan (salvo que estén bloqueados por su propio límite)
+        if self._can_admit(client) and not any(self._can_admit(c) for c, _ in self._waiting):
+            self._grant(client)
+            return
+        if not wait or len(self._waiting) >= self.max_queued:
+            self.rejected += 1
+            raise ServerBusy(self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (client, future)
+        self._waiting.append(entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._cancel(entry)
+            if future.done() and not future.cancelled():
+                # Admitida justo al vencer el plazo
+                return
+            self.rejected += 1
+            raise ServerBusy(self.retry_after(), "Tiempo de espera en cola agotado")
+        except asyncio.CancelledError:
+            self._cancel(entry)
+            if future.done() and not future.cancelled():
+                self.release(client)
+            raise
+
+    def _cancel(self, entry):
+        try:
+            self._waiting.remove(entry)
+        except ValueError:
+            pass
+        entry[1].cancel()
+
+    def release(self, client: Hashable, duration: Optional[float] = None):
+        """Libera el hueco de una transferencia terminada y admite a los siguientes en cola"""
+        self.active -= 1
+        self.per_client[client] -= 1
+        if self.per_client[client] <= 0:
+            del self.per_client[client]
+        if duration is not None:
+            self.avg_duration = duration if self.avg_duration is None else \
+                (1 - self.alpha) * self.avg_duration + self.alpha * duration
+        self._wake()
+
+    def _wake(self):
+        for entry in list(self._waiting):
+            client, future = entry
+            if self.active >= self.max_active:
+                return
+            if future.done():
+                self._waiting.remove(entry)
+            elif self._can_admit(client):
+                self._waiting.remove(entry)
+                self._grant(client)
+                future.set_result(None)
+
+    def get_stats(self) -> Dict:
+        return {"active": self.active, "queued": len(self._waiting), "clients": len(self.per_client),
+                "admitted": self.admitted, "rejected": self.rejected, "avg_duration": self.avg_duration}
+
+
+class Flow:
+    """Cola de peticiones de una transferencia dentro del FairScheduler"""
+
+    def __init__(self, key: Hashable, weight: float = 1.0):
+        if weight <= 0:
+            raise ValueError("weight debe ser positivo")
+        self.key = key
+        self.weight = weight
+        self.deficit = 0.0
+        self.waiting: Deque[Tuple[int, asyncio.Future]] = deque()
+        self.queued = False      # Está en la lista de flujos activos del scheduler
+        self.topped_up = False   # Ya recibió su quantum en la visita actual
+        self.served_bytes = 0
+
+
+class FairScheduler:
+    def __init__(self, quantum: int = 16 * 1024, slots: int = 4):
+        self.quantum = quantum
+        self.slots = slots             # Chunks procesándose a la vez (entre todos los flujos)
+        self.in_service = 0
+        self._active: Deque[Flow] = deque()
+
+    def register(self, key: Hashable, weight: float = 1.0) -> Flow:
+        return Flow(key, weight)
+
+    def unregister(self, flow: Flow):
+        """Descarta las peticiones pendientes de un flujo que termina"""
+        for _, future in flow.waiting:
+            future.cancel()
+        flow.waiting.clear()
+        self._dispatch()
+
+    async def acquire(self, flow: Flow, nbytes: int):
+        """
+        Espera el turno de flow para procesar nbytes. Sin competencia (nadie
+        esperando y slots libres) retorna de inmediato. Llamar a release() al terminar.
+        """
+        if not self._active and self.in_service < self.slots:
+            self.in_service += 1
+            flow.served_bytes += nbytes
+            return
+        future = asyncio.get_running_loop().create_future()
+        flow.waiting.append((nbytes, future))
+        if not flow.queued:
+            flow.queued = True
+            self._active.append(flow)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # El turno llegó a la vez que la cancelación: devolverlo
+                self.release()
+            raise
+
+    def release(self):
+        self.in_service -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Deficit Round Robin sobre los flujos con peticiones pendientes"""
+        while self.in_service < self.slots and self._active:
+            flow = self._active[0]
+            while flow.waiting and flow.waiting[0][1].done():
+                flow.waiting.popleft()
+            if not flow.waiting:
+                # Un flujo vacío sale de la ronda y pierde el déficit acumulado
+                self._active.popleft()
+                flow.queued = flow.topped_up = False
+                flow.deficit = 0.0
+                continue
+            nbytes, future = flow.waiting[0]
+            if flow.deficit < nbytes:
+                if flow.topped_up:
+                    # Agotó su quantum en esta visita: pasa al final de la ronda
+                    flow.topped_up = False
+                    self._active.rotate(-1)
+                else:
+                    flow.deficit += self.quantum * flow.weight
+                    flow.topped_up = True
+                continue
+            flow.waiting.popleft()
+            flow.deficit -= nbytes
+            flow.served_bytes += nbytes
+            self.in_service += 1
+            future.set_result(None)
+
+    def get_stats(self) -> Dict:
+        return {"in_service": self.in_service, "slots": self.slots, "waiting_flows": len(self._active),
+                "waiting_requests": sum(len(f.waiting) for f in self._active)}
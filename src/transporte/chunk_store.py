@@ -0,0 +1,274 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from src.transporte.fragmentation import CHUNKING_CDC, chunk_lengths
+
+# Almacén direccionado por contenido para deduplicar subidas.
+#
+# Los archivos recibidos se guardan una sola vez en files/, nombrados por el
+# SHA-256 de su contenido, y un índice SQLite asocia el hash de cada bloque
+# al archivo y offset donde está. Un bloque conocido no vuelve a viajar: el
+# emisor manda primero el manifiesto (hashes de bloques), el servidor
+# responde con los que le faltan y solo esos se transfieren. Los archivos se
+# materializan en su destino con hard links (o reflink/copia si no se puede).
+#
+# Los archivos del almacén son inmutables: quien escriba en un destino
+# materializado debe reemplazarlo (os.replace), nunca abrirlo para escribir.
+
+DIGEST_SIZE = 32                    # SHA-256
+DEFAULT_BLOCK_SIZE = 16 * 1024     # Tamaño medio de bloque con CDC
+FICLONE = 0x40049409                # ioctl de Linux para reflinks (btrfs, xfs)
+
+
+def block_digest(data) -> bytes:
+    return hashlib.sha256(data).digest()
+
+
+@dataclass
+class Manifest:
+    """Descripción de un archivo por sus bloques: [(hash, longitud), ...]"""
+    file_hash: str
+    size: int
+    block_size: int
+    blocks: List[Tuple[bytes, int]] = field(default_factory=list)
+
+    def offsets(self) -> Iterable[Tuple[bytes, int, int]]:
+        """Produce (hash, offset, longitud) de cada bloque"""
+        offset = 0
+        for digest, length in self.blocks:
+            yield digest, offset, length
+            offset += length
+
+    def to_fields(self) -> Dict:
+        """Campos planos para el frame img_manifest (válidos en JSON y en TLV)"""
+        fields = {"file_hash": self.file_hash, "size": self.size, "block_size": self.block_size,
+                  "blocks": b"".join(d for d, _ in self.blocks).hex()}
+        lengths = [n for _, n in self.blocks]
+        if lengths != _fixed_lengths(self.size, self.block_size):
+            fields["block_lens"] = ",".join(map(str, lengths))
+        return fields
+
+    @classmethod
+    def from_fields(cls, fields: Dict) -> "Manifest":
+        """Lanza ValueError si el manifiesto es inconsistente"""
+        size = int(fields["size"])
+        block_size = int(fields["block_size"])
+        raw = bytes.fromhex(fields["blocks"])
+        if len(raw) % DIGEST_SIZE:
+            raise ValueError("Lista de hashes truncada")
+        digests = [raw[i:i + DIGEST_SIZE] for i in range(0, len(raw), DIGEST_SIZE)]
+        if fields.get("block_lens"):
+            lengths = [int(n) for n in str(fields["block_lens"]).split(",")]
+        else:
+            lengths = _fixed_lengths(size, block_size)
+        if len(lengths) != len(digests) or sum(lengths) != size:
+            raise ValueError("El manifiesto no cubre el tamaño declarado")
+        return cls(str(fields["file_hash"]), size, block_size, list(zip(digests, lengths)))
+
+
+def _fixed_lengths(size: int, block_size: int) -> List[int]:
+    if block_size <= 0:
+        raise ValueError("block_size debe ser positivo")
+    full, rest = divmod(size, block_size)
+    return [block_size] * full + ([rest] if rest else [])
+
+
+def build_manifest(data, block_size: int = DEFAULT_BLOCK_SIZE, chunking: str = CHUNKING_CDC) -> Manifest:
+    """
+    Calcula el manifiesto de un buffer. Con CHUNKING_CDC block_size es el
+    tamaño medio y las fronteras dependen del contenido, así que una edición
+    solo cambia los bloques que toca; con CHUNKING_FIXED son bloques fijos.
+    """
+    view = memoryview(data).cast('B')
+    blocks = []
+    offset = 0
+    for n in chunk_lengths(view, block_size, chunking):
+        blocks.append((block_digest(view[offset:offset + n]), n))
+        offset += n
+    return Manifest(hashlib.sha256(view).hexdigest(), len(view), block_size, blocks)
+
+
+def delta_payload(data, manifest: Manifest, missing: Iterable[bytes]) -> bytes:
+    """Concatena, en el orden pedido, los bloques que le faltan al servidor"""
+    view = memoryview(data).cast('B')
+    where = {d: (o, n) for d, o, n in manifest.offsets()}
+    out = bytearray()
+    for digest in missing:
+        o, n = where[digest]
+        out += view[o:o + n]
+    return bytes(out)
+
+
+def delta_reader(data, manifest: Manifest, missing: Iterable[bytes]):
+    """
+    Como delta_payload, pero como fuente read(n) asíncrona que copia los
+    bloques pedidos a medida que se leen (para ChunkPipeline.pack_stream)
+    """
+    view = memoryview(data).cast('B')
+    where = {d: (o, n) for d, o, n in manifest.offsets()}
+    spans = [where[d] for d in missing]
+    span = pos = 0
+
+    async def read(n: int) -> bytes:
+        nonlocal span, pos
+        out = bytearray()
+        while span < len(spans) and len(out) < n:
+            o, length = spans[span]
+            take = min(length - pos, n - len(out))
+            out += view[o + pos:o + pos + take]
+            pos += take
+            if pos == length:
+                span += 1
+                pos = 0
+        return bytes(out)
+    return read
+
+
+def _link_or_copy(src: Path, dest: Path):
+    """Materializa src en dest de forma atómica: hard link, reflink o copia"""
+    try:
+        if os.path.samefile(src, dest):
+            # rename() entre dos enlaces del mismo inodo no hace nada
+            return
+    except FileNotFoundError:
+        pass
+    tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        os.link(src, tmp)
+    except OSError:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            try:
+                import fcntl
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (ImportError, OSError):
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    os.replace(tmp, dest)
+
+
+class ChunkStore:
+    def __init__(self, root: Union[str, os.PathLike]):
+        self.root = Path(root)
+        self.files_dir = self.root / "files"
+        self.files_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Se usa desde hilos (asyncio.to_thread); el lock serializa el acceso
+        self._db = sqlite3.connect(str(self.root / "index.db"), check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (file_hash TEXT PRIMARY KEY, size INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS blocks (
+                digest BLOB PRIMARY KEY, file_hash TEXT NOT NULL,
+                offset INTEGER NOT NULL, length INTEGER NOT NULL);
+        """)
+        self.bytes_deduplicated = 0
+        self.bytes_received = 0
+
+    def _file_path(self, file_hash: str) -> Path:
+        return self.files_dir / file_hash[:2] / file_hash
+
+    def has_file(self, file_hash: str) -> bool:
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM files WHERE file_hash = ?", (file_hash,)).fetchone()
+        return row is not None and self._file_path(file_hash).exists()
+
+    def missing(self, manifest: Manifest) -> List[bytes]:
+        """Hashes de bloques del manifiesto que el almacén no tiene (sin repetir)"""
+        if self.has_file(manifest.file_hash):
+            return []
+        wanted = list(dict.fromkeys(d for d, _ in manifest.blocks))
+        with self._lock:
+            known = set()
+            for i in range(0, len(wanted), 500):
+                batch = wanted[i:i + 500]
+                rows = self._db.execute(
+                    f"SELECT digest FROM blocks WHERE digest IN ({','.join('?' * len(batch))})", batch)
+                known.update(bytes(r[0]) for r in rows)
+        return [d for d in wanted if d not in known]
+
+    def read_block(self, digest: bytes) -> Optional[bytes]:
+        """Lee un bloque conocido verificando su hash; None si no está o no coincide"""
+        with self._lock:
+            row = self._db.execute("SELECT file_hash, offset, length FROM blocks WHERE digest = ?",
+                                   (digest,)).fetchone()
+        if row is None:
+            return None
+        file_hash, offset, length = row
+        try:
+            with open(self._file_path(file_hash), 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        except FileNotFoundError:
+            return None
+        return data if block_digest(data) == digest else None
+
+    def _index(self, manifest: Manifest):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO files VALUES (?, ?)", (manifest.file_hash, manifest.size))
+            self._db.executemany("INSERT OR IGNORE INTO blocks VALUES (?, ?, ?, ?)",
+                                 [(d, manifest.file_hash, o, n) for d, o, n in manifest.offsets()])
+
+    def add_file(self, path: Union[str, os.PathLike], block_size: int = DEFAULT_BLOCK_SIZE,
+                 chunking: str = CHUNKING_CDC) -> Manifest:
+        """Incorpora un archivo ya guardado en path (sin copiarlo si se puede enlazar)"""
+        manifest = build_manifest(Path(path).read_bytes(), block_size, chunking)
+        if not self.has_file(manifest.file_hash):
+            dest = self._file_path(manifest.file_hash)
+            dest.parent.mkdir(exist_ok=True)
+            _link_or_copy(Path(path), dest)
+        self._index(manifest)
+        return manifest
+
+    def materialize(self, manifest: Manifest, new_blocks: Dict[bytes, bytes],
+                    dest: Union[str, os.PathLike]) -> bool:
+        """
+        Reconstruye el archivo del manifiesto en dest con los bloques del
+        almacén más new_blocks (los recibidos en esta transferencia).
+        Retorna False si falta algún bloque o el hash final no coincide.
+        """
+        for digest, data in new_blocks.items():
+            if block_digest(data) != digest:
+                return False
+        stored = self._file_path(manifest.file_hash)
+        if not self.has_file(manifest.file_hash):
+            stored.parent.mkdir(exist_ok=True)
+            tmp = stored.with_name(f".{stored.name}.{uuid.uuid4().hex}.tmp")
+            h = hashlib.sha256()
+            try:
+                with open(tmp, 'wb') as f:
+                    for digest, _, _ in manifest.offsets():
+                        data = new_blocks.get(digest)
+                        if data is None:
+                            data = self.read_block(digest)
+                        if data is None:
+                            return False
+                        h.update(data)
+                        f.write(data)
+                if h.hexdigest() != manifest.file_hash:
+                    return False
+                os.replace(tmp, stored)
+            finally:
+                if tmp.exists():
+                    tmp.unlink()
+            self._index(manifest)
+        received = sum(len(d) for d in new_blocks.values())
+        self.bytes_received += received
+        self.bytes_deduplicated += manifest.size - received
+        _link_or_copy(stored, Path(dest))
+        return True
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            files, stored = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            blocks = self._db.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+        return {"files": files, "stored_bytes": stored, "blocks": blocks,
+                "bytes_received": self.bytes_received, "bytes_deduplicated": self.bytes_deduplicated}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
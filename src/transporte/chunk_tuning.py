@@ -0,0 +1,151 @@
+import math
+from typing import Dict, Optional, Tuple, Union
+
+from src.transporte.fragmentation import HEADER_SIZE
+
+# Ajuste automático del tamaño de chunk por destino.
+#
+# Cada chunk paga un coste fijo (header + framing y, en FIABLE, un RTT de
+# espera por su ACK) y un coste proporcional al riesgo de perderse entero.
+# Con una tasa de pérdida por byte q (derivada de la tasa de pérdida de
+# chunks medida) y un coste fijo H expresado en bytes, el rendimiento útil es
+#     f(s) = s / (s + H) * (1 - q) ** (s + H)
+# cuyo máximo está en x = s + H = (L*H + sqrt((L*H)**2 + 4*L*H)) / (2*L),
+# con L = -ln(1 - q). Sin pérdidas el óptimo es el máximo permitido.
+#
+# El protocolo fija el tamaño de chunk al anunciar img_meta, así que el ajuste
+# se aplica entre transferencias: las mediciones de una transferencia deciden
+# el tamaño de la siguiente hacia el mismo host:puerto.
+
+AUTO = "auto"
+
+MIN_CHUNK_SIZE = 64
+MAX_CHUNK_SIZE = 65536
+FRAMING_OVERHEAD = 4               # Prefijo de longitud de send_message
+IP_UDP_OVERHEAD = 28               # IPv4 + UDP, para transporte por datagramas
+
+
+class ChunkSizeTuner:
+    def __init__(self, initial: int = 1024, min_size: int = MIN_CHUNK_SIZE,
+                 max_size: int = MAX_CHUNK_SIZE, datagram_mtu: Optional[int] = None,
+                 ack_per_chunk: bool = True, alpha: float = 0.125, window: int = 1):
+        self.min_size = min_size
+        self.max_size = max_size
+        if datagram_mtu:
+            # Sobre datagramas, un chunk no debe fragmentarse a nivel IP
+            self.max_size = max(min_size, min(max_size, datagram_mtu - IP_UDP_OVERHEAD
+                                              - HEADER_SIZE - FRAMING_OVERHEAD))
+        self.ack_per_chunk = ack_per_chunk
+        self.window = window               # Chunks en vuelo por ACK esperado (ver resolve_chunk_size)
+        self.alpha = alpha                 # Peso EWMA de cada muestra (como SRTT en TCP)
+        self.current = self._clamp(initial)
+        self.srtt: Optional[float] = None
+        self.loss_rate = 0.0                     # Fracción de chunks perdidos (EWMA)
+        self.wire_size: Optional[float] = None   # Tamaño medio en el cable de esos chunks
+        self.throughput: Optional[float] = None  # Bytes/s
+        self.samples = 0
+
+    def _clamp(self, size: float) -> int:
+        # Múltiplos de 64 dentro de los límites
+        size = int(size) // 64 * 64
+        return max(self.min_size, min(self.max_size, size))
+
+    def _ewma(self, old: Optional[float], sample: float) -> float:
+        return sample if old is None else (1 - self.alpha) * old + self.alpha * sample
+
+    def observe_rtt(self, rtt: float):
+        self.srtt = self._ewma(self.srtt, rtt)
+
+    def observe_chunk(self, lost: bool, chunk_size: int):
+        """Registra el resultado (entregado/perdido) de un chunk de chunk_size bytes"""
+        self.loss_rate = (1 - self.alpha) * self.loss_rate + self.alpha * (1.0 if lost else 0.0)
+        self.wire_size = self._ewma(self.wire_size, chunk_size + HEADER_SIZE + FRAMING_OVERHEAD)
+        self.samples += 1
+
+    def byte_loss(self) -> float:
+        """Probabilidad de pérdida por byte: 1 - (1 - p) ** (1 / wire_size)"""
+        if not self.wire_size or self.loss_rate <= 0:
+            return 0.0
+        p = min(self.loss_rate, 0.999)
+        return -math.expm1(math.log1p(-p) / self.wire_size)
+
+    def observe_throughput(self, nbytes: int, seconds: float):
+        if seconds > 0 and nbytes > 0:
+            self.throughput = self._ewma(self.throughput, nbytes / seconds)
+
+    def fixed_cost(self) -> float:
+        """Coste fijo por chunk expresado en bytes"""
+        cost = HEADER_SIZE + FRAMING_OVERHEAD
+        if self.ack_per_chunk and self.srtt is not None and self.throughput:
+            # Esperar el ACK cuesta un producto ancho de banda-retardo, que con
+            # una ventana de N chunks en vuelo se reparte entre los N
+            cost += self.srtt * self.throughput / max(1, self.window)
+        return cost
+
+    def recommend(self) -> int:
+        """Tamaño óptimo según las mediciones actuales"""
+        if self.samples == 0 and self.srtt is None:
+            return self.current
+        q = self.byte_loss()
+        if q <= 0:
+            return self.max_size
+        L = -math.log1p(-q)
+        H = self.fixed_cost()
+        x = (L * H + math.sqrt((L * H) ** 2 + 4 * L * H)) / (2 * L)
+        return self._clamp(x - H)
+
+    def next_chunk_size(self) -> int:
+        """
+        Tamaño para la próxima transferencia. Se acerca al recomendado como
+        mucho a x2 / /2 por transferencia para no oscilar con mediciones ruidosas.
+        """
+        target = self.recommend()
+        self.current = self._clamp(min(max(target, self.current // 2), self.current * 2))
+        return self.current
+
+    def get_stats(self) -> Dict:
+        return {
+            "chunk_size": self.current,
+            "recommended": self.recommend(),
+            "srtt": self.srtt,
+            "loss_rate": self.loss_rate,
+            "byte_loss": self.byte_loss(),
+            "throughput_bps": self.throughput,
+            "samples": self.samples,
+        }
+
+
+_tuners: Dict[Tuple[str, int], ChunkSizeTuner] = {}
+
+
+def get_tuner(host: str, port: int) -> ChunkSizeTuner:
+    """Tuner compartido por destino; acumula mediciones entre transferencias"""
+    key = (host, port)
+    if key not in _tuners:
+        _tuners[key] = ChunkSizeTuner()
+    return _tuners[key]
+
+
+def resolve_chunk_size(chunk_size: Union[int, str, None], host: str, port: int, window: int = 1) -> int:
+    """
+    Convierte chunk_size ("auto", None o un entero) en el tamaño a usar.
+    window es el número de chunks que el envío mantendrá sin confirmar.
+    """
+    if chunk_size in (None, AUTO, 0):
+        tuner = get_tuner(host, port)
+        tuner.window = window
+        return tuner.next_chunk_size()
+    return int(chunk_size)
+
+
+def parse_chunk_size(value: Union[int, str]) -> Union[int, str]:
+    """
+    Valida un chunk_size recibido de la API: "auto" o un entero en rango.
+    Lanza ValueError si no es válido.
+    """
+    if isinstance(value, str) and value.strip().lower() == AUTO:
+        return AUTO
+    size = int(value)
+    if size < MIN_CHUNK_SIZE or size > MAX_CHUNK_SIZE:
+        raise ValueError(f"chunk_size debe estar entre {MIN_CHUNK_SIZE} y {MAX_CHUNK_SIZE}")
+    return size
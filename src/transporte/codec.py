@@ -0,0 +1,166 @@
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+# Serialización de mensajes estructurados (frames de control, paquetes del
+# transporte confiable, bus del chat, WebSocket).
+#
+# Hay dos formatos en el cable:
+#
+# - "json": el de siempre. Si orjson está instalado se usa para codificar y
+#   decodificar (mismo JSON, bastante menos CPU); si no, la librería estándar.
+# - "msgpack": binario, más compacto y rápido; solo si msgpack está
+#   instalado en los dos extremos.
+#
+# Los mensajes se distinguen por el primer byte (un objeto JSON empieza por
+# '{', un mapa msgpack por 0x80-0x8f, 0xde o 0xdf, y ninguno choca con los
+# magics binarios IMGC/IMGT), así que quien recibe decodifica cualquiera sin
+# configuración y responde en el formato del otro; los frames que no son
+# mensajes (chunks) se reconocen sin intentar decodificarlos. Quien inicia
+# elige con TRANSPORT_CODEC (json por defecto) o negocia con negotiate()
+# cuando el protocolo tiene un saludo.
+
+try:
+    import orjson
+except ImportError:     # Opcional: sin orjson se usa json de la librería estándar
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:     # Opcional: sin msgpack solo hay JSON
+    msgpack = None
+
+
+class UnsupportedCodec(ValueError):
+    """El mensaje viene en un formato que este proceso no tiene instalado"""
+
+
+class Codec:
+    name = ""
+    binary = False      # True si no produce texto (no sirve para frames de texto del WebSocket)
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data) -> Any:
+        """Lanza ValueError si data no es válido"""
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = "json"
+
+    def __init__(self, backend: Optional[str] = None):
+        if backend is None:
+            backend = "orjson" if orjson is not None else "json"
+        if backend == "orjson" and orjson is None:
+            raise ValueError("orjson no está instalado")
+        if backend not in ("json", "orjson"):
+            raise ValueError(f"Backend JSON desconocido: {backend}")
+        self.backend = backend
+
+    def dumps(self, obj: Any) -> bytes:
+        if self.backend == "orjson":
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def dumps_text(self, obj: Any) -> str:
+        """Como dumps pero en str (frames de texto del WebSocket, columnas TEXT)"""
+        if self.backend == "orjson":
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        return json.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data) -> Any:
+        if self.backend == "orjson":
+            if isinstance(data, (bytearray, memoryview)):
+                data = bytes(data)
+            return orjson.loads(data)      # orjson.JSONDecodeError es ValueError
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode('utf-8')
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ValueError("msgpack no está instalado")
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data) -> Any:
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(f"msgpack inválido: {e}")
+
+
+JSON = JSONCodec()
+CODECS: Dict[str, Codec] = {"json": JSON}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+
+def available() -> List[str]:
+    """Formatos que este proceso sabe leer y escribir, del preferido al último"""
+    return [name for name in ("msgpack", "json") if name in CODECS]
+
+
+def get_codec(name: str) -> Codec:
+    codec = CODECS.get(name)
+    if codec is None:
+        raise UnsupportedCodec(f"Codec no disponible: {name} (disponibles: {', '.join(available())})")
+    return codec
+
+
+def default_codec() -> Codec:
+    """Formato con el que este proceso inicia conversaciones (TRANSPORT_CODEC, json si no)"""
+    name = os.environ.get('TRANSPORT_CODEC', 'json')
+    codec = CODECS.get(name)
+    if codec is None:
+        print(f"[CODEC] {name} no disponible, usando json")
+        return JSON
+    return codec
+
+
+def negotiate(offered: Iterable[str]) -> Codec:
+    """El primero de offered (en el orden de quien ofrece) que este proceso soporta; json si ninguno"""
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+_MSGPACK_MAP = frozenset(range(0x80, 0x90)) | {0xde, 0xdf}
+_JSON_START = frozenset(b'{ \t\r\n')
+
+
+def detect_codec(data) -> Optional[Codec]:
+    """
+    Codec de un mensaje recibido según su primer byte; None si no es un
+    mensaje estructurado (chunks, frames TLV...). Lanza UnsupportedCodec si
+    es msgpack y no está instalado.
+    """
+    if not data:
+        return None
+    first = data[0]
+    if isinstance(first, str):
+        first = ord(first)
+    if first in _JSON_START:
+        return JSON
+    if first in _MSGPACK_MAP:
+        return get_codec("msgpack")
+    return None
+
+
+def decode(data) -> Any:
+    """Decodifica un mensaje en el formato que traiga; ValueError si no es ninguno"""
+    codec = detect_codec(data)
+    if codec is None:
+        raise ValueError("No es un mensaje JSON ni msgpack")
+    return codec.loads(data)
@@ -0,0 +1,198 @@
+import math
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Corrección de errores hacia adelante (FEC) para transferencias SEMI-FIABLES.
+# Los chunks de datos se agrupan en bloques consecutivos de group_size; cada
+# grupo lleva parity_count chunks de paridad, y el receptor puede reconstruir
+# hasta parity_count chunks perdidos por grupo sin retransmisiones.
+#  - "xor": una paridad por grupo (XOR de todos los chunks), recupera 1 pérdida
+#  - "rs":  Reed-Solomon sobre GF(256) con matriz de Cauchy, recupera tantas
+#           pérdidas como paridades tenga el grupo
+
+SCHEME_XOR = "xor"
+SCHEME_RS = "rs"
+
+
+@dataclass
+class FECConfig:
+    scheme: str = SCHEME_RS      # "rs" o "xor"
+    group_size: int = 16         # Chunks de datos por grupo
+    redundancy: float = 0.25     # Paridades / datos (en XOR define group_size)
+
+    def __post_init__(self):
+        if self.scheme not in (SCHEME_XOR, SCHEME_RS):
+            raise ValueError(f"Esquema FEC desconocido: {self.scheme}")
+        if self.redundancy <= 0:
+            raise ValueError("redundancy debe ser positiva")
+        if self.scheme == SCHEME_XOR:
+            # Una sola paridad por grupo: la redundancia fija el tamaño del grupo
+            self.group_size = max(1, round(1 / self.redundancy))
+        if self.group_size < 1 or self.group_size + self.parity_count > 256:
+            raise ValueError("group_size fuera de rango para GF(256)")
+
+    @property
+    def parity_count(self) -> int:
+        if self.scheme == SCHEME_XOR:
+            return 1
+        return max(1, math.ceil(self.group_size * self.redundancy))
+
+    def to_fields(self) -> Dict:
+        """Campos planos para anunciar la configuración en img_meta"""
+        return {"fec_scheme": self.scheme, "fec_group": self.group_size, "fec_parity": self.parity_count}
+
+    @classmethod
+    def from_fields(cls, fields: Dict) -> Optional["FECConfig"]:
+        scheme = fields.get("fec_scheme")
+        if not scheme:
+            return None
+        group = int(fields["fec_group"])
+        parity = int(fields.get("fec_parity", 1))
+        return cls(scheme=scheme, group_size=group, redundancy=parity / group)
+
+
+def group_bounds(group_id: int, total_chunks: int, group_size: int) -> Tuple[int, int]:
+    """Rango [first, end) de chunk_ids de datos del grupo"""
+    first = group_id * group_size
+    return first, min(first + group_size, total_chunks)
+
+
+def group_of(chunk_id: int, group_size: int) -> int:
+    return chunk_id // group_size
+
+
+# --- Aritmética en GF(256), polinomio primitivo 0x11d ---
+
+def _build_tables() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    exp = np.zeros(512, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int32)
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    exp[255:510] = exp[0:255]
+    # Tabla de multiplicación completa: MUL[a, b] = a * b
+    logs = log[1:]
+    mul = np.zeros((256, 256), dtype=np.uint8)
+    mul[1:, 1:] = exp[(logs[:, None] + logs[None, :]) % 255]
+    inv = np.zeros(256, dtype=np.uint8)
+    inv[1:] = exp[(255 - logs) % 255]
+    return exp, mul, inv
+
+
+_EXP, _MUL, _INV = _build_tables()
+
+
+def _cauchy_matrix(k: int, m: int) -> np.ndarray:
+    """Matriz de Cauchy m x k: C[i, j] = 1 / (x_i + y_j), con x_i = k + i, y_j = j"""
+    x = np.arange(k, k + m, dtype=np.uint8)
+    y = np.arange(k, dtype=np.uint8)
+    return _INV[x[:, None] ^ y[None, :]]
+
+
+def _gf_matmul(a: np.ndarray, shards: np.ndarray) -> np.ndarray:
+    """Producto a (r x k) por shards (k x L) en GF(256), vectorizado por filas"""
+    out = np.zeros((a.shape[0], shards.shape[1]), dtype=np.uint8)
+    for j in range(a.shape[1]):
+        # _MUL[a[:, j]] es (r, 256); indexar con la fila j multiplica toda la fila
+        out ^= _MUL[a[:, j]][:, shards[j]]
+    return out
+
+
+def _gf_invert(a: np.ndarray) -> np.ndarray:
+    """Inversa de una matriz cuadrada en GF(256) por Gauss-Jordan"""
+    n = a.shape[0]
+    aug = np.concatenate([a.astype(np.uint8), np.eye(n, dtype=np.uint8)], axis=1)
+    for c in range(n):
+        pivot_rows = np.nonzero(aug[c:, c])[0]
+        if len(pivot_rows) == 0:
+            raise ValueError("Matriz FEC singular")
+        p = c + pivot_rows[0]
+        if p != c:
+            aug[[c, p]] = aug[[p, c]]
+        aug[c] = _MUL[_INV[aug[c, c]]][aug[c]]
+        factors = aug[:, c].copy()
+        factors[c] = 0
+        aug ^= _MUL[factors[:, None], aug[c][None, :]]
+    return aug[:, n:]
+
+
+def _to_matrix(shards: List[bytes], chunk_size: int) -> np.ndarray:
+    """Apila los chunks en una matriz k x chunk_size rellenando con ceros"""
+    mat = np.zeros((len(shards), chunk_size), dtype=np.uint8)
+    for i, shard in enumerate(shards):
+        row = np.frombuffer(shard, dtype=np.uint8)
+        mat[i, :len(row)] = row
+    return mat
+
+
+def encode_group(shards: List[bytes], chunk_size: int, config: FECConfig) -> List[bytes]:
+    """Calcula los chunks de paridad de un grupo de datos"""
+    data = _to_matrix(shards, chunk_size)
+    if config.scheme == SCHEME_XOR:
+        return [np.bitwise_xor.reduce(data, axis=0).tobytes()]
+    parity = _gf_matmul(_cauchy_matrix(len(shards), config.parity_count), data)
+    return [row.tobytes() for row in parity]
+
+
+def encode_parity(data, chunk_size: int, config: FECConfig) -> Iterator[Tuple[int, int, bytes]]:
+    """
+    Genera la paridad de un buffer completo fragmentado en chunk_size.
+    Produce tuplas (group_id, parity_index, paridad).
+    """
+    view = memoryview(data).cast('B')
+    total_chunks = (len(view) + chunk_size - 1) // chunk_size
+    groups = (total_chunks + config.group_size - 1) // config.group_size
+    for g in range(groups):
+        first, end = group_bounds(g, total_chunks, config.group_size)
+        shards = [view[i * chunk_size:(i + 1) * chunk_size] for i in range(first, end)]
+        for index, parity in enumerate(encode_group(shards, chunk_size, config)):
+            yield g, index, parity
+
+
+def recover_group(data_shards: Dict[int, bytes], parity_shards: Dict[int, bytes],
+                  group_len: int, chunk_size: int, config: FECConfig) -> Dict[int, bytes]:
+    """
+    Reconstruye los chunks de datos perdidos de un grupo.
+    data_shards usa índices locales 0..group_len-1 y parity_shards 0..parity_count-1.
+    Retorna {índice_local: datos (con relleno hasta chunk_size)} de los recuperados.
+    Lanza ValueError si no hay suficientes chunks para reconstruir.
+    """
+    missing = [i for i in range(group_len) if i not in data_shards]
+    if not missing:
+        return {}
+
+    if config.scheme == SCHEME_XOR:
+        if len(missing) > 1 or 0 not in parity_shards:
+            raise ValueError("Paridad XOR insuficiente")
+        rows = list(data_shards.values()) + [parity_shards[0]]
+        return {missing[0]: np.bitwise_xor.reduce(_to_matrix(rows, chunk_size), axis=0).tobytes()}
+
+    if len(data_shards) + len(parity_shards) < group_len:
+        raise ValueError("Paridad Reed-Solomon insuficiente")
+
+    # Tomar group_len filas de la matriz generadora [I; C] de los chunks disponibles
+    cauchy = _cauchy_matrix(group_len, config.parity_count)
+    rows, shards = [], []
+    for i, shard in data_shards.items():
+        row = np.zeros(group_len, dtype=np.uint8)
+        row[i] = 1
+        rows.append(row)
+        shards.append(shard)
+    for j, shard in parity_shards.items():
+        if len(rows) == group_len:
+            break
+        if j < config.parity_count:
+            rows.append(cauchy[j])
+            shards.append(shard)
+    if len(rows) < group_len:
+        raise ValueError("Paridad Reed-Solomon insuficiente")
+
+    decode = _gf_invert(np.stack(rows[:group_len]))
+    recovered = _gf_matmul(decode[missing], _to_matrix(shards[:group_len], chunk_size))
+    return {i: recovered[n].tobytes() for n, i in enumerate(missing)}
@@ -1,27 +1,102 @@
+import asyncio
 import struct
 import time
 import gzip
 import hashlib
-import json
-from typing import Optional, Dict, Tuple, List
+import math
+import os
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import (Optional, Dict, Tuple, List, Iterable, Iterator, Union, BinaryIO, Callable,
+                    Awaitable, AsyncIterator)
+
+import numpy as np
+
+from src.transporte.tlv import encode_tlv, decode_tlv
+from src.transporte.codec import JSON
+from src.transporte.fec import FECConfig, encode_parity, recover_group, group_bounds, group_of
+from src.transporte.progress import ProgressTracker
 
 # Formato de encabezado de chunk mejorado:
 # 4s 1B  I     I      H        H         B      16s     H
 # magic (4) | ver (1) | total_len (4) | offset (4) | chunk_id (2) | total_chunks (2) | flags (1) | hash (16) | meta_len (2)
-# Seguido por metadatos JSON de longitud meta_len
+# Seguido por metadatos de longitud meta_len: JSON, o TLV binario si FLAG_TLV_METADATA
 HEADER_FMT = "!4sBIIHHB16sH"
 HEADER_SIZE = struct.calcsize(HEADER_FMT)
+_HEADER = struct.Struct(HEADER_FMT)
 MAGIC = b'IMGC'
 VERSION = 2
 
+# Versión 3: mismo layout con campos anchos para transferencias grandes
+# total_len (8) | offset (8) | chunk_id (4) | total_chunks (4)
+# Se usa solo cuando la transferencia no cabe en la versión 2 (más de
+# 65535 chunks o más de 4 GB), así que el resto sigue usando el header corto.
+HEADER_FMT_V3 = "!4sBQQIIB16sH"
+HEADER_SIZE_V3 = struct.calcsize(HEADER_FMT_V3)
+VERSION_V3 = 3
+_HEADERS = {VERSION: _HEADER, VERSION_V3: struct.Struct(HEADER_FMT_V3)}
+
 FLAG_COMPRESSED = 0x1
 FLAG_HAS_METADATA = 0x2
+FLAG_TLV_METADATA = 0x4
+# Chunk de paridad FEC: offset lleva el número de grupo y chunk_id el índice de paridad
+FLAG_PARITY = 0x8
+
+METADATA_JSON = "json"
+METADATA_TLV = "tlv"
+
+
+def header_version(total_len: int, total_chunks: int) -> int:
+    """Versión de header más compacta capaz de representar la transferencia"""
+    if total_len <= 0xFFFFFFFF and total_chunks <= 0xFFFF:
+        return VERSION
+    if total_len <= 0xFFFFFFFFFFFFFFFF and total_chunks <= 0xFFFFFFFF:
+        return VERSION_V3
+    raise ValueError(f"Transferencia demasiado grande: {total_len} bytes en {total_chunks} chunks")
+
+
+def _unpack_header(pv) -> Tuple[int, int, int, int, int, int, bytes, int, int]:
+    """
+    Lee el header de un paquete versión 2 o 3.
+    Retorna (ver, total_len, offset, chunk_id, total_chunks, flags, hash, meta_len, header_size).
+    """
+    ver = pv[4]
+    header = _HEADERS.get(ver)
+    if header is None:
+        raise ValueError(f"Unsupported version: {ver}")
+    if len(pv) < header.size:
+        raise ValueError("Packet too small")
+    _, _, total_len, offset, chunk_id, total_chunks, flags, payload_hash, meta_len = header.unpack_from(pv)
+    return ver, total_len, offset, chunk_id, total_chunks, flags, payload_hash, meta_len, header.size
+
+
+def _encode_metadata(metadata: Dict, metadata_format: str) -> Tuple[bytes, int]:
+    """Serializa los metadatos de chunk; retorna (bytes, flags)"""
+    if metadata_format == METADATA_TLV:
+        meta_bytes, flags = encode_tlv(metadata), FLAG_HAS_METADATA | FLAG_TLV_METADATA
+    elif metadata_format == METADATA_JSON:
+        meta_bytes, flags = JSON.dumps(metadata), FLAG_HAS_METADATA
+    else:
+        raise ValueError(f"Formato de metadatos desconocido: {metadata_format}")
+    if len(meta_bytes) > 65535:  # Límite de 2 bytes para meta_len
+        raise ValueError("Metadatos demasiado largos")
+    return meta_bytes, flags
+
+
+def _decode_metadata(meta_bytes, flags: int) -> Dict:
+    try:
+        if flags & FLAG_TLV_METADATA:
+            return decode_tlv(meta_bytes)
+        return JSON.loads(meta_bytes)
+    except Exception as e:
+        raise ValueError(f"Invalid metadata: {e}")
 
 
 def pack_chunk(data: bytes, total_len: int, offset: int, chunk_id: int, total_chunks: int, 
-               compressed: bool = False, metadata: Optional[Dict] = None) -> bytes:
+               compressed: bool = False, metadata: Optional[Dict] = None,
+               metadata_format: str = METADATA_JSON) -> bytes:
     """
-    Empaqueta un chunk con metadatos mejorados para transferencia robusta de imágenes
+    Empaqueta un chunk con metadatos mejorados para transferencia robusta de imágenes.
+    metadata_format="tlv" codifica los metadatos en binario compacto en vez de JSON.
     """
     flags = 0
     payload = data
@@ -37,15 +112,14 @@ def pack_chunk(data: bytes, total_len: int, offset: int, chunk_id: int, total_ch
     # Preparar metadatos
     meta_bytes = b''
     if metadata:
-        flags |= FLAG_HAS_METADATA
-        meta_bytes = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+        meta_bytes, meta_flags = _encode_metadata(metadata, metadata_format)
+        flags |= meta_flags
     
     meta_len = len(meta_bytes)
-    if meta_len > 65535:  # Límite de 2 bytes para meta_len
-        raise ValueError("Metadatos demasiado largos")
     
-    header = struct.pack(HEADER_FMT, MAGIC, VERSION, total_len, offset, chunk_id, 
-                        total_chunks, flags, payload_hash, meta_len)
+    version = header_version(total_len, total_chunks)
+    header = _HEADERS[version].pack(MAGIC, version, total_len, offset, chunk_id,
+                                    total_chunks, flags, payload_hash, meta_len)
     
     return header + meta_bytes + payload
 
@@ -54,35 +128,27 @@ def unpack_chunk(packet: bytes) -> Tuple[Dict, bytes]:
     """
     Desempaqueta un chunk con verificación de integridad y metadatos
     """
-    if len(packet) < HEADER_SIZE:
+    # magic + versión; el tamaño del header completo depende de la versión
+    if len(packet) < 5:
         raise ValueError("Packet too small")
     
-    header = packet[:HEADER_SIZE]
-    magic, ver, total_len, offset, chunk_id, total_chunks, flags, payload_hash, meta_len = struct.unpack(HEADER_FMT, header)
-    
-    if magic != MAGIC:
+    if packet[:4] != MAGIC:
         raise ValueError("Invalid magic")
     
-    if ver != VERSION:
-        # Para compatibilidad hacia atrás, permitir versión 1
-        if ver == 1:
-            # Usar formato anterior para versión 1
-            return _unpack_chunk_v1(packet)
-        else:
-            raise ValueError(f"Unsupported version: {ver}")
+    if packet[4] == 1:
+        # Para compatibilidad hacia atrás, usar formato anterior para versión 1
+        return _unpack_chunk_v1(packet)
+    ver, total_len, offset, chunk_id, total_chunks, flags, payload_hash, meta_len, header_size = \
+        _unpack_header(packet)
     
     # Extraer metadatos
     metadata = None
-    data_start = HEADER_SIZE
+    data_start = header_size
     if flags & FLAG_HAS_METADATA:
-        if len(packet) < HEADER_SIZE + meta_len:
+        if len(packet) < header_size + meta_len:
             raise ValueError("Packet too small for metadata")
-        meta_bytes = packet[HEADER_SIZE:HEADER_SIZE + meta_len]
-        try:
-            metadata = json.loads(meta_bytes.decode('utf-8'))
-        except Exception as e:
-            raise ValueError(f"Invalid metadata: {e}")
-        data_start = HEADER_SIZE + meta_len
+        metadata = _decode_metadata(packet[header_size:header_size + meta_len], flags)
+        data_start = header_size + meta_len
     
     # Extraer payload
     payload = packet[data_start:]
@@ -108,15 +174,508 @@ def unpack_chunk(packet: bytes) -> Tuple[Dict, bytes]:
         "total_chunks": total_chunks,
         "flags": flags,
         "metadata": metadata,
+        "parity": bool(flags & FLAG_PARITY),
         "integrity_verified": True
     }
     
     return meta, payload
 
+def pack_parity_chunk(parity: bytes, total_len: int, group_id: int, index: int, total_chunks: int) -> bytes:
+    """Empaqueta un chunk de paridad FEC (ver src.transporte.fec)"""
+    version = header_version(total_len, total_chunks)
+    header = _HEADERS[version].pack(MAGIC, version, total_len, group_id, index, total_chunks,
+                                    FLAG_PARITY, hashlib.md5(parity).digest(), 0)
+    return header + parity
+
+
+def parity_frames(data: Union[bytes, bytearray, memoryview], chunk_size: int,
+                  config: FECConfig) -> Dict[int, List[bytes]]:
+    """
+    Calcula y empaqueta la paridad FEC de un buffer completo.
+    Retorna {último chunk_id del grupo: [frames de paridad]} para que el
+    emisor envíe la paridad justo después de cada grupo de datos.
+    """
+    total_len = len(data)
+    total_chunks = count_chunks(total_len, chunk_size)
+    frames: Dict[int, List[bytes]] = {}
+    for group_id, index, parity in encode_parity(data, chunk_size, config):
+        _, end = group_bounds(group_id, total_chunks, config.group_size)
+        frames.setdefault(end - 1, []).append(
+            pack_parity_chunk(parity, total_len, group_id, index, total_chunks))
+    return frames
+
+
+def count_chunks(total_len: int, chunk_size: int) -> int:
+    """Número de chunks necesarios para fragmentar total_len bytes"""
+    if chunk_size <= 0:
+        raise ValueError("chunk_size debe ser positivo")
+    return (total_len + chunk_size - 1) // chunk_size
+
+
+# --- Chunking definido por contenido (FastCDC / Gear) ---
+#
+# Cortar en offsets fijos desplaza todas las fronteras tras una inserción, así
+# que un archivo apenas editado no comparte bloques con el original. Con
+# CHUNKING_CDC las fronteras se eligen donde un hash rodante (Gear) de los
+# últimos 64 bytes cumple una máscara, de modo que dependen del contenido y
+# se re-sincronizan tras el cambio. Se usa para los manifiestos de
+# deduplicación; los frames del protocolo siguen siendo de tamaño fijo porque
+# los grupos FEC y el ajuste de chunk_size dependen de ello.
+
+CHUNKING_FIXED = "fixed"
+CHUNKING_CDC = "cdc"
+
+_GEAR_WINDOW = 64
+# Tabla Gear determinista (debe coincidir entre emisor y servidor)
+_GEAR = np.array([int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)],
+                 dtype=np.uint64)
+
+
+def gear_hashes(data) -> np.ndarray:
+    """
+    Hash Gear en cada posición: h[i] = sum(G[b[i-k]] << k, k < 64) mod 2**64,
+    el mismo valor que el recurrente h = (h << 1) + G[b]. Se calcula por
+    duplicación de ventana (1, 2, 4, ... 64) en 6 pasadas vectorizadas.
+    """
+    h = _GEAR[np.frombuffer(data, dtype=np.uint8)]
+    w = 1
+    while w < _GEAR_WINDOW:
+        h[w:] += h[:-w] << np.uint64(w)
+        w *= 2
+    return h
+
+
+def _top_mask(bits: int) -> np.uint64:
+    # Bits altos: dependen de toda la ventana de 64 bytes
+    return np.uint64(((1 << bits) - 1) << (64 - bits))
+
+
+def cdc_boundaries(data, avg_size: int = 16 * 1024, min_size: Optional[int] = None,
+                   max_size: Optional[int] = None, segment: int = 4 * 1024 * 1024) -> List[int]:
+    """
+    Offsets de fin de cada chunk con FastCDC (chunking normalizado): entre
+    min_size y avg_size se exige una máscara más estricta y a partir de
+    avg_size una más laxa, lo que concentra los tamaños alrededor de avg_size.
+    Los hashes se calculan por segmentos para acotar la memoria.
+    """
+    view = memoryview(data).cast('B')
+    n = len(view)
+    min_size = min_size or avg_size // 4
+    max_size = max_size or avg_size * 8
+    if not (_GEAR_WINDOW <= min_size <= avg_size <= max_size):
+        raise ValueError("Se requiere 64 <= min_size <= avg_size <= max_size")
+
+    bits = max(1, round(math.log2(avg_size)))
+    mask_s, mask_l = _top_mask(bits + 2), _top_mask(max(1, bits - 2))
+    strict, loose = [], []
+    for start in range(0, n, segment):
+        lo = max(0, start - (_GEAR_WINDOW - 1))
+        h = gear_hashes(view[lo:start + segment])[start - lo:]
+        # mask_s contiene los bits de mask_l: los estrictos son un subconjunto
+        cand = np.flatnonzero((h & mask_l) == 0)
+        loose.append(cand + start)
+        strict.append(cand[(h[cand] & mask_s) == 0] + start)
+    strict = np.concatenate(strict) if strict else np.zeros(0, dtype=np.int64)
+    loose = np.concatenate(loose) if loose else np.zeros(0, dtype=np.int64)
+
+    # Un hash que cumple la máscara en la posición p corta el chunk en p + 1
+    cuts = []
+    start = 0
+    while n - start > min_size:
+        end = min(start + max_size, n)
+        normal = min(start + avg_size, n)
+        i = np.searchsorted(strict, start + min_size - 1)
+        if i < len(strict) and strict[i] + 1 < normal:
+            end = int(strict[i]) + 1
+        else:
+            j = np.searchsorted(loose, normal - 1)
+            if j < len(loose) and loose[j] + 1 < end:
+                end = int(loose[j]) + 1
+        cuts.append(end)
+        start = end
+    if start < n:
+        cuts.append(n)
+    return cuts
+
+
+def chunk_lengths(data, chunk_size: int, chunking: str = CHUNKING_FIXED) -> List[int]:
+    """Longitudes de los chunks de data según el modo de chunking"""
+    total_len = len(memoryview(data).cast('B'))
+    if chunking == CHUNKING_FIXED:
+        if chunk_size <= 0:
+            raise ValueError("chunk_size debe ser positivo")
+        full, rest = divmod(total_len, chunk_size)
+        return [chunk_size] * full + ([rest] if rest else [])
+    if chunking == CHUNKING_CDC:
+        cuts = cdc_boundaries(data, avg_size=chunk_size)
+        return [end - start for start, end in zip([0] + cuts, cuts)]
+    raise ValueError(f"Modo de chunking desconocido: {chunking}")
+
+
+def _open_source(source) -> Tuple[int, Optional[memoryview], Optional[BinaryIO], bool]:
+    """
+    Normaliza la fuente de fragment(): buffer en memoria, ruta o archivo abierto.
+    Retorna (total_len, vista, archivo, cerrar_al_terminar).
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source).cast('B')
+        return len(view), view, None, False
+    if isinstance(source, (str, os.PathLike)):
+        f = open(source, 'rb')
+        return os.fstat(f.fileno()).st_size, None, f, True
+    if hasattr(source, 'readinto'):
+        start = source.tell()
+        total_len = source.seek(0, os.SEEK_END) - start
+        source.seek(start)
+        return total_len, None, source, False
+    raise TypeError(f"Fuente no soportada: {type(source).__name__}")
+
+
+def _pack_range(view: Optional[memoryview], f: Optional[BinaryIO], total_len: int, chunk_size: int,
+                first_id: int, end_id: int, total_chunks: int, compressed: bool,
+                meta_bytes: bytes, meta_flags: int) -> Tuple[bytearray, List[Tuple[int, int]]]:
+    """
+    Empaqueta los chunks [first_id, end_id) en una arena preasignada.
+    La fuente es view (payload desde el offset de first_id) o un archivo ya
+    posicionado en ese offset. Retorna la arena y los límites de cada frame.
+    """
+    base = first_id * chunk_size
+    count = end_id - first_id
+
+    # La compresión cambia el tamaño del payload, así que hay que
+    # comprimir antes de poder dimensionar la arena
+    payloads: Optional[List[bytes]] = None
+    if compressed:
+        payloads = []
+        for i in range(first_id, end_id):
+            rel = i * chunk_size - base
+            if view is not None:
+                raw = view[rel:rel + chunk_size]
+            else:
+                raw = f.read(min(chunk_size, total_len - i * chunk_size))
+            payloads.append(gzip.compress(raw))
+        payload_lens = [len(p) for p in payloads]
+    else:
+        payload_lens = [min(chunk_size, total_len - i * chunk_size) for i in range(first_id, end_id)]
+
+    version = header_version(total_len, total_chunks)
+    header = _HEADERS[version]
+    chunk0_meta = meta_bytes if first_id == 0 else b''
+    arena = bytearray(count * header.size + len(chunk0_meta) + sum(payload_lens))
+    arena_view = memoryview(arena)
+    flags_base = FLAG_COMPRESSED if compressed else 0
+    bounds: List[Tuple[int, int]] = []
+
+    pos = 0
+    for n, i in enumerate(range(first_id, end_id)):
+        offset = i * chunk_size
+        flags = flags_base
+        chunk_meta = b''
+        if i == 0 and meta_bytes:
+            flags |= meta_flags
+            chunk_meta = meta_bytes
+        data_start = pos + header.size + len(chunk_meta)
+        data_end = data_start + payload_lens[n]
+        slot = arena_view[data_start:data_end]
+
+        if payloads is not None:
+            slot[:] = payloads[n]
+        elif view is not None:
+            slot[:] = view[offset - base:offset - base + payload_lens[n]]
+        else:
+            if f.readinto(slot) != len(slot):
+                raise ValueError("Archivo truncado durante la fragmentación")
+
+        if chunk_meta:
+            arena_view[pos + header.size:data_start] = chunk_meta
+        header.pack_into(arena, pos, MAGIC, version, total_len, offset, i, total_chunks,
+                         flags, hashlib.md5(slot).digest(), len(chunk_meta))
+        bounds.append((pos, data_end))
+        pos = data_end
+    return arena, bounds
+
+
+def fragment(source: Union[bytes, bytearray, memoryview, str, os.PathLike, BinaryIO],
+             chunk_size: int = 1024, compressed: bool = False,
+             metadata: Optional[Dict] = None,
+             metadata_format: str = METADATA_JSON) -> Iterator[memoryview]:
+    """
+    Fragmenta un buffer o archivo completo en frames listos para enviar.
+
+    Todos los frames (header + metadatos + payload) se escriben en una única
+    arena preasignada: los headers se calculan en una sola pasada con
+    struct.pack_into y los archivos se leen directamente en la arena con
+    readinto, sin objetos intermedios por chunk. Los metadatos opcionales se
+    adjuntan al chunk 0, igual que hacen los clientes con pack_chunk.
+    Cada frame producido es un memoryview sobre la arena.
+    """
+    total_len, view, f, close_file = _open_source(source)
+    try:
+        total_chunks = count_chunks(total_len, chunk_size)
+        if total_chunks == 0:
+            return
+
+        meta_bytes, meta_flags = b'', 0
+        if metadata:
+            meta_bytes, meta_flags = _encode_metadata(metadata, metadata_format)
+
+        arena, bounds = _pack_range(view, f, total_len, chunk_size, 0, total_chunks, total_chunks,
+                                    compressed, meta_bytes, meta_flags)
+    finally:
+        if close_file:
+            f.close()
+
+    arena_view = memoryview(arena)
+    for start, end in bounds:
+        yield arena_view[start:end]
+
+
+def pack_chunks(data: Union[bytes, bytearray, memoryview], chunk_size: int = 1024,
+                compressed: bool = False, metadata: Optional[Dict] = None,
+                metadata_format: str = METADATA_JSON) -> List[memoryview]:
+    """Versión por lotes de pack_chunk: fragmenta un buffer completo de una vez"""
+    return list(fragment(data, chunk_size, compressed, metadata, metadata_format))
+
+
+def unpack_chunks(packets: Iterable[Union[bytes, memoryview]]) -> Iterator[Tuple[Dict, memoryview]]:
+    """
+    Desempaqueta un lote de chunks recibidos.
+    A diferencia de unpack_chunk, el payload sin comprimir se devuelve como
+    memoryview sobre el paquete original, sin copiarlo.
+    """
+    for packet in packets:
+        pv = memoryview(packet).cast('B')
+        if len(pv) < 5:
+            raise ValueError("Packet too small")
+        if pv[:4] != MAGIC:
+            raise ValueError("Invalid magic")
+        if pv[4] == 1:
+            meta, payload = unpack_chunk(bytes(pv))
+            yield meta, memoryview(payload)
+            continue
+        ver, total_len, offset, chunk_id, total_chunks, flags, payload_hash, meta_len, header_size = \
+            _unpack_header(pv)
+
+        metadata = None
+        data_start = header_size
+        if flags & FLAG_HAS_METADATA:
+            if len(pv) < header_size + meta_len:
+                raise ValueError("Packet too small for metadata")
+            metadata = _decode_metadata(pv[header_size:header_size + meta_len], flags)
+            data_start += meta_len
+
+        payload = pv[data_start:]
+        if hashlib.md5(payload).digest() != payload_hash:
+            raise ValueError("Payload integrity check failed")
+        if flags & FLAG_COMPRESSED:
+            try:
+                payload = memoryview(gzip.decompress(payload))
+            except Exception as e:
+                raise ValueError(f"Decompression failed: {e}")
+
+        yield {
+            "version": ver,
+            "total_len": total_len,
+            "offset": offset,
+            "chunk_id": chunk_id,
+            "total_chunks": total_chunks,
+            "flags": flags,
+            "metadata": metadata,
+            "parity": bool(flags & FLAG_PARITY),
+            "integrity_verified": True
+        }, payload
+
+
+def _pack_batch(payload, total_len: int, chunk_size: int, first_id: int, end_id: int,
+                total_chunks: int, compressed: bool, meta_bytes: bytes,
+                meta_flags: int) -> Tuple[bytearray, List[Tuple[int, int]]]:
+    """Tarea de worker: empaqueta un lote de chunks (apta para ProcessPoolExecutor)"""
+    return _pack_range(memoryview(payload).cast('B'), None, total_len, chunk_size, first_id, end_id,
+                       total_chunks, compressed, meta_bytes, meta_flags)
+
+
+def _unpack_batch(packets: List[bytes]) -> List[Tuple[Dict, bytes]]:
+    """Tarea de worker: verifica y desempaqueta un lote de chunks"""
+    return [unpack_chunk(packet) for packet in packets]
+
+
+def _unpack_batch_checked(packets: List[bytes]) -> List[Union[Tuple[Dict, bytes], ValueError]]:
+    """Como _unpack_batch, pero un paquete inválido deja su ValueError en su lugar"""
+    results = []
+    for packet in packets:
+        try:
+            results.append(unpack_chunk(packet))
+        except ValueError as e:
+            results.append(e)
+    return results
+
+
+class ChunkPipeline:
+    """
+    Empaquetado y verificación de chunks en paralelo sobre un pool de workers.
+
+    Los chunks se reparten en lotes de batch_size; cada lote se empaqueta en
+    su propia arena (gzip + MD5 + headers) en un worker y los resultados se
+    devuelven en orden. zlib y hashlib liberan el GIL con buffers grandes,
+    así que un pool de hilos escala con chunks de varios KB; con chunks
+    pequeños MD5 no suelta el GIL y conviene use_processes=True.
+    Las variantes *_async ejecutan el trabajo fuera del event loop.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, use_processes: bool = False,
+                 batch_size: int = 64, offload_threshold: int = 16 * 1024):
+        self.use_processes = use_processes
+        self.batch_size = batch_size
+        # unpack_one()/unpack_many() solo salen del event loop con al menos
+        # estos bytes: por debajo el salto al pool cuesta más que el MD5
+        self.offload_threshold = offload_threshold
+        if use_processes:
+            self.executor: Executor = ProcessPoolExecutor(max_workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="chunk-pipeline")
+
+    def _slice(self, view: memoryview):
+        # Los procesos necesitan bytes serializables; los hilos comparten la vista
+        return bytes(view) if self.use_processes else view
+
+    def _pack_jobs(self, data, chunk_size: int, compressed: bool, metadata: Optional[Dict],
+                   metadata_format: str) -> List[tuple]:
+        view = memoryview(data).cast('B')
+        total_len = len(view)
+        total_chunks = count_chunks(total_len, chunk_size)
+        meta_bytes, meta_flags = b'', 0
+        if metadata:
+            meta_bytes, meta_flags = _encode_metadata(metadata, metadata_format)
+        jobs = []
+        for first in range(0, total_chunks, self.batch_size):
+            end = min(first + self.batch_size, total_chunks)
+            payload = self._slice(view[first * chunk_size:end * chunk_size])
+            jobs.append((payload, total_len, chunk_size, first, end, total_chunks,
+                         compressed, meta_bytes, meta_flags))
+        return jobs
+
+    def _unpack_jobs(self, packets: Iterable) -> List[List]:
+        packets = [self._slice(memoryview(p)) if self.use_processes else p for p in packets]
+        return [packets[i:i + self.batch_size] for i in range(0, len(packets), self.batch_size)]
+
+    @staticmethod
+    def _collect(results) -> List[memoryview]:
+        frames = []
+        for arena, bounds in results:
+            arena_view = memoryview(arena)
+            frames.extend(arena_view[start:end] for start, end in bounds)
+        return frames
+
+    @staticmethod
+    def _read_source(source):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                return f.read()
+        return source
+
+    def pack(self, source, chunk_size: int = 1024, compressed: bool = False,
+             metadata: Optional[Dict] = None, metadata_format: str = METADATA_JSON) -> List[memoryview]:
+        """Equivalente paralelo de pack_chunks(); acepta también una ruta"""
+        jobs = self._pack_jobs(self._read_source(source), chunk_size, compressed, metadata, metadata_format)
+        futures = [self.executor.submit(_pack_batch, *job) for job in jobs]
+        return self._collect(f.result() for f in futures)
+
+    async def pack_async(self, source, chunk_size: int = 1024, compressed: bool = False,
+                         metadata: Optional[Dict] = None,
+                         metadata_format: str = METADATA_JSON) -> List[memoryview]:
+        """Como pack(), sin bloquear el event loop (la lectura del archivo incluida)"""
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self._read_source, source)
+        jobs = self._pack_jobs(data, chunk_size, compressed, metadata, metadata_format)
+        results = await asyncio.gather(*(loop.run_in_executor(self.executor, _pack_batch, *job)
+                                         for job in jobs))
+        return self._collect(results)
+
+    async def pack_stream(self, read: Callable[[int], Awaitable[bytes]], total_len: int,
+                          chunk_size: int = 1024, compressed: bool = False) -> AsyncIterator[memoryview]:
+        """
+        Fragmenta una fuente leída con await read(n) (p. ej. UploadFile.read)
+        sin tenerla entera en memoria: lee de a batch_size chunks, empaqueta
+        cada lote en el pool y produce sus frames. Solo hay un lote en memoria
+        a la vez. Lanza ValueError si la fuente se acaba antes de total_len bytes.
+        """
+        loop = asyncio.get_running_loop()
+        total_chunks = count_chunks(total_len, chunk_size)
+        for first in range(0, total_chunks, self.batch_size):
+            end = min(first + self.batch_size, total_chunks)
+            offset = first * chunk_size
+            want = min(end * chunk_size, total_len) - offset
+            block = bytearray()
+            while len(block) < want:
+                data = await read(want - len(block))
+                if not data:
+                    raise ValueError(f"Fuente truncada: {offset + len(block)}/{total_len} bytes")
+                block += data
+            arena, bounds = await loop.run_in_executor(
+                self.executor, _pack_batch, self._slice(memoryview(block)), total_len, chunk_size,
+                first, end, total_chunks, compressed, b'', 0)
+            arena_view = memoryview(arena)
+            for start, stop in bounds:
+                yield arena_view[start:stop]
+
+    def unpack(self, packets: Iterable) -> List[Tuple[Dict, bytes]]:
+        """Verifica y desempaqueta un lote de paquetes en paralelo, en orden"""
+        futures = [self.executor.submit(_unpack_batch, batch) for batch in self._unpack_jobs(packets)]
+        return [item for f in futures for item in f.result()]
+
+    async def unpack_async(self, packets: Iterable) -> List[Tuple[Dict, bytes]]:
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(loop.run_in_executor(self.executor, _unpack_batch, batch)
+                                         for batch in self._unpack_jobs(packets)))
+        return [item for batch in results for item in batch]
+
+    async def unpack_one(self, packet: bytes) -> Tuple[Dict, bytes]:
+        """
+        Desempaqueta un paquete recibido. Los pequeños se procesan en línea
+        (el salto a un worker costaría más que el propio MD5); los grandes
+        se verifican en el pool para no bloquear otras conexiones.
+        """
+        if len(packet) < self.offload_threshold:
+            return unpack_chunk(packet)
+        loop = asyncio.get_running_loop()
+        return (await loop.run_in_executor(self.executor, _unpack_batch, [packet]))[0]
+
+    async def unpack_many(self, packets: List) -> List[Union[Tuple[Dict, bytes], ValueError]]:
+        """
+        Desempaqueta los paquetes que llegaron juntos por una conexión. Si
+        suman offload_threshold bytes se verifican en el pool con un único
+        salto (con chunks de 1 KB ninguno llegaría por separado); si no, en
+        línea. Un paquete inválido no invalida el resto: en su lugar queda
+        su ValueError.
+        """
+        if sum(len(p) for p in packets) < self.offload_threshold:
+            return _unpack_batch_checked(packets)
+        if self.use_processes:
+            packets = [bytes(p) for p in packets]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _unpack_batch_checked, packets)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+_default_pipeline: Optional[ChunkPipeline] = None
+
+
+def get_pipeline() -> ChunkPipeline:
+    """Pipeline compartido (pool de hilos) para los emisores y receptores"""
+    global _default_pipeline
+    if _default_pipeline is None:
+        _default_pipeline = ChunkPipeline()
+    return _default_pipeline
+
+
 def _unpack_chunk_v1(packet: bytes) -> Tuple[Dict, bytes]:
     """Compatibilidad con versión anterior"""
     OLD_HEADER_FMT = "!4sBIIHHB"
     OLD_HEADER_SIZE = struct.calcsize(OLD_HEADER_FMT)
+    if len(packet) < OLD_HEADER_SIZE:
+        raise ValueError("Packet too small")
     
     header = packet[:OLD_HEADER_SIZE]
     magic, ver, total_len, offset, chunk_id, total_chunks, flags = struct.unpack(OLD_HEADER_FMT, header)
@@ -146,11 +705,104 @@ class Reassembler:
     def __init__(self, total_len: int, total_chunks: int, timeout: float = 10.0):
         self.total_len = total_len
         self.total_chunks = total_chunks
+        self.transfer_id: Optional[str] = None
         self.received: Dict[int, bytes] = {}
         self.metadata: Dict[int, Dict] = {}  # Metadatos por chunk
         self.missing_chunks: set = set(range(total_chunks))
         self.start_time = time.time()
+        self.last_activity = self.start_time
         self.timeout = timeout
+        # FEC opcional: paridades recibidas por grupo y chunks reconstruidos
+        self.fec: Optional[FECConfig] = None
+        self.chunk_size = 0
+        self.parity: Dict[int, Dict[int, bytes]] = {}
+        self.parity_bytes = 0
+        self.max_parity_bytes: Optional[int] = None   # Tope de paridad retenida (None: sin tope)
+        self.recovered_chunks: set = set()
+        # Ensamblado parcial incremental: offset real de cada chunk, buffer
+        # (creado al primer uso) y longitud del prefijo contiguo recibido
+        self.offsets: Dict[int, int] = {}
+        self._partial: Optional[bytearray] = None
+        self._prefix_next = 0
+        self.contiguous_len = 0
+        self._preview = None
+        # Flujo de eventos de progreso (suscribirse con progress.subscribe())
+        self.bytes_received = 0
+        self.duplicates = 0
+        self.progress = ProgressTracker(total_chunks, total_len)
+        # Callback on_store(offset, data) por cada chunk nuevo (incluidos los
+        # reconstruidos por FEC), p. ej. para escribirlo a disco según llega
+        self.on_store: Optional[Callable[[int, bytes], None]] = None
+
+    def enable_fec(self, config: FECConfig, chunk_size: int):
+        """Activa la reconstrucción de chunks perdidos a partir de paridad"""
+        self.fec = config
+        self.chunk_size = chunk_size
+
+    def add_frame(self, meta: Dict, payload: bytes) -> bool:
+        """Añade un chunk tal como lo devuelve unpack_chunk (datos o paridad)"""
+        if meta.get("parity"):
+            return self.add_parity(meta["offset"], meta["chunk_id"], payload)
+        return self.add_chunk(meta["chunk_id"], meta["offset"], payload, meta.get("metadata"))
+
+    def add_parity(self, group_id: int, index: int, data: bytes) -> bool:
+        """
+        Añade un chunk de paridad e intenta reconstruir su grupo.
+        Retorna True si la paridad es nueva.
+        """
+        if self.fec is None:
+            return False
+        first, end = group_bounds(group_id, self.total_chunks, self.fec.group_size)
+        if first >= end or not 0 <= index < self.fec.parity_count or len(data) > self.chunk_size:
+            raise ValueError(f"Paridad inválida: grupo {group_id}, índice {index}")
+        group = self.parity.get(group_id, {})
+        if index in group or not any(i in self.missing_chunks for i in range(first, end)):
+            # Repetida o de un grupo ya completo: no hace falta guardarla
+            return False
+        if self.max_parity_bytes is not None and self.parity_bytes + len(data) > self.max_parity_bytes:
+            return False
+        self.parity.setdefault(group_id, {})[index] = data
+        self.parity_bytes += len(data)
+        self.last_activity = time.time()
+        self._try_recover(group_id)
+        return True
+
+    def _drop_parity(self, group_id: int):
+        group = self.parity.pop(group_id, None)
+        if group:
+            self.parity_bytes -= sum(len(d) for d in group.values())
+
+    def _try_recover(self, group_id: int) -> int:
+        """Reconstruye los chunks perdidos del grupo si hay paridad suficiente"""
+        first, end = group_bounds(group_id, self.total_chunks, self.fec.group_size)
+        missing = [i for i in range(first, end) if i in self.missing_chunks]
+        parity = self.parity.get(group_id, {})
+        if not missing:
+            self._drop_parity(group_id)
+            return 0
+        if len(missing) > len(parity):
+            return 0
+        data = {i - first: self.received[i] for i in range(first, end) if i in self.received}
+        try:
+            rebuilt = recover_group(data, parity, end - first, self.chunk_size, self.fec)
+        except ValueError:
+            return 0
+        for local, chunk in rebuilt.items():
+            chunk_id = first + local
+            offset = chunk_id * self.chunk_size
+            length = min(self.chunk_size, self.total_len - offset)
+            self._store(chunk_id, offset, chunk[:length])
+            self.recovered_chunks.add(chunk_id)
+        # Grupo completo: su paridad ya no sirve
+        self._drop_parity(group_id)
+        return len(rebuilt)
+
+    def recover_missing(self) -> int:
+        """Intenta reconstruir todos los grupos incompletos; retorna chunks recuperados"""
+        if self.fec is None:
+            return 0
+        groups = {group_of(i, self.fec.group_size) for i in self.missing_chunks}
+        return sum(self._try_recover(g) for g in groups)
 
     def add_chunk(self, chunk_id: int, offset: int, data: bytes, metadata: Optional[Dict] = None) -> bool:
         """
@@ -158,18 +810,66 @@ class Reassembler:
         Retorna True si es un chunk nuevo, False si ya existía.
         """
         if chunk_id in self.received:
+            # Retransmisión de un chunk ya recibido
+            self.duplicates += 1
+            self.progress.update(retransmits=1)
             return False
         
         if chunk_id < 0 or chunk_id >= self.total_chunks:
             raise ValueError(f"Invalid chunk_id: {chunk_id}")
         
-        self.received[chunk_id] = data
+        if offset < 0 or offset + len(data) > self.total_len:
+            raise ValueError(f"Invalid offset: {offset}")
+
+        if self.bytes_received + len(data) > self.total_len:
+            # Chunks solapados: retenerlos superaría el tamaño reservado
+            raise ValueError(f"Chunk {chunk_id} excede el tamaño total ({self.total_len} bytes)")
+        
+        self._store(chunk_id, offset, data)
         if metadata:
             self.metadata[chunk_id] = metadata
         
-        self.missing_chunks.discard(chunk_id)
+        if self.fec is not None:
+            self._try_recover(group_of(chunk_id, self.fec.group_size))
         return True
 
+    def _store(self, chunk_id: int, offset: int, data: bytes):
+        """Registra un chunk y actualiza el buffer parcial y el prefijo contiguo"""
+        if self._partial is not None:
+            self._partial[offset:offset + len(data)] = data
+        self.received[chunk_id] = self._retain(offset, data)
+        self.offsets[chunk_id] = offset
+        self.missing_chunks.discard(chunk_id)
+        self.last_activity = time.time()
+        self.bytes_received += len(data)
+        self.progress.update(len(self.received), self.bytes_received)
+        if self.on_store is not None:
+            self.on_store(offset, data)
+        # Los chunk_ids crecen con el offset: avanzar mientras no haya huecos
+        while self._prefix_next in self.received and self.offsets[self._prefix_next] == self.contiguous_len:
+            self.contiguous_len += len(self.received[self._prefix_next])
+            self._prefix_next += 1
+
+    def _retain(self, offset: int, data: bytes):
+        """
+        Objeto que se guarda en received para el chunk: el propio payload o,
+        si ya existe el buffer parcial, una vista sobre él (sin segunda copia)
+        """
+        if self._partial is not None:
+            return memoryview(self._partial)[offset:offset + len(data)]
+        return data
+
+    def _partial_buffer(self) -> bytearray:
+        if self._partial is None:
+            # Primer uso: volcar lo ya recibido y cambiar los payloads por
+            # vistas sobre el buffer; a partir de aquí _store lo mantiene
+            self._partial = bytearray(self.total_len)
+            for chunk_id, data in self.received.items():
+                offset = self.offsets[chunk_id]
+                self._partial[offset:offset + len(data)] = data
+                self.received[chunk_id] = memoryview(self._partial)[offset:offset + len(data)]
+        return self._partial
+
     def get_missing_chunks(self) -> List[int]:
         """Retorna la lista de chunks faltantes"""
         return sorted(list(self.missing_chunks))
@@ -213,28 +913,64 @@ class Reassembler:
     def assemble_partial(self) -> bytes:
         """
         Ensambla chunks parciales, rellenando huecos con zeros.
-        Útil para visualizar archivos parcialmente recibidos.
+        Cada chunk se coloca en su offset real, así que los bytes posteriores a
+        un hueco quedan en su posición correcta. El buffer se mantiene de forma
+        incremental, pero cada llamada copia el resultado entero: para
+        escribirlo o decodificarlo, mejor partial_view().
         """
         if not self.received:
             return b''
-        
-        # Calcular tamaño promedio de chunk
-        if self.received:
-            avg_chunk_size = sum(len(data) for data in self.received.values()) // len(self.received)
-        else:
-            avg_chunk_size = self.total_len // self.total_chunks
-        
-        out = bytearray()
-        for i in range(self.total_chunks):
-            part = self.received.get(i)
-            if part is None:
-                # Rellenar con zeros
-                expected_size = min(avg_chunk_size, self.total_len - len(out))
-                out.extend(b'\x00' * expected_size)
-            else:
-                out.extend(part)
-        
-        return bytes(out)[:self.total_len]
+        return bytes(self._partial_buffer())
+
+    def partial_view(self) -> memoryview:
+        """Vista de solo lectura (sin copia) del buffer parcial, que sigue actualizándose"""
+        return memoryview(self._partial_buffer()).toreadonly()
+
+    def contiguous_prefix(self) -> memoryview:
+        """Prefijo más largo recibido sin huecos desde el byte 0 (sin copia)"""
+        return self.partial_view()[:self.contiguous_len]
+
+    def preview(self, max_size: Tuple[int, int] = (512, 512), fmt: str = "JPEG",
+                min_interval: float = 0.5) -> Optional[bytes]:
+        """
+        Vista previa progresiva de la imagen con lo recibido hasta ahora.
+        Decodifica con Pillow el prefijo contiguo y cachea el resultado; como
+        mucho se regenera una vez cada min_interval segundos.
+        Retorna None si aún no hay datos suficientes para decodificar la cabecera.
+        """
+        if self._preview is None:
+            from src.transporte.preview import ProgressivePreview
+            self._preview = ProgressivePreview(max_size, fmt, min_interval)
+        return self._preview.render(self.contiguous_prefix())
+
+    def save(self, path) -> bool:
+        """
+        Escribe el archivo completo en path; retorna False si faltan chunks.
+        Se escribe en un temporal y se renombra, así un destino que sea un hard
+        link (p. ej. del almacén de deduplicación) se reemplaza sin modificarlo.
+        """
+        assembled = self.assemble()
+        if assembled is None:
+            return False
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(assembled)
+        os.replace(tmp, path)
+        return True
+
+    def close(self):
+        """Libera los recursos del reensamblador (sin efecto en memoria)"""
+
+    def memory_footprint(self) -> int:
+        """Bytes de payload retenidos en memoria"""
+        if self._partial is not None:
+            # received solo tiene vistas sobre el buffer
+            return len(self._partial) + self.parity_bytes
+        return sum(len(d) for d in self.received.values()) + self.parity_bytes
+
+    def idle_time(self) -> float:
+        """Segundos desde el último chunk o paridad recibidos"""
+        return time.time() - self.last_activity
 
     def is_timed_out(self) -> bool:
         return (time.time() - self.start_time) > self.timeout
@@ -248,5 +984,9 @@ class Reassembler:
             "progress": self.get_progress(),
             "is_complete": self.is_complete(),
             "is_timed_out": self.is_timed_out(),
+            "recovered_chunks": len(self.recovered_chunks),
+            "contiguous_bytes": self.contiguous_len,
+            "duplicates": self.duplicates,
+            "rate": self.progress.rate,
             "elapsed_time": time.time() - self.start_time
         }
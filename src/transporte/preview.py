@@ -0,0 +1,96 @@
+import io
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Tuple
+
+# Vista previa progresiva de imágenes que aún se están recibiendo.
+# Se decodifica el prefijo contiguo recibido (tolerando que esté truncado) y
+# se re-codifica como miniatura. El resultado se cachea y solo se regenera
+# cuando llegaron bytes nuevos y pasó min_interval desde la última vez, así
+# que llamar a render() en cada chunk no vuelve a decodificar el archivo.
+# En JPEG se usa draft() para decodificar directamente a escala reducida.
+#
+# Tolerar el truncado exige ImageFile.LOAD_TRUNCATED_IMAGES, que es global en
+# Pillow. Las vistas previas lo activan dentro de truncated_decoding() y el
+# resto de decodificaciones (miniaturas, validación) corren dentro de
+# strict_decoding(): las de un mismo tipo pueden ir en paralelo en varios
+# hilos, pero nunca a la vez que las del otro, así que nadie ve cambiar el
+# flag a mitad de una decodificación.
+
+_mode_lock = threading.Condition()
+_active = {True: 0, False: 0}       # Decodificaciones en curso por valor del flag
+
+
+@contextmanager
+def _decoding(truncated: bool):
+    from PIL import ImageFile
+    with _mode_lock:
+        _mode_lock.wait_for(lambda: _active[not truncated] == 0)
+        if _active[truncated] == 0:
+            ImageFile.LOAD_TRUNCATED_IMAGES = truncated
+        _active[truncated] += 1
+    try:
+        yield
+    finally:
+        with _mode_lock:
+            _active[truncated] -= 1
+            if _active[truncated] == 0:
+                if truncated:
+                    ImageFile.LOAD_TRUNCATED_IMAGES = False
+                _mode_lock.notify_all()
+
+
+def truncated_decoding():
+    """Contexto para decodificar imágenes incompletas (LOAD_TRUNCATED_IMAGES activo)"""
+    return _decoding(True)
+
+
+def strict_decoding():
+    """Contexto para decodificar imágenes completas sin que una vista previa active el truncado"""
+    return _decoding(False)
+
+
+class ProgressivePreview:
+    def __init__(self, max_size: Tuple[int, int] = (512, 512), fmt: str = "JPEG",
+                 min_interval: float = 0.5):
+        self.max_size = max_size
+        self.fmt = fmt
+        self.min_interval = min_interval
+        self._cached: Optional[bytes] = None
+        self._cached_at_len = -1
+        self._last_render = 0.0
+
+    def render(self, prefix: memoryview, force: bool = False) -> Optional[bytes]:
+        """
+        Retorna la vista previa codificada (fmt, reducida a max_size) del prefijo.
+        Reutiliza la última si no llegaron bytes nuevos o si no pasó min_interval.
+        Retorna None si aún no se puede decodificar la cabecera de la imagen.
+        """
+        now = time.time()
+        if self._cached is not None and not force:
+            if len(prefix) == self._cached_at_len or now - self._last_render < self.min_interval:
+                return self._cached
+        if not prefix:
+            return self._cached
+
+        from PIL import Image
+        try:
+            with truncated_decoding(), Image.open(io.BytesIO(prefix)) as img:
+                if img.format == "JPEG":
+                    img.draft("RGB", self.max_size)
+                img.load()
+                thumb = img.copy()
+            thumb.thumbnail(self.max_size)
+            if self.fmt.upper() == "JPEG" and thumb.mode not in ("RGB", "L"):
+                thumb = thumb.convert("RGB")
+            out = io.BytesIO()
+            thumb.save(out, self.fmt)
+        except Exception:
+            # Cabecera incompleta o formato no reconocido todavía
+            return self._cached
+
+        self._cached = out.getvalue()
+        self._cached_at_len = len(prefix)
+        self._last_render = now
+        return self._cached
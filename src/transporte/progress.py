@@ -0,0 +1,146 @@
+import asyncio
+import time
+from dataclasses import dataclass, asdict
+from typing import AsyncIterator, Callable, List, Optional
+
+# Progreso de transferencias como flujo de eventos.
+#
+# Emisores y receptores llaman a ProgressTracker.update() en cada chunk, que
+# es barato: solo se construye y publica un evento cada min_interval segundos
+# (o al terminar). Cada suscriptor asíncrono tiene una cola de un elemento que
+# guarda únicamente el último evento, así que un consumidor lento (p. ej. un
+# WebSocket) nunca acumula eventos viejos: recibe siempre el estado más reciente.
+
+
+@dataclass
+class ProgressEvent:
+    transfer_id: Optional[str]
+    name: Optional[str]
+    chunks_done: int
+    total_chunks: int
+    bytes_done: int
+    total_bytes: int
+    rate: float                 # Bytes/s (media exponencial)
+    eta: Optional[float]        # Segundos restantes estimados
+    retransmits: int
+    elapsed: float
+    done: bool
+
+    @property
+    def percent(self) -> float:
+        if self.total_chunks:
+            return 100.0 * self.chunks_done / self.total_chunks
+        return 100.0 * self.bytes_done / self.total_bytes if self.total_bytes else 100.0
+
+    def to_dict(self):
+        data = asdict(self)
+        data["percent"] = self.percent
+        return data
+
+
+class ProgressTracker:
+    def __init__(self, total_chunks: int, total_bytes: int, transfer_id: Optional[str] = None,
+                 name: Optional[str] = None, min_interval: float = 0.25, alpha: float = 0.3):
+        self.total_chunks = total_chunks
+        self.total_bytes = total_bytes
+        self.transfer_id = transfer_id
+        self.name = name
+        self.min_interval = min_interval
+        self.alpha = alpha
+        self.chunks_done = 0
+        self.bytes_done = 0
+        self.retransmits = 0
+        self.rate = 0.0
+        self.done = False
+        self.start_time = time.monotonic()
+        self._last_publish = 0.0
+        self._last_bytes = 0
+        self._last_sample = self.start_time
+        self._listeners: List[Callable[[ProgressEvent], None]] = []
+        self._queues: List[asyncio.Queue] = []
+        self.last_event: Optional[ProgressEvent] = None
+
+    def update(self, chunks_done: Optional[int] = None, bytes_done: Optional[int] = None,
+               retransmits: int = 0, done: bool = False):
+        """
+        Registra avance (valores absolutos) y reintentos (incremento).
+        Publica un evento si pasó min_interval desde el último o si terminó.
+        """
+        if chunks_done is not None:
+            self.chunks_done = chunks_done
+        if bytes_done is not None:
+            self.bytes_done = bytes_done
+        self.retransmits += retransmits
+        if done or (self.total_chunks and self.chunks_done >= self.total_chunks):
+            self.done = True
+        now = time.monotonic()
+        if self.done or now - self._last_publish >= self.min_interval:
+            self._publish(now)
+
+    def finish(self):
+        """Marca la transferencia como terminada (completa o no) y publica el estado final"""
+        self.done = True
+        self._publish(time.monotonic())
+
+    def _sample_rate(self, now: float):
+        dt = now - self._last_sample
+        if dt <= 0:
+            return
+        sample = (self.bytes_done - self._last_bytes) / dt
+        self.rate = sample if self.rate == 0 else (1 - self.alpha) * self.rate + self.alpha * sample
+        self._last_bytes = self.bytes_done
+        self._last_sample = now
+
+    def snapshot(self) -> ProgressEvent:
+        remaining = max(0, self.total_bytes - self.bytes_done)
+        return ProgressEvent(
+            transfer_id=self.transfer_id, name=self.name,
+            chunks_done=self.chunks_done, total_chunks=self.total_chunks,
+            bytes_done=self.bytes_done, total_bytes=self.total_bytes,
+            rate=self.rate, eta=(remaining / self.rate) if self.rate > 0 else None,
+            retransmits=self.retransmits, elapsed=time.monotonic() - self.start_time,
+            done=self.done)
+
+    def _publish(self, now: float):
+        self._sample_rate(now)
+        self._last_publish = now
+        event = self.snapshot()
+        if self.last_event is not None and self.last_event.done:
+            return
+        self.last_event = event
+        for listener in list(self._listeners):
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"[PROGRESS] Error en listener: {e}")
+        for queue in self._queues:
+            # Coalescer: descartar el evento pendiente que nadie leyó
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def add_listener(self, callback: Callable[[ProgressEvent], None]):
+        """Suscripción síncrona: callback(evento) en cada publicación"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[ProgressEvent], None]):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    async def subscribe(self) -> AsyncIterator[ProgressEvent]:
+        """
+        Itera los eventos de progreso hasta el final de la transferencia.
+        Si el consumidor se retrasa solo ve el evento más reciente.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        if self.last_event is not None:
+            queue.put_nowait(self.last_event)
+        self._queues.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                yield event
+                if event.done:
+                    return
+        finally:
+            self._queues.remove(queue)
@@ -0,0 +1,237 @@
+import asyncio
+import mmap
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from src.transporte.fragmentation import Reassembler, count_chunks
+
+
+class TransferRejected(Exception):
+    """No hay presupuesto de memoria o disco para aceptar la transferencia"""
+
+
+class SpillReassembler(Reassembler):
+    """
+    Reensamblador respaldado por disco: los chunks se escriben directamente en
+    un archivo mapeado en memoria (mmap) en su offset, así que los datos viven
+    en la caché de páginas del sistema y no en el heap del proceso.
+    received guarda vistas sobre el mapeo en lugar de copias del payload.
+    """
+
+    def __init__(self, total_len: int, total_chunks: int, spill_path, timeout: float = 10.0):
+        super().__init__(total_len, total_chunks, timeout=timeout)
+        self.spill_path = Path(spill_path)
+        self._file = open(self.spill_path, 'w+b')
+        self._file.truncate(total_len)
+        self._partial = mmap.mmap(self._file.fileno(), total_len) if total_len else bytearray()
+
+    def memory_footprint(self) -> int:
+        # Los datos están en el mapeo; solo la paridad FEC vive en el heap
+        return self.parity_bytes
+
+    def save(self, path) -> bool:
+        """Mueve el archivo de spill a path sin volver a leerlo"""
+        if not self.is_complete():
+            return False
+        self.close(remove=False)
+        os.replace(self.spill_path, path)
+        return True
+
+    def save_partial(self, path):
+        """
+        Mueve el archivo de spill (huecos a cero) a path sin copiarlo al heap;
+        assemble_partial() haría bytes() de todo el mapeo.
+        """
+        self.close(remove=False)
+        os.replace(self.spill_path, path)
+
+    def close(self, remove: bool = True):
+        if self._file.closed:
+            return
+        # Soltar las vistas exportadas antes de cerrar el mmap
+        self.received.clear()
+        self.parity.clear()
+        if isinstance(self._partial, mmap.mmap):
+            self._partial.flush()
+            self._partial.close()
+        self._file.close()
+        if remove:
+            try:
+                self.spill_path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class _Transfer:
+    def __init__(self, reassembler: Reassembler, reserved: int, idle_timeout: float,
+                 on_expire: Optional[Callable[[], None]], spilled: int = 0):
+        self.reassembler = reassembler
+        self.reserved = reserved
+        self.spilled = spilled
+        self.idle_timeout = idle_timeout
+        self.on_expire = on_expire
+
+
+class ReassemblyManager:
+    """
+    Registro de las transferencias en curso, indexadas por transfer_id.
+
+    Cada transferencia en memoria reserva su tamaño total contra un
+    presupuesto global (memory_budget). Cuando no cabe, se reensambla en disco
+    si hay spill_dir, o se rechaza con TransferRejected. El disco también está
+    acotado: ninguna transferencia puede superar max_transfer_size y las que
+    están en disco no pueden sumar más de spill_budget. total_chunks tiene que
+    ser coherente con el tamaño (construir el reensamblador cuesta memoria por
+    chunk) y la paridad FEC retenida por transferencia no pasa de
+    max_parity_bytes. Una tarea periódica
+    expira las transferencias sin actividad durante más de su timeout y libera
+    su reserva.
+    """
+
+    def __init__(self, memory_budget: int = 256 * 1024 * 1024, spill_dir=None,
+                 expiry_interval: float = 1.0, max_transfer_size: int = 4 * 1024 ** 3,
+                 spill_budget: int = 8 * 1024 ** 3, max_parity_bytes: int = 64 * 1024 * 1024):
+        self.memory_budget = memory_budget
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.expiry_interval = expiry_interval
+        self.max_transfer_size = max_transfer_size
+        self.spill_budget = spill_budget
+        self.max_parity_bytes = max_parity_bytes
+        self.transfers: Dict[str, _Transfer] = {}
+        self.reserved = 0
+        self.spilled = 0
+        self.expired = 0
+        self.rejected = 0
+        self._expiry_task: Optional[asyncio.Task] = None
+
+    def open(self, transfer_id: Optional[str], total_len: int, total_chunks: int,
+             timeout: float = 10.0, on_expire: Optional[Callable[[], None]] = None,
+             chunk_size: Optional[int] = None) -> Reassembler:
+        """
+        Crea el reensamblador de una transferencia nueva.
+        timeout es el tiempo máximo sin recibir chunks antes de expirarla.
+        Con chunk_size, total_chunks tiene que ser exactamente el que le corresponde.
+        """
+        transfer_id = transfer_id or uuid.uuid4().hex
+        if transfer_id in self.transfers:
+            raise ValueError(f"Transferencia duplicada: {transfer_id}")
+        if total_len < 0:
+            raise ValueError(f"Tamaño inválido: {total_len}")
+        if not 0 < total_chunks <= max(1, total_len) and not (total_len == total_chunks == 0):
+            raise ValueError(f"Número de chunks inválido: {total_chunks} para {total_len} bytes")
+        if chunk_size and count_chunks(total_len, chunk_size) != total_chunks:
+            raise ValueError(f"Número de chunks inválido: {total_chunks} para {total_len} bytes "
+                             f"en chunks de {chunk_size}")
+        if total_len > self.max_transfer_size:
+            self.rejected += 1
+            raise TransferRejected(
+                f"Transferencia demasiado grande ({total_len} > {self.max_transfer_size} bytes)")
+
+        spilled = 0
+        if self.reserved + total_len <= self.memory_budget:
+            reassembler = Reassembler(total_len, total_chunks, timeout=timeout)
+            reserved = total_len
+        elif self.spill_dir is not None:
+            if self.spilled + total_len > self.spill_budget:
+                self.rejected += 1
+                raise TransferRejected(
+                    f"Presupuesto de disco agotado ({self.spilled}/{self.spill_budget} bytes)")
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            # El nombre del archivo nunca sale del transfer_id (puede venir de fuera)
+            spill_path = self.spill_dir / f"{uuid.uuid4().hex}.part"
+            reassembler = SpillReassembler(total_len, total_chunks, spill_path, timeout=timeout)
+            reserved = 0
+            spilled = total_len
+        else:
+            self.rejected += 1
+            raise TransferRejected(
+                f"Presupuesto de memoria agotado ({self.reserved}/{self.memory_budget} bytes)")
+
+        reassembler.transfer_id = transfer_id
+        reassembler.max_parity_bytes = min(total_len, self.max_parity_bytes)
+        reassembler.progress.transfer_id = transfer_id
+        self.transfers[transfer_id] = _Transfer(reassembler, reserved, timeout, on_expire, spilled)
+        self.reserved += reserved
+        self.spilled += spilled
+        return reassembler
+
+    def get(self, transfer_id: str) -> Optional[Reassembler]:
+        transfer = self.transfers.get(transfer_id)
+        return transfer.reassembler if transfer else None
+
+    def release(self, transfer_id: str):
+        """Da por terminada una transferencia y libera su reserva"""
+        transfer = self.transfers.pop(transfer_id, None)
+        if transfer is None:
+            return
+        self.reserved -= transfer.reserved
+        self.spilled -= transfer.spilled
+        transfer.reassembler.close()
+
+    def expire(self) -> int:
+        """Expira las transferencias inactivas; retorna cuántas se eliminaron"""
+        stale = [tid for tid, t in self.transfers.items()
+                 if t.reassembler.idle_time() > t.idle_timeout]
+        for tid in stale:
+            transfer = self.transfers[tid]
+            print(f"[REASSEMBLY] Transferencia {tid} expirada tras {transfer.idle_timeout:.1f}s sin actividad")
+            self.release(tid)
+            self.expired += 1
+            if transfer.on_expire:
+                try:
+                    transfer.on_expire()
+                except Exception as e:
+                    print(f"[REASSEMBLY] Error en on_expire de {tid}: {e}")
+        return len(stale)
+
+    async def _expiry_loop(self):
+        while True:
+            await asyncio.sleep(self.expiry_interval)
+            self.expire()
+
+    def start(self):
+        """Arranca la tarea de expiración periódica en el event loop actual"""
+        if self._expiry_task is None or self._expiry_task.done():
+            self._expiry_task = asyncio.get_running_loop().create_task(self._expiry_loop())
+
+    async def stop(self):
+        if self._expiry_task is not None:
+            self._expiry_task.cancel()
+            try:
+                await self._expiry_task
+            except asyncio.CancelledError:
+                pass
+            self._expiry_task = None
+
+    def get_status(self, transfer_id: str) -> Optional[Dict]:
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            return None
+        status = transfer.reassembler.get_status()
+        status.update({
+            "transfer_id": transfer_id,
+            "spilled": isinstance(transfer.reassembler, SpillReassembler),
+            "reserved_bytes": transfer.reserved,
+            "memory_bytes": transfer.reassembler.memory_footprint(),
+            "idle_time": transfer.reassembler.idle_time(),
+        })
+        return status
+
+    def get_stats(self) -> Dict:
+        """Estado global del gestor"""
+        return {
+            "active_transfers": len(self.transfers),
+            "reserved_bytes": self.reserved,
+            "memory_budget": self.memory_budget,
+            "spilled_bytes": self.spilled,
+            "spill_budget": self.spill_budget,
+            "spilled_transfers": sum(isinstance(t.reassembler, SpillReassembler)
+                                     for t in self.transfers.values()),
+            "expired": self.expired,
+            "rejected": self.rejected,
+            "transfers": {tid: self.get_status(tid) for tid in self.transfers},
+            "timestamp": time.time(),
+        }
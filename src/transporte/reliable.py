@@ -1,11 +1,12 @@
 import asyncio
 import struct
 import time
-import json
 import random
-from typing import Dict, Optional, Callable, Any
+from typing import Dict, List, Optional, Callable, Any
 from dataclasses import dataclass
 
+from src.transporte.codec import Codec, default_codec, detect_codec
+
 HEADER_FMT = "!I"  # 4 bytes para longitud del mensaje
 
 # Configuración de transporte confiable
@@ -17,8 +18,9 @@ class ReliableConfig:
     loss_simulation: float = 0.0  # Tasa de pérdida simulada (0.0-1.0)
 
 class ReliableTransport:
-    def __init__(self, config: ReliableConfig = None):
+    def __init__(self, config: ReliableConfig = None, codec: Optional[Codec] = None):
         self.config = config or ReliableConfig()
+        self.codec = codec or default_codec()
         self.seq_num = 0
         self.pending_acks: Dict[int, asyncio.Event] = {}
         self.received_packets: Dict[int, bytes] = {}
@@ -31,14 +33,17 @@ class ReliableTransport:
         seq = self.seq_num
         self.seq_num += 1
         
+        # JSON no admite bytes: van en hex; msgpack los lleva tal cual
+        if isinstance(data, bytes) and not self.codec.binary:
+            data = data.hex()
         packet = {
             "type": packet_type,
             "seq": seq,
-            "data": data.hex() if isinstance(data, bytes) else data,
+            "data": data,
             "timestamp": time.time()
         }
         
-        packet_bytes = json.dumps(packet).encode('utf-8')
+        packet_bytes = self.codec.dumps(packet)
         
         # Crear evento para esperar ACK
         ack_event = asyncio.Event()
@@ -76,28 +81,67 @@ class ReliableTransport:
         if seq in self.pending_acks:
             self.pending_acks[seq].set()
     
-    async def send_ack(self, writer: asyncio.StreamWriter, seq: int):
-        """Envía ACK para un paquete recibido"""
+    async def send_ack(self, writer: asyncio.StreamWriter, seq: int, codec: Optional[Codec] = None):
+        """Envía ACK para un paquete recibido (en el codec del paquete si se indica)"""
         ack_packet = {
             "type": "ack",
             "seq": seq,
             "timestamp": time.time()
         }
-        await send_message(writer, json.dumps(ack_packet).encode('utf-8'))
+        await send_message(writer, (codec or self.codec).dumps(ack_packet))
         print(f"[RELIABLE] ACK enviado para seq={seq}")
 
+def write_message(writer: asyncio.StreamWriter, data: bytes):
+    """Encola un mensaje con encabezado de longitud sin esperar drain()"""
+    writer.write(struct.pack(HEADER_FMT, len(data)) + data)
+
 async def send_message(writer: asyncio.StreamWriter, data: bytes):
     """Envía mensaje con encabezado de longitud"""
     header = struct.pack(HEADER_FMT, len(data))
     writer.write(header + data)
     await writer.drain()
 
+async def send_message_stream(writer: asyncio.StreamWriter, read, size: int, block_size: int = 64 * 1024):
+    """
+    Envía un mensaje de size bytes leído por bloques con await read(n), sin
+    tenerlo entero en memoria. Lanza ValueError si la fuente se acaba antes de tiempo.
+    """
+    writer.write(struct.pack(HEADER_FMT, size))
+    sent = 0
+    while sent < size:
+        data = await read(min(block_size, size - sent))
+        if not data:
+            raise ValueError(f"Fuente truncada: {sent}/{size} bytes")
+        writer.write(data)
+        sent += len(data)
+        await writer.drain()
+    await writer.drain()
+
 async def read_message(reader: asyncio.StreamReader) -> bytes:
     """Lee mensaje con encabezado de longitud"""
     header = await reader.readexactly(4)
     (length,) = struct.unpack(HEADER_FMT, header)
     return await reader.readexactly(length)
 
+def _message_buffered(reader: asyncio.StreamReader) -> bool:
+    """True si el buffer del reader ya tiene un mensaje completo (leerlo no espera)"""
+    buf = reader._buffer    # StreamReader no expone cuánto tiene ya recibido
+    if len(buf) < 4:
+        return False
+    (length,) = struct.unpack_from(HEADER_FMT, buf)
+    return len(buf) >= 4 + length
+
+async def read_messages(reader: asyncio.StreamReader, limit: int) -> List[bytes]:
+    """
+    Lee un mensaje (esperando si hace falta) y, sin volver a esperar, los
+    siguientes que ya estén completos en el buffer, hasta limit. Solo la
+    primera lectura puede fallar por conexión cerrada.
+    """
+    messages = [await read_message(reader)]
+    while len(messages) < limit and _message_buffered(reader):
+        messages.append(await read_message(reader))
+    return messages
+
 async def start_server(host: str, port: int, on_message: Callable):
     """Inicia servidor con manejo mejorado"""
     server = await asyncio.start_server(
@@ -118,36 +162,39 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
         while True:
             raw_data = await read_message(reader)
             
+            # Paquetes del protocolo confiable (JSON o msgpack); los chunks y
+            # frames binarios se reconocen por el primer byte sin decodificarlos
             try:
-                # Intentar parsear como JSON (para paquetes del protocolo confiable)
-                packet = json.loads(raw_data.decode('utf-8'))
-                
-                if packet.get("type") == "ack":
-                    # Manejar ACK
-                    transport.handle_ack(packet["seq"])
-                    continue
-                elif packet.get("type") == "data":
-                    # Paquete de datos - enviar ACK y procesar
-                    seq = packet["seq"]
-                    await transport.send_ack(writer, seq)
-                    
-                    # Convertir datos de hex a bytes si es necesario
-                    data = packet.get("data", "")
-                    if isinstance(data, str):
-                        try:
-                            data = bytes.fromhex(data)
-                        except ValueError:
-                            data = data.encode('utf-8')
-                    
-                    await on_message(data, writer, transport)
-                else:
-                    # Otro tipo de paquete
-                    await on_message(raw_data, writer, transport)
-                    
-            except (json.JSONDecodeError, UnicodeDecodeError):
-                # No es JSON válido, tratar como datos raw
+                codec = detect_codec(raw_data)
+                packet = codec.loads(raw_data) if codec is not None else None
+            except ValueError:
+                # No es JSON/msgpack válido (o no está instalado), tratar como datos raw
+                packet = None
+            if not isinstance(packet, dict):
                 await on_message(raw_data, writer, transport)
-                
+                continue
+
+            if packet.get("type") == "ack":
+                # Manejar ACK
+                transport.handle_ack(packet["seq"])
+            elif packet.get("type") == "data":
+                # Paquete de datos - enviar ACK y procesar
+                seq = packet["seq"]
+                await transport.send_ack(writer, seq, codec)
+
+                # Convertir datos de hex a bytes si es necesario
+                data = packet.get("data", "")
+                if isinstance(data, str):
+                    try:
+                        data = bytes.fromhex(data)
+                    except ValueError:
+                        data = data.encode('utf-8')
+
+                await on_message(data, writer, transport)
+            else:
+                # Otro tipo de paquete
+                await on_message(raw_data, writer, transport)
+
     except asyncio.IncompleteReadError:
         print(f"[Transporte] Cliente {peer} desconectado.")
     except Exception as e:
@@ -176,7 +223,7 @@ async def send_file_reliable(host: str, port: int, filepath: str,
             "type": "file"
         }
         
-        success = await transport.send_reliable(writer, json.dumps(metadata).encode(), "metadata")
+        success = await transport.send_reliable(writer, transport.codec.dumps(metadata), "metadata")
         if not success:
             return False
         
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional, Set, Union
+
+# Capa de almacenamiento asíncrona para los archivos recibidos.
+# Toda la E/S de disco (escrituras, fsync, renombrados, validación con Pillow)
+# corre en un pool de hilos acotado, así que una escritura grande no detiene
+# el event loop ni al resto de conexiones. Los archivos se escriben en un
+# temporal junto al destino y se publican con os.replace, de modo que nunca
+# queda un archivo a medio escribir con el nombre final.
+
+PathLike = Union[str, os.PathLike]
+
+
+def _fsync_dir(path: Path):
+    """Persiste la entrada de directorio tras un rename (solo POSIX)"""
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _temp_path(path: Path, suffix: str = "tmp") -> Path:
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex}.{suffix}")
+
+
+class IncrementalFile:
+    """
+    Archivo destino que se escribe por posiciones a medida que llegan los
+    chunks. submit() acumula los rangos contiguos (hasta coalesce_bytes) y
+    encola cada bloque como una sola escritura en el pool, así que los chunks
+    pequeños no cuestan una tarea y un salto al pool cada uno;
+    wait_capacity() aplica contrapresión si hay demasiados bytes pendientes.
+    finalize() espera lo pendiente, hace fsync y renombra al destino.
+    """
+
+    def __init__(self, storage: "AsyncStorage", path: PathLike, size: int,
+                 max_pending_bytes: int = 8 * 1024 * 1024, coalesce_bytes: int = 256 * 1024):
+        self.storage = storage
+        self.path = Path(path)
+        self.size = size
+        self.tmp_path = _temp_path(self.path, "part")
+        self.max_pending_bytes = max_pending_bytes
+        self.coalesce_bytes = coalesce_bytes
+        self.bytes_written = 0
+        self.committed = False
+        self._pending: Set[asyncio.Future] = set()
+        self._pending_bytes = 0
+        self._buffer = bytearray()       # Rango contiguo aún sin encolar
+        self._buffer_offset = 0
+        self._lock = threading.Lock()    # Para seek+write donde no hay os.pwrite
+        self._file = None
+        self._closed = False
+        self._error: Optional[BaseException] = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.tmp_path, 'w+b')
+            # Reservar el tamaño final: los chunks pueden llegar desordenados
+            self._file.truncate(self.size)
+
+    def _write_at(self, offset: int, data: bytes):
+        with self._lock:
+            self._open()
+            if hasattr(os, 'pwrite'):
+                view = memoryview(data)
+                while view:
+                    n = os.pwrite(self._file.fileno(), view, offset)
+                    view, offset = view[n:], offset + n
+            else:
+                self._file.seek(offset)
+                self._file.write(data)
+
+    def submit(self, offset: int, data: bytes):
+        """Encola la escritura de data en offset (apto como Reassembler.on_store)"""
+        if self._closed:
+            return
+        if self._buffer and offset != self._buffer_offset + len(self._buffer):
+            self._flush()
+        if not self._buffer:
+            self._buffer_offset = offset
+        self._buffer += data
+        if len(self._buffer) >= self.coalesce_bytes:
+            self._flush()
+
+    def _flush(self):
+        """Encola en el pool la escritura del rango acumulado"""
+        if not self._buffer:
+            return
+        data, offset = self._buffer, self._buffer_offset
+        self._buffer = bytearray()
+        future = asyncio.ensure_future(self.storage.run(self._write_at, offset, data))
+        self._pending.add(future)
+        self._pending_bytes += len(data)
+
+        def done(f, n=len(data)):
+            self._pending.discard(f)
+            self._pending_bytes -= n
+            if f.cancelled():
+                return
+            if f.exception() is not None:
+                self._error = self._error or f.exception()
+            else:
+                self.bytes_written += n
+        future.add_done_callback(done)
+
+    async def wait_capacity(self):
+        """Espera mientras haya más de max_pending_bytes sin escribir"""
+        while self._pending_bytes > self.max_pending_bytes and self._pending:
+            await asyncio.wait(set(self._pending), return_when=asyncio.FIRST_COMPLETED)
+        if self._error is not None:
+            raise self._error
+
+    async def _drain(self):
+        self._flush()
+        if self._pending:
+            await asyncio.gather(*set(self._pending), return_exceptions=True)
+        if self._error is not None:
+            raise self._error
+
+    def _commit(self, dest: Path, fsync: bool):
+        with self._lock:
+            self._open()
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+        os.replace(self.tmp_path, dest)
+        if fsync:
+            _fsync_dir(dest.parent)
+
+    async def finalize(self, dest: Optional[PathLike] = None) -> Path:
+        """Publica el archivo en dest (por defecto el destino original) de forma atómica"""
+        dest = Path(dest) if dest is not None else self.path
+        await self._drain()
+        self._closed = True
+        await self.storage.run(self._commit, dest, self.storage.fsync)
+        self.committed = True
+        return dest
+
+    def _discard(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+        try:
+            self.tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+
+    async def abort(self):
+        """Descarta el temporal sin publicar nada (sin efecto tras finalize)"""
+        if self.committed:
+            return
+        self._closed = True
+        self._buffer = bytearray()
+        await asyncio.gather(*set(self._pending), return_exceptions=True)
+        await self.storage.run(self._discard)
+
+
+class AsyncStorage:
+    def __init__(self, max_workers: int = 4, fsync: bool = True):
+        self.max_workers = max_workers
+        self.fsync = fsync
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+
+    async def run(self, fn: Callable, *args):
+        """Ejecuta una operación bloqueante de disco en el pool"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _write_atomic(self, path: Path, data: bytes):
+        tmp = _temp_path(path)
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        if self.fsync:
+            _fsync_dir(path.parent)
+
+    async def write_file(self, path: PathLike, data: bytes) -> Path:
+        """Escribe data en path de forma atómica (temporal + fsync + rename)"""
+        path = Path(path)
+        await self.run(self._write_atomic, path, data)
+        return path
+
+    async def read_file(self, path: PathLike) -> bytes:
+        return await self.run(Path(path).read_bytes)
+
+    def open_incremental(self, path: PathLike, size: int) -> IncrementalFile:
+        return IncrementalFile(self, path, size)
+
+    @staticmethod
+    def _verify_image(path: Path) -> bool:
+        from PIL import Image
+        from src.transporte.preview import strict_decoding
+        try:
+            with strict_decoding(), Image.open(path) as img:
+                img.verify()
+            return True
+        except Exception:
+            return False
+
+    async def validate_image(self, path: PathLike) -> bool:
+        """Comprueba con Pillow que el archivo sea una imagen válida, fuera del loop"""
+        return await self.run(self._verify_image, Path(path))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_default_storage: Optional[AsyncStorage] = None
+
+
+def get_storage() -> AsyncStorage:
+    """Capa de almacenamiento compartida por los servidores del proceso"""
+    global _default_storage
+    if _default_storage is None:
+        _default_storage = AsyncStorage()
+    return _default_storage
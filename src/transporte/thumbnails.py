@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+# Miniaturas y variantes web de las imágenes recibidas.
+#
+# Cada variante (tamaño máximo, formato y calidad) se genera con Pillow en un
+# pool de procesos, así que redimensionar fotos de varios MB no compite por
+# el GIL con el servidor. Los resultados se guardan en disco indexados por el
+# SHA-256 del original más el nombre de la variante: el mismo contenido con
+# otro nombre reutiliza la caché y un original reemplazado genera otra clave.
+# La caché tiene un tamaño máximo y expulsa las entradas menos usadas (LRU).
+
+PathLike = Union[str, os.PathLike]
+
+
+@dataclass(frozen=True)
+class Variant:
+    max_size: int          # Lado mayor en píxeles
+    fmt: str = "WEBP"      # WEBP o JPEG
+    quality: int = 80
+
+    @property
+    def media_type(self) -> str:
+        return "image/webp" if self.fmt == "WEBP" else "image/jpeg"
+
+    @property
+    def extension(self) -> str:
+        return "webp" if self.fmt == "WEBP" else "jpg"
+
+
+VARIANTS: Dict[str, Variant] = {
+    "thumb": Variant(400, "WEBP", 70),      # Galerías y chat (hasta 200 px a 2x)
+    "web": Variant(1600, "WEBP", 82),       # Vista ampliada en pantalla
+}
+
+
+def webp_supported() -> bool:
+    from PIL import features
+    return bool(features.check("webp"))
+
+
+def render_variant(path: str, max_size: int, fmt: str, quality: int) -> bytes:
+    """
+    Genera una variante de la imagen en path (se ejecuta en un proceso del
+    pool). fmt es el formato final: ThumbnailPipeline ya descartó WEBP si
+    Pillow no sabe codificarlo.
+    """
+    import io
+    from PIL import Image, ImageOps
+    from src.transporte.preview import strict_decoding
+
+    with strict_decoding(), Image.open(path) as img:
+        if img.format == "JPEG":
+            # Decodificar directamente a una escala cercana a la final
+            img.draft("RGB", (max_size, max_size))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=3.0)
+        if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        out = io.BytesIO()
+        if fmt == "JPEG":
+            img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        else:
+            img.save(out, "WEBP", quality=quality, method=4)
+    return out.getvalue()
+
+
+def file_digest(path: PathLike) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ThumbnailCache:
+    """Caché en disco con tamaño máximo y expulsión LRU (se usa desde hilos)"""
+
+    def __init__(self, root: PathLike, max_bytes: int = 256 * 1024 * 1024):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()   # clave -> bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._scan()
+
+    def _scan(self):
+        # Recuperar el orden de uso de una ejecución anterior (mtime se toca en cada acierto)
+        found = []
+        for path in self.root.glob("*/*"):
+            if path.name.startswith("."):
+                continue
+            st = path.stat()
+            found.append((st.st_mtime, path.relative_to(self.root).as_posix(), st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.total_bytes += size
+
+    @staticmethod
+    def key(file_hash: str, variant: str, variant_spec: Variant) -> str:
+        return f"{file_hash[:2]}/{file_hash}.{variant}.{variant_spec.extension}"
+
+    def get(self, key: str) -> Optional[Path]:
+        path = self.root / key
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._forget(key)
+            return None
+        return path
+
+    def put(self, key: str, data: bytes) -> Path:
+        path = self.root / key
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = len(data)
+            self.total_bytes += len(data)
+            self._evict(keep=key)
+        return path
+
+    def _forget(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _evict(self, keep: str):
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == keep:
+                self._entries.move_to_end(key)
+                continue
+            self._forget(key)
+            self.evictions += 1
+            try:
+                (self.root / key).unlink()
+            except FileNotFoundError:
+                pass
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class ThumbnailPipeline:
+    def __init__(self, cache_dir: PathLike, max_bytes: int = 256 * 1024 * 1024,
+                 max_workers: Optional[int] = None, variants: Optional[Dict[str, Variant]] = None):
+        self.cache = ThumbnailCache(cache_dir, max_bytes)
+        self.variants = dict(variants or VARIANTS)
+        if not webp_supported():
+            # Sin codificador WebP se genera JPEG, y así lo dicen la
+            # extensión en caché y el media_type con que se sirve
+            self.variants = {name: replace(spec, fmt="JPEG") if spec.fmt == "WEBP" else spec
+                             for name, spec in self.variants.items()}
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # Hash por ruta, válido mientras no cambien mtime ni tamaño
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.max_workers)
+        return self._executor
+
+    async def content_hash(self, path: PathLike) -> str:
+        st = await asyncio.to_thread(os.stat, path)
+        cached = self._hashes.get(str(path))
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        digest = await asyncio.to_thread(file_digest, path)
+        self._hashes[str(path)] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    async def get(self, path: PathLike, variant: str = "thumb") -> Tuple[Path, str]:
+        """
+        Retorna (ruta en caché, hash del original) de la variante de path,
+        generándola si hace falta. Peticiones simultáneas de la misma variante
+        comparten una única generación. Lanza KeyError si la variante no existe.
+        """
+        spec = self.variants[variant]
+        file_hash = await self.content_hash(path)
+        key = self.cache.key(file_hash, variant, spec)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            return cached, file_hash
+
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._generate(path, key, spec))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future), file_hash
+
+    async def _generate(self, path: PathLike, key: str, spec: Variant) -> Path:
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self._pool(), render_variant, str(path),
+                                          spec.max_size, spec.fmt, spec.quality)
+        return await asyncio.to_thread(self.cache.put, key, data)
+
+    async def generate_all(self, path: PathLike):
+        """Genera todas las variantes de una imagen recién recibida"""
+        results = await asyncio.gather(*(self.get(path, v) for v in self.variants), return_exceptions=True)
+        for variant, result in zip(self.variants, results):
+            if isinstance(result, Exception):
+                print(f"[THUMBS] No se pudo generar {variant} de {os.path.basename(path)}: {result}")
+
+    def get_stats(self) -> Dict:
+        return {**self.cache.get_stats(), "inflight": len(self._inflight)}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
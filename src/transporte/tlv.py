@@ -0,0 +1,224 @@
+import struct
+from typing import Dict, Tuple, Union
+
+from src.transporte.codec import Codec, UnsupportedCodec, decode, default_codec, detect_codec
+
+# Codificación TLV binaria compacta para metadatos de chunk y frames de control.
+# Cada entrada: tag (1) | longitud (varint) | valor (longitud bytes)
+# Las claves conocidas se codifican con un tag de 1 byte; el resto usa un tag
+# de extensión (0x80 | tipo) y lleva el nombre de la clave dentro del valor:
+# key_len (1) | key (utf-8) | valor
+
+KIND_UINT = 0
+KIND_SINT = 1
+KIND_FLOAT = 2
+KIND_STR = 3
+KIND_BYTES = 4
+KIND_BOOL = 5
+
+TAG_EXTENSION = 0x80
+
+# Registro de claves conocidas: nombre -> (tag, tipo)
+WELL_KNOWN_KEYS: Dict[str, Tuple[int, int]] = {
+    # Metadatos de imagen/chunk
+    "format": (1, KIND_STR),
+    "width": (2, KIND_UINT),
+    "height": (3, KIND_UINT),
+    "total_size": (4, KIND_UINT),
+    "compression": (5, KIND_STR),
+    "digest": (6, KIND_BYTES),
+    # Campos de frames de control (img_meta, ack, control)
+    "type": (16, KIND_STR),
+    "msg": (17, KIND_STR),
+    "name": (18, KIND_STR),
+    "size": (19, KIND_UINT),
+    "total_chunks": (20, KIND_UINT),
+    "chunk_id": (21, KIND_UINT),
+    "chunk_size": (22, KIND_UINT),
+    "timestamp": (23, KIND_FLOAT),
+    "mode": (24, KIND_STR),
+}
+_TAGS: Dict[int, Tuple[str, int]] = {tag: (key, kind) for key, (tag, kind) in WELL_KNOWN_KEYS.items()}
+
+# Prefijo de los frames de control binarios (los JSON empiezan por '{')
+CONTROL_MAGIC = b'IMGT'
+
+_FLOAT = struct.Struct("!d")
+
+Value = Union[int, float, str, bytes, bool]
+
+
+def _encode_varint(n: int, out: bytearray):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _decode_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise ValueError("Varint truncado")
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _kind_of(value: Value) -> int:
+    # bool antes que int: bool es subclase de int
+    if isinstance(value, bool):
+        return KIND_BOOL
+    if isinstance(value, int):
+        return KIND_UINT if value >= 0 else KIND_SINT
+    if isinstance(value, float):
+        return KIND_FLOAT
+    if isinstance(value, str):
+        return KIND_STR
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return KIND_BYTES
+    raise ValueError(f"Tipo no soportado en TLV: {type(value).__name__}")
+
+
+def _encode_value(value: Value, kind: int) -> bytes:
+    if kind == KIND_UINT:
+        out = bytearray()
+        _encode_varint(value, out)
+        return bytes(out)
+    if kind == KIND_SINT:
+        out = bytearray()
+        # zigzag sin límite de 64 bits (los varints tampoco lo tienen)
+        _encode_varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+        return bytes(out)
+    if kind == KIND_FLOAT:
+        return _FLOAT.pack(value)
+    if kind == KIND_STR:
+        return value.encode('utf-8')
+    if kind == KIND_BYTES:
+        return bytes(value)
+    if kind == KIND_BOOL:
+        return b'\x01' if value else b'\x00'
+    raise ValueError(f"Tipo TLV desconocido: {kind}")
+
+
+def _decode_value(raw: bytes, kind: int) -> Value:
+    if kind == KIND_UINT:
+        return _decode_varint(raw, 0)[0]
+    if kind == KIND_SINT:
+        n = _decode_varint(raw, 0)[0]
+        return (n >> 1) ^ -(n & 1)
+    if kind == KIND_FLOAT:
+        return _FLOAT.unpack(raw)[0]
+    if kind == KIND_STR:
+        return raw.decode('utf-8')
+    if kind == KIND_BYTES:
+        return raw
+    if kind == KIND_BOOL:
+        return raw != b'\x00'
+    raise ValueError(f"Tipo TLV desconocido: {kind}")
+
+
+def encode_tlv(fields: Dict[str, Value]) -> bytes:
+    """
+    Codifica un diccionario plano en TLV binario.
+    Soporta int, float, str, bytes y bool; las estructuras anidadas no.
+    """
+    out = bytearray()
+    for key, value in fields.items():
+        if value is None:
+            continue
+        kind = _kind_of(value)
+        known = WELL_KNOWN_KEYS.get(key)
+        if known is not None and known[1] == kind:
+            tag = known[0]
+            raw = _encode_value(value, kind)
+        else:
+            key_bytes = key.encode('utf-8')
+            if len(key_bytes) > 255:
+                raise ValueError(f"Clave demasiado larga: {key}")
+            tag = TAG_EXTENSION | kind
+            raw = bytes([len(key_bytes)]) + key_bytes + _encode_value(value, kind)
+        out.append(tag)
+        _encode_varint(len(raw), out)
+        out += raw
+    return bytes(out)
+
+
+def decode_tlv(buf: bytes) -> Dict[str, Value]:
+    """Decodifica un bloque TLV generado por encode_tlv"""
+    buf = bytes(buf)
+    fields: Dict[str, Value] = {}
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        tag = buf[pos]
+        length, pos = _decode_varint(buf, pos + 1)
+        if pos + length > end:
+            raise ValueError("Entrada TLV truncada")
+        raw = buf[pos:pos + length]
+        pos += length
+
+        if tag & TAG_EXTENSION:
+            key_len = raw[0] if raw else 0
+            key = raw[1:1 + key_len].decode('utf-8')
+            fields[key] = _decode_value(raw[1 + key_len:], tag & ~TAG_EXTENSION)
+        else:
+            known = _TAGS.get(tag)
+            if known is None:
+                raise ValueError(f"Tag TLV desconocido: {tag}")
+            fields[known[0]] = _decode_value(raw, known[1])
+    return fields
+
+
+def pack_control(fields: Dict[str, Value]) -> bytes:
+    """Empaqueta un frame de control (control, img_meta, ack...) en binario"""
+    return CONTROL_MAGIC + encode_tlv(fields)
+
+
+def is_binary_control(data: bytes) -> bool:
+    return data[:len(CONTROL_MAGIC)] == CONTROL_MAGIC
+
+
+def parse_control(data: bytes) -> Dict:
+    """
+    Decodifica un frame de control en cualquiera de sus formatos: binario
+    (prefijo CONTROL_MAGIC), JSON o msgpack (ver src/transporte/codec.py).
+    Lanza ValueError si no es un frame de control válido (UnsupportedCodec
+    si viene en un formato que no está instalado).
+    """
+    if is_binary_control(data):
+        return decode_tlv(data[len(CONTROL_MAGIC):])
+    try:
+        pkt = decode(data)
+    except UnsupportedCodec:
+        raise
+    except ValueError as e:
+        raise ValueError(f"Frame de control inválido: {e}")
+    if not isinstance(pkt, dict):
+        raise ValueError("Frame de control inválido")
+    return pkt
+
+
+def control_format(data: bytes) -> Union[bool, Codec]:
+    """
+    Formato de un frame de control recibido, para responder en el mismo
+    (se pasa tal cual como binary a encode_control).
+    """
+    if is_binary_control(data):
+        return True
+    return detect_codec(data) or default_codec()
+
+
+def encode_control(fields: Dict[str, Value], binary: Union[bool, Codec] = False) -> bytes:
+    """
+    Serializa un frame de control en binario (TLV) si binary es True, con el
+    codec dado si binary es un Codec, o con el codec por defecto.
+    """
+    if binary is True:
+        return pack_control(fields)
+    codec = binary if isinstance(binary, Codec) else default_codec()
+    return codec.dumps(fields)
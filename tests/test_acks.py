@@ -0,0 +1,36 @@
+import asyncio
+
+from src.transporte.acks import AckBatcher, decode_batch_ack, encode_batch_ack
+
+
+class FakeWriter:
+    def __init__(self):
+        self.frames = []
+
+    def write(self, data):
+        self.frames.append(bytes(data[4:]))  # Sin el prefijo de longitud
+
+    def is_closing(self):
+        return False
+
+
+def test_batch_ack_roundtrip():
+    frame = encode_batch_ack(10, {12, 15, 400})
+    assert decode_batch_ack(frame) == (10, {12, 15, 400})
+    assert decode_batch_ack(encode_batch_ack(3, set())) == (3, set())
+
+
+def test_batcher_coalesces_and_flushes_on_timer():
+    async def run():
+        writer = FakeWriter()
+        batcher = AckBatcher(writer, ack_every=4, ack_delay=0.01)
+        for chunk_id in (0, 1, 3, 4):
+            batcher.on_chunk(chunk_id)
+        # Cuatro chunks: un único ACK con 3 y 4 fuera de orden
+        assert [decode_batch_ack(f) for f in writer.frames] == [(2, {3, 4})]
+        batcher.on_chunk(2)
+        await asyncio.sleep(0.05)
+        return writer.frames
+
+    frames = asyncio.run(run())
+    assert len(frames) == 2 and decode_batch_ack(frames[-1]) == (5, set())
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from src.transporte.admission import AdmissionController, FairScheduler, ServerBusy
+
+
+def test_admission_limits_queue_and_busy():
+    async def run():
+        adm = AdmissionController(max_active=2, max_per_client=1, max_queued=1, queue_timeout=5.0)
+        await adm.acquire("a")
+        await adm.acquire("b")
+        # Global lleno: "c" espera en cola y un cuarto recibe busy
+        waiter = asyncio.create_task(adm.acquire("c"))
+        await asyncio.sleep(0)
+        with pytest.raises(ServerBusy) as busy:
+            await adm.acquire("d")
+        assert busy.value.retry_after > 0
+        assert not waiter.done()
+        adm.release("a", duration=2.0)
+        await asyncio.wait_for(waiter, 1.0)
+        assert adm.get_stats()["active"] == 2 and adm.avg_duration == 2.0
+
+        # Límite por cliente: "b" no puede abrir una segunda transferencia
+        adm.queue_timeout = 0.05
+        with pytest.raises(ServerBusy):
+            await adm.acquire("b")
+        assert adm.get_stats()["queued"] == 0
+
+        # Sin wait (cliente que no pidió admisión) no se encola
+        adm.queue_timeout = 5.0
+        with pytest.raises(ServerBusy):
+            await asyncio.wait_for(adm.acquire("e", wait=False), 0.5)
+        assert adm.get_stats()["queued"] == 0
+
+    asyncio.run(run())
+
+
+def test_drr_interleaves_small_flow_with_large_one():
+    async def run():
+        sched = FairScheduler(quantum=4096, slots=1)
+        big, small = sched.register("big"), sched.register("small")
+        order = []
+
+        async def worker(flow, n):
+            for _ in range(n):
+                await sched.acquire(flow, 4096)
+                order.append(flow.key)
+                await asyncio.sleep(0)
+                sched.release()
+
+        # El flujo grande ya ocupa el scheduler cuando llega el pequeño
+        big_task = asyncio.create_task(worker(big, 20))
+        await asyncio.sleep(0)
+        await worker(small, 3)
+        await big_task
+        return order
+
+    order = asyncio.run(run())
+    last_small = max(i for i, key in enumerate(order) if key == "small")
+    # Con DRR el flujo pequeño termina en unas pocas rondas, no tras los 20 chunks grandes
+    assert last_small < 10
+    assert order.count("big") == 20
+
+
+def test_sender_stops_on_busy_instead_of_retrying():
+    from src.app.cliente import _prepare_progress, _send_frames
+    from src.transporte.chunk_tuning import ChunkSizeTuner
+    from src.transporte.reliable import send_message
+    from src.transporte.tlv import encode_control
+
+    async def run(window):
+        async def busy(reader, writer):
+            await send_message(writer, encode_control({"type": "busy", "retry_after": 3.0}))
+            while await reader.read(65536):
+                pass
+            writer.close()
+
+        server = await asyncio.start_server(busy, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            with pytest.raises(ServerBusy) as e:
+                await asyncio.wait_for(_send_frames(reader, writer, [b'a' * 10], ChunkSizeTuner(), 10, window,
+                                                    5, 0.5, _prepare_progress(None, "x", 1, 10)), 2.0)
+            assert e.value.retry_after == 3.0
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+    for window in (1, 4):
+        asyncio.run(run(window))
@@ -0,0 +1,93 @@
+import asyncio
+
+from src.app.bus import BrokerBus, ChatBroker, LocalBus
+from src.app.message_store import MemoryMessageStore
+
+
+def test_local_bus_coalesces_presence_and_stores_offline():
+    async def run():
+        sent = []
+        bus = LocalBus(MemoryMessageStore(), debounce=0.02)
+        await bus.start(lambda user, msg, durable: user == "ana", sent.append)
+        for i in range(20):
+            await bus.join(f"u{i}", "ip")
+        await asyncio.sleep(0.05)
+        # Una ráfaga de altas produce un único delta
+        assert bus.presence_broadcasts == 1 and len(sent[0]["changes"]) == 20
+        await bus.route("luis", {"msg": "hola"}, await bus.next_seq("luis"))
+        return await bus.fetch_offline("luis")
+
+    assert asyncio.run(run()) == [(1, {"msg": "hola"})]
+
+
+def test_broker_routes_between_workers(tmp_path):
+    path = str(tmp_path / "chat.sock")
+
+    async def run():
+        broker = ChatBroker(path, MemoryMessageStore(), debounce=0.01)
+        await broker.start()
+        inbox = {"a": [], "b": []}
+        local_users = {"a": {"ana"}, "b": {"luis"}}
+        workers = {}
+        for name in ("a", "b"):
+            def deliver(user, msg, durable, name=name):
+                if user not in local_users[name]:
+                    return False
+                inbox[name].append(msg)
+                return True
+            workers[name] = BrokerBus(path, autostart=False)
+            await workers[name].start(deliver, lambda msg: None)
+        await workers["a"].join("ana", "10.0.0.1")
+        await workers["b"].join("luis", "10.0.0.2")
+        await asyncio.sleep(0.05)
+        # Ambos workers ven la misma presencia (réplica de la del broker)
+        assert workers["a"].presence.members == workers["b"].presence.members == {
+            "ana": "10.0.0.1", "luis": "10.0.0.2"}
+
+        await workers["a"].route("luis", {"msg": "hola luis"}, await workers["a"].next_seq("luis"))
+        await workers["a"].route("eva", {"msg": "hola eva"}, await workers["a"].next_seq("eva"))
+        await asyncio.sleep(0.05)
+        offline = await workers["b"].fetch_offline("eva")
+
+        # Si el worker de luis cae, luis deja de estar conectado
+        await workers["b"].close()
+        await asyncio.sleep(0.1)
+        members = dict(workers["a"].presence.members)
+        await workers["a"].close()
+        broker._server.close()
+        return inbox, offline, members
+
+    inbox, offline, members = asyncio.run(run())
+    assert inbox["b"] == [{"msg": "hola luis"}] and inbox["a"] == []
+    assert offline == [(1, {"msg": "hola eva"})]
+    assert members == {"ana": "10.0.0.1"}
+
+
+def test_worker_skips_malformed_broker_frames(tmp_path):
+    from src.transporte.codec import JSON
+    from src.transporte.reliable import read_message, write_message
+    path = str(tmp_path / "fake.sock")
+
+    async def run():
+        async def fake_broker(reader, writer):
+            await read_message(reader)                      # hello
+            write_message(writer, JSON.dumps({"op": "hello", "codec": "json"}))
+            write_message(writer, b'{"op": "deliver"}')     # Faltan campos
+            write_message(writer, b'{roto')
+            write_message(writer, JSON.dumps({"op": "deliver", "user": "ana", "message": {"msg": "hola"},
+                                              "durable": False, "seq": 1}))
+            await writer.drain()
+            await reader.read()
+
+        server = await asyncio.start_unix_server(fake_broker, path)
+        inbox = []
+        bus = BrokerBus(path, autostart=False)
+        await bus.start(lambda user, msg, durable: inbox.append(msg) or True, lambda msg: None)
+        await asyncio.sleep(0.05)
+        alive = not bus._read_task.done()
+        await bus.close()
+        server.close()
+        return inbox, alive
+
+    inbox, alive = asyncio.run(run())
+    assert inbox == [{"msg": "hola"}] and alive
@@ -0,0 +1,58 @@
+import asyncio
+import os
+
+from src.transporte.chunk_store import ChunkStore, Manifest, build_manifest, delta_payload, delta_reader
+from src.transporte.fragmentation import CHUNKING_FIXED
+
+
+def test_manifest_fields_roundtrip():
+    manifest = build_manifest(os.urandom(10_000), block_size=4096, chunking=CHUNKING_FIXED)
+    assert [n for _, n in manifest.blocks] == [4096, 4096, 1808]
+    assert "block_lens" not in manifest.to_fields()
+    assert Manifest.from_fields(manifest.to_fields()) == manifest
+
+    cdc = build_manifest(os.urandom(100_000), block_size=4096)
+    assert "block_lens" in cdc.to_fields()
+    assert Manifest.from_fields(cdc.to_fields()) == cdc
+
+
+def test_store_only_requests_unknown_blocks(tmp_path):
+    store = ChunkStore(tmp_path / "store")
+    original = os.urandom(40_000)
+    first = tmp_path / "a.png"
+    first.write_bytes(original)
+    store.add_file(first, block_size=4096)
+
+    # Misma imagen: no falta nada y se materializa como hard link
+    manifest = build_manifest(original, 4096)
+    assert store.missing(manifest) == []
+    assert store.materialize(manifest, {}, tmp_path / "copia.png")
+    assert os.path.samefile(tmp_path / "copia.png", store._file_path(manifest.file_hash))
+
+    # Casi duplicada (inserción que desplaza el resto): solo viaja la zona editada
+    edited = original[:5000] + b"EDIT" + original[5000:]
+    manifest2 = build_manifest(edited, 4096)
+    missing = store.missing(manifest2)
+    delta = delta_payload(edited, manifest2, missing)
+    assert 0 < len(delta) < len(edited) // 3
+    # La versión en streaming produce los mismos bytes, leídos en trozos
+    read = delta_reader(edited, manifest2, missing)
+
+    async def read_all():
+        out = b""
+        while piece := await read(1000):
+            out += piece
+        return out
+    assert asyncio.run(read_all()) == delta
+    lengths = dict(manifest2.blocks)
+    new_blocks, offset = {}, 0
+    for digest in missing:
+        new_blocks[digest] = delta[offset:offset + lengths[digest]]
+        offset += lengths[digest]
+    assert store.materialize(manifest2, new_blocks, tmp_path / "b.png")
+    assert (tmp_path / "b.png").read_bytes() == edited
+
+    # Un bloque que no coincide con su hash se rechaza
+    new_blocks[missing[0]] = b"x" * lengths[missing[0]]
+    assert not store.materialize(manifest2, new_blocks, tmp_path / "c.png")
+    store.close()
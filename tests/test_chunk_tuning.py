@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from src.transporte.chunk_tuning import (ChunkSizeTuner, MAX_CHUNK_SIZE, parse_chunk_size,
+                                         resolve_chunk_size, get_tuner)
+
+
+def test_tuner_shrinks_with_loss_and_grows_without():
+    lossy = ChunkSizeTuner(initial=4096, ack_per_chunk=False)
+    for i in range(200):
+        lossy.observe_chunk(i % 10 == 0, 4096)
+    assert lossy.recommend() < 4096
+    # Se acerca como mucho a la mitad por transferencia
+    assert lossy.next_chunk_size() == 2048
+
+    clean = ChunkSizeTuner(initial=1024)
+    for _ in range(50):
+        clean.observe_chunk(False, 1024)
+    sizes = [clean.next_chunk_size() for _ in range(10)]
+    assert sizes[0] == 2048 and sizes[-1] == MAX_CHUNK_SIZE
+
+
+def test_ack_latency_favours_larger_chunks():
+    lossy = [i % 20 == 0 for i in range(200)]
+    no_ack = ChunkSizeTuner(ack_per_chunk=False)
+    with_ack = ChunkSizeTuner(ack_per_chunk=True)
+    for t in (no_ack, with_ack):
+        for lost in lossy:
+            t.observe_chunk(lost, 1024)
+        t.observe_rtt(0.01)
+        t.observe_throughput(1_000_000, 1.0)
+    assert with_ack.recommend() > no_ack.recommend()
+
+
+def test_window_spreads_ack_latency():
+    lossy = [i % 20 == 0 for i in range(200)]
+    single = ChunkSizeTuner()
+    windowed = ChunkSizeTuner(window=32)
+    for t in (single, windowed):
+        for lost in lossy:
+            t.observe_chunk(lost, 1024)
+        t.observe_rtt(0.01)
+        t.observe_throughput(1_000_000, 1.0)
+    assert windowed.recommend() < single.recommend()
+
+
+def test_datagram_mtu_caps_size():
+    assert ChunkSizeTuner(datagram_mtu=1500).max_size < 1500
+
+
+def test_parse_and_resolve_chunk_size():
+    assert parse_chunk_size("auto") == "auto"
+    assert parse_chunk_size("2048") == 2048
+    with pytest.raises(ValueError):
+        parse_chunk_size("10")
+    with pytest.raises(ValueError):
+        parse_chunk_size("grande")
+    assert resolve_chunk_size(512, "h", 1) == 512
+    assert resolve_chunk_size("auto", "h", 1) == get_tuner("h", 1).current
+
+
+def test_fiable_send_fails_when_chunks_are_never_acked():
+    from src.app.cliente import _prepare_progress, _send_frames
+
+    async def scenario(window):
+        async def silent(reader, writer):
+            # Lee los chunks pero nunca confirma
+            while await reader.read(65536):
+                pass
+            writer.close()
+
+        server = await asyncio.start_server(silent, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        progress = _prepare_progress(None, "x", 2, 20)
+        try:
+            with pytest.raises(ConnectionError):
+                await _send_frames(reader, writer, [b'a' * 10, b'b' * 10], ChunkSizeTuner(), 10,
+                                   window, 2, 0.05, progress)
+        finally:
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+    for window in (1, 4):
+        asyncio.run(scenario(window))
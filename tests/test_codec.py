@@ -0,0 +1,36 @@
+import pytest
+
+from src.transporte import codec
+from src.transporte.codec import JSON, JSONCodec, UnsupportedCodec, detect_codec, negotiate
+from src.transporte.fragmentation import pack_chunk
+from src.transporte.tlv import control_format, encode_control, pack_control, parse_control
+
+
+def test_frames_are_recognized_and_answered_in_the_peer_format():
+    fields = {"type": "ack", "chunk_id": 7}
+    tlv, as_json = pack_control(fields), encode_control(fields)
+    chunk = pack_chunk(b"x" * 32, 32, 0, 0, 1)
+    # Los chunks no se confunden con mensajes y no se intenta decodificarlos
+    assert detect_codec(chunk) is None and detect_codec(tlv) is None
+    assert detect_codec(as_json) is JSON
+    assert parse_control(tlv) == parse_control(as_json) == fields
+    assert control_format(tlv) is True and control_format(as_json) is JSON
+    with pytest.raises(ValueError):
+        parse_control(chunk)
+    # Los dos backends JSON producen el mismo mensaje
+    stdlib = JSONCodec("json")
+    assert stdlib.loads(JSON.dumps(fields)) == JSON.loads(stdlib.dumps_text(fields)) == fields
+
+
+def test_msgpack_is_negotiated_only_when_installed():
+    assert negotiate(["zstd", "json"]) is JSON
+    assert negotiate(None) is JSON
+    frame = bytes([0x81, 0xa4]) + b"type" + bytes([0xa3]) + b"ack"    # {"type": "ack"} en msgpack
+    if codec.msgpack is None:
+        assert negotiate(["msgpack", "json"]) is JSON
+        with pytest.raises(UnsupportedCodec):
+            parse_control(frame)
+    else:
+        assert negotiate(["msgpack", "json"]).name == "msgpack"
+        assert parse_control(frame) == {"type": "ack"}
+        assert parse_control(encode_control({"type": "ack"}, control_format(frame))) == {"type": "ack"}
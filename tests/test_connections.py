@@ -0,0 +1,76 @@
+import asyncio
+import json
+
+from src.app.connections import ConnectionHub
+
+
+class FakeWebSocket:
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.sent = []
+        self.closed_code = None
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise ConnectionResetError("socket cerrado")
+        self.sent.append(text)
+
+    async def close(self, code=1000):
+        self.closed_code = code
+
+
+def test_broadcast_does_not_wait_for_slow_client():
+    async def run():
+        hub = ConnectionHub()
+        slow, fast = FakeWebSocket(delay=0.5), FakeWebSocket()
+        hub.add("lento", slow)
+        hub.add("rapido", fast)
+        for i in range(20):
+            hub.add(f"u{i}", FakeWebSocket())
+        hub.broadcast({"type": "presence_delta", "users": hub.users()})
+        await asyncio.sleep(0.05)
+        assert len(json.loads(fast.sent[0])["users"]) == 22
+        # El cliente lento aún no terminó su envío y el rápido ya lo recibió
+        assert slow.sent == []
+        await hub.close_all()
+
+    asyncio.run(run())
+
+
+def test_failed_connection_returns_durable_messages():
+    async def run():
+        stored = []
+        hub = ConnectionHub(on_undelivered=lambda user, msg: stored.append((user, msg)))
+        ws = FakeWebSocket(fail=True)
+        hub.add("ana", ws)
+        assert hub.send("ana", {"type": "message", "msg": "hola"}, durable=True)
+        hub.send("ana", {"type": "transfer_progress"})
+        await asyncio.sleep(0.05)
+        assert "ana" not in hub and ws.closed_code == 1011
+        assert not hub.send("ana", {"type": "message", "msg": "otra"})
+        return stored
+
+    stored = asyncio.run(run())
+    assert stored == [("ana", {"type": "message", "msg": "hola"})]
+
+
+def test_full_queue_drops_droppable_and_closes_on_the_rest():
+    async def run():
+        hub = ConnectionHub(max_queue=2)
+        ws = FakeWebSocket(delay=0.5)
+        hub.add("ana", ws)
+        hub.send("ana", {"type": "message", "msg": "hola"})
+        hub.send("ana", {"type": "message", "msg": "hola"})
+        for _ in range(3):
+            hub.broadcast({"type": "presence_delta"})
+        assert "ana" in hub and hub.dropped == 3
+        hub.send("ana", {"type": "file_credit"})
+        hub.send("ana", {"type": "file_credit"})
+        await asyncio.sleep(0.01)
+        assert "ana" not in hub and ws.closed_code == 1013
+        return hub.get_stats()
+
+    stats = asyncio.run(run())
+    assert stats["overflow_closes"] == 1 and stats["dropped"] == 3
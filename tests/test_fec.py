@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from src.transporte.fec import FECConfig, encode_group, recover_group
+from src.transporte.fragmentation import pack_chunks, parity_frames, unpack_chunk, Reassembler
+
+
+def test_reed_solomon_recovers_up_to_parity_count():
+    config = FECConfig(scheme="rs", group_size=8, redundancy=0.5)
+    shards = [os.urandom(100) for _ in range(8)]
+    parity = encode_group(shards, 100, config)
+    assert len(parity) == 4
+
+    # Perder 4 chunks de datos: se recuperan con las 4 paridades
+    data = {i: s for i, s in enumerate(shards) if i not in (0, 3, 5, 7)}
+    rebuilt = recover_group(data, dict(enumerate(parity)), 8, 100, config)
+    assert {i: rebuilt[i] for i in (0, 3, 5, 7)} == {i: shards[i] for i in (0, 3, 5, 7)}
+
+    with pytest.raises(ValueError):
+        recover_group({0: shards[0]}, dict(enumerate(parity)), 8, 100, config)
+
+
+def test_xor_parity_recovers_single_loss():
+    config = FECConfig(scheme="xor", redundancy=0.25)
+    assert config.group_size == 4 and config.parity_count == 1
+    shards = [os.urandom(64), os.urandom(64), os.urandom(64), os.urandom(10)]
+    parity = encode_group(shards, 64, config)
+    data = {0: shards[0], 1: shards[1], 3: shards[3]}
+    rebuilt = recover_group(data, {0: parity[0]}, 4, 64, config)
+    assert rebuilt[2] == shards[2]
+
+
+def test_reassembler_completes_with_loss_without_retransmission():
+    data = os.urandom(50_000)
+    chunk_size = 500
+    config = FECConfig(scheme="rs", group_size=10, redundancy=0.3)
+
+    r = Reassembler(len(data), 100)
+    r.enable_fec(config, chunk_size)
+    # ~15% de pérdida: hasta 2 chunks de datos y 1 paridad por grupo
+    for i, pkt in enumerate(pack_chunks(data, chunk_size)):
+        if i % 7 == 3:
+            continue
+        meta, payload = unpack_chunk(bytes(pkt))
+        r.add_frame(meta, payload)
+    for group_frames in parity_frames(data, chunk_size, config).values():
+        for pkt in group_frames[1:]:
+            meta, payload = unpack_chunk(pkt)
+            r.add_frame(meta, payload)
+
+    assert len(r.recovered_chunks) == 14
+    assert r.is_complete()
+    assert r.assemble() == data
+    # Los grupos completos no retienen paridad
+    assert r.parity_bytes == 0 and not r.parity
+
+
+def test_parity_is_validated_and_capped():
+    config = FECConfig(scheme="rs", group_size=4, redundancy=0.5)
+    r = Reassembler(1000, 10)
+    r.enable_fec(config, 100)
+    r.max_parity_bytes = 250
+    with pytest.raises(ValueError):
+        r.add_parity(3, 0, b'x' * 100)      # Solo hay grupos 0..2
+    with pytest.raises(ValueError):
+        r.add_parity(0, 2, b'x' * 100)      # Dos paridades por grupo
+    with pytest.raises(ValueError):
+        r.add_parity(0, 0, b'x' * 101)      # Más grande que un chunk
+    assert r.add_parity(0, 0, b'x' * 100) and r.add_parity(0, 1, b'x' * 100)
+    assert not r.add_parity(1, 0, b'x' * 100)   # Pasaría del tope
+    assert r.memory_footprint() == 200
@@ -1,6 +1,11 @@
+import asyncio
 import pytest
 import random
-from src.transporte.fragmentation import pack_chunk, unpack_chunk, Reassembler
+from src.transporte.fragmentation import (
+    pack_chunk, unpack_chunk, Reassembler, fragment, pack_chunks, unpack_chunks, ChunkPipeline,
+    HEADER_SIZE, HEADER_SIZE_V3, VERSION, VERSION_V3, gear_hashes, cdc_boundaries, chunk_lengths
+)
+from src.transporte.tlv import pack_control, parse_control, encode_control, encode_tlv, decode_tlv
 
 
 def fragment_bytes(data: bytes, chunk_size: int):
@@ -58,3 +63,281 @@ def test_reassembler_out_of_order():
         r.add_chunk(meta['chunk_id'], meta['offset'], payload)
     assert r.is_complete()
     assert r.assemble() == data
+
+
+def test_pack_chunks_matches_pack_chunk():
+    data = bytes(range(256)) * 37
+    meta = {"image_format": "png"}
+    frames = pack_chunks(data, 300, metadata=meta)
+    expected = []
+    total_chunks = (len(data) + 299) // 300
+    for i in range(total_chunks):
+        offset = i * 300
+        expected.append(pack_chunk(data[offset:offset + 300], len(data), offset, i, total_chunks,
+                                   metadata=meta if i == 0 else None))
+    assert [bytes(f) for f in frames] == expected
+
+
+def test_fragment_from_file_compressed(tmp_path):
+    data = b'imagen-de-prueba' * 500
+    path = tmp_path / 'img.bin'
+    path.write_bytes(data)
+    frames = list(fragment(str(path), 512, compressed=True))
+    r = None
+    for meta, payload in unpack_chunks(frames):
+        if r is None:
+            r = Reassembler(meta['total_len'], meta['total_chunks'])
+        r.add_chunk(meta['chunk_id'], meta['offset'], payload)
+    assert r.assemble() == data
+
+
+def test_wide_header_for_large_transfers():
+    # Más de 65535 chunks: se usa la versión 3 con campos anchos
+    data = bytes(range(256)) * 300
+    frames = pack_chunks(data, 1)
+    assert len(frames) == 76800
+    assert frames[-1][4] == VERSION_V3 and len(frames[-1]) == HEADER_SIZE_V3 + 1
+    r = Reassembler(len(data), len(frames))
+    for meta, payload in unpack_chunks(frames):
+        r.add_chunk(meta['chunk_id'], meta['offset'], payload)
+    assert r.assemble() == data
+
+    # Offsets de más de 4 GB
+    pkt = pack_chunk(b'x', 5 * 2**30, 5 * 2**30 - 1, 5 * 2**20, 5 * 2**20 + 1)
+    meta, payload = unpack_chunk(pkt)
+    assert (meta['version'], meta['offset'], meta['chunk_id']) == (VERSION_V3, 5 * 2**30 - 1, 5 * 2**20)
+
+    # Las transferencias pequeñas siguen con el header corto de la versión 2
+    small = pack_chunk(b'abc', 3, 0, 0, 1)
+    assert small[4] == VERSION and len(small) == HEADER_SIZE + 3
+
+
+def test_unpack_version_1_still_supported():
+    import struct
+    pkt = struct.pack("!4sBIIHHB", b'IMGC', 1, 4, 0, 0, 1, 0) + b'data'
+    meta, payload = unpack_chunk(pkt)
+    assert meta['version'] == 1 and payload == b'data'
+    assert next(unpack_chunks([pkt]))[1] == b'data'
+
+
+def test_gear_hashes_match_rolling_definition():
+    data = bytes(random.Random(1).getrandbits(8) for _ in range(300))
+    from src.transporte.fragmentation import _GEAR
+    h, expected = 0, []
+    for b in data:
+        h = ((h << 1) + int(_GEAR[b])) & 0xFFFFFFFFFFFFFFFF
+        expected.append(h)
+    assert gear_hashes(data).tolist() == expected
+
+
+def test_cdc_boundaries_resync_after_insertion():
+    rnd = random.Random(7)
+    data = bytes(rnd.getrandbits(8) for _ in range(200_000))
+    edited = data[:50_000] + b'insertado' + data[50_000:]
+    lengths = chunk_lengths(data, 4096, "cdc")
+    assert sum(lengths) == len(data)
+    assert all(1024 <= n <= 32768 for n in lengths[:-1])
+
+    def chunks(buf):
+        cuts = cdc_boundaries(buf, avg_size=4096)
+        return {buf[a:b] for a, b in zip([0] + cuts, cuts)}
+    original, changed = chunks(data), chunks(edited)
+    # Solo cambian los chunks que tocan la inserción
+    assert len(changed - original) <= 2
+    assert cdc_boundaries(b'', 4096) == []
+
+
+def test_fragment_empty_buffer():
+    assert pack_chunks(b'', 128) == []
+
+
+def test_tlv_metadata_roundtrip():
+    meta = {"format": "png", "width": 640, "height": 480, "total_size": 123456,
+            "compression": "gzip", "digest": b'\x01' * 16, "custom": -5, "ratio": 0.5}
+    pkt = pack_chunk(b'payload', 7, 0, 0, 1, metadata=meta, metadata_format="tlv")
+    json_pkt = pack_chunk(b'payload', 7, 0, 0, 1, metadata=meta | {"digest": "01" * 16})
+    assert len(pkt) < len(json_pkt)
+    decoded, payload = unpack_chunk(pkt)
+    assert decoded['metadata'] == meta
+    assert payload == b'payload'
+
+
+def test_tlv_signed_ints_beyond_64_bits():
+    values = {"a": -1, "b": -(2 ** 63), "c": -(2 ** 63) - 5, "d": -(2 ** 80), "e": 2 ** 70}
+    assert decode_tlv(encode_tlv(values)) == values
+
+
+def test_control_frames_binary_and_json():
+    ctrl = {"type": "img_meta", "name": "a.png", "size": 10, "total_chunks": 1}
+    assert parse_control(pack_control(ctrl)) == ctrl
+    assert parse_control(encode_control(ctrl)) == ctrl
+    with pytest.raises(ValueError):
+        parse_control(b'\x00\x01garbage')
+
+
+def test_assemble_partial_uses_real_offsets():
+    data = bytes(range(256)) * 10
+    frames = pack_chunks(data, 300)
+    r = Reassembler(len(data), len(frames))
+    for i, (meta, payload) in enumerate(unpack_chunks(frames)):
+        if i == 2:
+            continue
+        r.add_chunk(meta['chunk_id'], meta['offset'], payload)
+    partial = r.assemble_partial()
+    assert len(partial) == len(data)
+    assert partial[:600] == data[:600]
+    assert partial[600:900] == b'\x00' * 300
+    assert partial[900:] == data[900:]
+    assert r.contiguous_len == 600
+    assert bytes(r.contiguous_prefix()) == data[:600]
+    # Con el buffer parcial creado, received son vistas sobre él: sin doble copia
+    assert all(isinstance(d, memoryview) for d in r.received.values())
+    assert r.memory_footprint() == len(data)
+    r.add_chunk(2, 600, data[600:900])
+    assert r.assemble() == data and r.partial_view() == data
+
+
+def test_progressive_preview():
+    from PIL import Image
+    import io
+    buf = io.BytesIO()
+    Image.new('RGB', (200, 100), (10, 200, 30)).save(buf, 'JPEG')
+    data = buf.getvalue()
+    frames = pack_chunks(data, 256)
+    r = Reassembler(len(data), len(frames))
+    assert r.preview(max_size=(64, 64), min_interval=60) is None
+    for i, (meta, payload) in enumerate(unpack_chunks(frames)):
+        if i == len(frames) - 1:
+            break
+        r.add_chunk(meta['chunk_id'], meta['offset'], payload)
+    # Imagen aún incompleta: se decodifica lo recibido
+    first = r.preview()
+    assert first is not None
+    assert Image.open(io.BytesIO(first)).size == (64, 32)
+    # Cacheada: dentro de min_interval no se vuelve a decodificar
+    r.add_chunk(meta['chunk_id'], meta['offset'], payload)
+    assert r.preview() is first
+
+
+def test_strict_decoding_waits_for_truncated_previews():
+    import threading
+    from PIL import ImageFile
+    from src.transporte.preview import strict_decoding, truncated_decoding
+
+    seen = []
+
+    def strict():
+        with strict_decoding():
+            seen.append(ImageFile.LOAD_TRUNCATED_IMAGES)
+
+    with truncated_decoding():
+        assert ImageFile.LOAD_TRUNCATED_IMAGES
+        t = threading.Thread(target=strict)
+        t.start()
+        t.join(0.1)
+        # La decodificación estricta no empieza mientras haya una vista previa
+        assert t.is_alive() and seen == []
+    t.join(1)
+    assert seen == [False] and not ImageFile.LOAD_TRUNCATED_IMAGES
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_chunk_pipeline_matches_sequential(use_processes):
+    data = bytes(range(256)) * 200
+    meta = {"format": "png"}
+    pipeline = ChunkPipeline(max_workers=2, use_processes=use_processes, batch_size=7)
+    try:
+        frames = pipeline.pack(data, 300, compressed=True, metadata=meta, metadata_format="tlv")
+        expected = pack_chunks(data, 300, compressed=True, metadata=meta, metadata_format="tlv")
+        assert [bytes(f) for f in frames] == [bytes(f) for f in expected]
+
+        unpacked = pipeline.unpack(frames)
+        assert [m['chunk_id'] for m, _ in unpacked] == list(range(len(frames)))
+        assert b''.join(bytes(p) for _, p in unpacked) == data
+    finally:
+        pipeline.shutdown()
+
+
+def test_chunk_pipeline_async():
+    data = b'0123456789abcdef' * 10000
+    pipeline = ChunkPipeline(max_workers=2, offload_threshold=1000)
+
+    async def roundtrip():
+        frames = await pipeline.pack_async(data, 4096, compressed=True)
+        results = [await pipeline.unpack_one(bytes(f)) for f in frames]
+        return results + await pipeline.unpack_async(frames)
+
+    try:
+        results = asyncio.run(roundtrip())
+    finally:
+        pipeline.shutdown()
+    half = len(results) // 2
+    assert b''.join(bytes(p) for _, p in results[:half]) == data
+    assert b''.join(bytes(p) for _, p in results[half:]) == data
+
+
+def test_buffered_chunks_unpacked_as_one_batch():
+    from src.transporte.reliable import read_messages, write_message
+    data = bytes(range(256)) * 40
+    frames = [bytes(f) for f in pack_chunks(data, 1024)]
+    frames[3] = frames[3][:-1] + bytes([frames[3][-1] ^ 1])    # Falla el MD5
+    pipeline = ChunkPipeline(max_workers=1, offload_threshold=4096)
+
+    async def run():
+        received = asyncio.Event()
+        batches = []
+
+        async def handle(reader, writer):
+            await received.wait()
+            while len(sum(batches, [])) < len(frames):
+                batches.append(await read_messages(reader, 64))
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.sockets[0].getsockname()[1])
+        for f in frames:
+            write_message(writer, f)
+        await writer.drain()
+        await asyncio.sleep(0.05)
+        received.set()
+        while len(sum(batches, [])) < len(frames):
+            await asyncio.sleep(0.01)
+        writer.close()
+        server.close()
+        return batches, await pipeline.unpack_many(batches[0])
+
+    try:
+        batches, results = asyncio.run(run())
+    finally:
+        pipeline.shutdown()
+    # Todo estaba ya en el buffer: una sola lectura, verificada en el pool de una vez
+    assert len(batches) == 1 and len(results) == len(frames)
+    assert isinstance(results[3], ValueError)
+    good = [r for i, r in enumerate(results) if i != 3]
+    assert all(bytes(p) == data[m['offset']:m['offset'] + len(p)] for m, p in good)
+
+
+def test_pack_stream_matches_pack_with_small_reads():
+    data = bytes(random.Random(5).getrandbits(8) for _ in range(50000))
+    pipeline = ChunkPipeline(max_workers=2, batch_size=8)
+    pos = 0
+
+    async def read(n):
+        # Fuente que devuelve menos de lo pedido, como un socket o un upload
+        nonlocal pos
+        piece = data[pos:pos + min(n, 777)]
+        pos += len(piece)
+        return piece
+
+    async def collect():
+        return [bytes(f) async for f in pipeline.pack_stream(read, len(data), 1000, compressed=True)]
+
+    try:
+        frames = asyncio.run(collect())
+        expected = [bytes(f) for f in pack_chunks(data, 1000, compressed=True)]
+        assert frames == expected
+        pos = len(data) - 10   # Fuente truncada
+        with pytest.raises(ValueError):
+            asyncio.run(collect())
+    finally:
+        pipeline.shutdown()
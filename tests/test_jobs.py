@@ -0,0 +1,85 @@
+import asyncio
+
+from src.app import jobs
+from src.app.jobs import JobManager
+
+
+def test_jobs_respect_concurrency_and_report_state():
+    async def run():
+        manager = JobManager(max_concurrent=1)
+        updates = []
+        manager.add_listener(lambda job: updates.append((job.id, job.state)))
+        release = asyncio.Event()
+
+        async def slow(job):
+            job.progress.update(bytes_done=10)
+            await release.wait()
+            return {"bytes_sent": 10}
+
+        async def broken(job):
+            raise RuntimeError("conexión rechazada")
+
+        first = manager.submit(slow, owner="ana")
+        second = manager.submit(broken, owner="ana")
+        await asyncio.sleep(0.01)
+        # Solo uno corre a la vez: el segundo sigue en cola
+        assert first.state == jobs.RUNNING and second.state == jobs.QUEUED
+        release.set()
+        await manager.wait(first.id)
+        await manager.wait(second.id)
+        return manager, first, second, updates
+
+    manager, first, second, updates = asyncio.run(run())
+    assert first.to_dict()["result"] == {"bytes_sent": 10}
+    assert first.to_dict()["progress"]["bytes_done"] == 10
+    assert second.state == jobs.FAILED and "rechazada" in second.error
+    assert [s for i, s in updates if i == first.id] == [jobs.QUEUED, jobs.RUNNING, jobs.DONE]
+    assert len(manager.list("ana")) == 2 and manager.list("otro") == []
+
+
+def test_cancel_running_job_runs_cleanup():
+    async def run():
+        manager = JobManager(max_concurrent=2)
+        cleaned = []
+
+        async def forever(job):
+            await asyncio.sleep(60)
+
+        async def cleanup(job):
+            cleaned.append(job.state)
+
+        job = manager.submit(forever, on_finish=cleanup)
+        await asyncio.sleep(0.01)
+        assert manager.cancel(job.id)
+        await manager.wait(job.id)
+        # Un trabajo terminado ya no se puede cancelar
+        return job, cleaned, manager.cancel(job.id)
+
+    job, cleaned, cancelled_again = asyncio.run(run())
+    assert job.state == jobs.CANCELLED and cleaned == [jobs.CANCELLED]
+    assert not cancelled_again
+
+
+def test_side_tasks_cancelled_with_job_and_on_shutdown():
+    async def run():
+        manager = JobManager(max_concurrent=1)
+
+        async def forever(job):
+            await asyncio.sleep(60)
+
+        first = manager.submit(forever)
+        second = manager.submit(forever)
+        side_first = manager.attach(first, asyncio.sleep(60))
+        side_second = manager.attach(second, asyncio.sleep(60))
+        await asyncio.sleep(0.01)
+        manager.cancel(first.id)
+        await manager.wait(first.id)
+        await asyncio.sleep(0)
+        first_cancelled = side_first.cancelled() and not side_second.done()
+        await manager.shutdown()
+        return first_cancelled, side_second, second
+
+    first_cancelled, side_second, second = asyncio.run(run())
+    assert first_cancelled
+    assert side_second.cancelled() and second.state == jobs.CANCELLED
+    assert not second.side_tasks
@@ -0,0 +1,44 @@
+import asyncio
+
+from src.app.message_store import MemoryMessageStore, SQLiteMessageStore
+
+
+def test_sqlite_store_caps_pages_and_survives_restart(tmp_path):
+    path = str(tmp_path / "messages.db")
+
+    async def fill():
+        store = SQLiteMessageStore(path, max_per_user=5, batch_interval=0.01)
+        for i in range(8):
+            await store.append("ana", {"msg": f"m{i}"})
+        await store.append("luis", {"msg": "hola"})
+        await store.close()
+
+    async def drain():
+        store = SQLiteMessageStore(path, max_per_user=5)
+        first = await store.fetch("ana", 0, limit=3)
+        await store.delete("ana", first[-1][0])
+        rest = await store.fetch("ana", first[-1][0], limit=3)
+        # La secuencia sigue tras el reinicio aunque ya no queden mensajes viejos
+        seq = await store.next_seq("ana")
+        stats = store.get_stats()
+        await store.close()
+        return first, rest, seq, stats
+
+    asyncio.run(fill())
+    first, rest, seq, stats = asyncio.run(drain())
+    # Solo quedan los 5 más recientes de ana, en orden
+    assert [m["msg"] for _, m in first] == ["m3", "m4", "m5"]
+    assert [m["msg"] for _, m in rest] == ["m6", "m7"]
+    assert seq == 9
+    assert stats["messages"] == 3 and stats["users"] == 2
+
+
+def test_messages_expire_after_ttl():
+    async def run():
+        store = MemoryMessageStore(ttl=0.05)
+        await store.append("ana", {"msg": "viejo"})
+        await asyncio.sleep(0.1)
+        await store.append("ana", {"msg": "nuevo"})
+        return await store.fetch("ana")
+
+    assert [m["msg"] for _, m in asyncio.run(run())] == ["nuevo"]
@@ -0,0 +1,50 @@
+from src.app.presence import PresenceRegistry
+
+
+def apply(state, message):
+    """Lo que hace el cliente: snapshot, o delta si no hay salto de versión"""
+    if message["type"] == "presence_snapshot":
+        return message["version"], dict(message["userIPs"])
+    version, members = state
+    assert message["from_version"] <= version
+    for change in message["changes"]:
+        if change["v"] > version:
+            if change["op"] == "join":
+                members[change["user"]] = change["ip"]
+            else:
+                members.pop(change["user"], None)
+    return message["version"], members
+
+
+def test_deltas_are_coalesced_and_converge_with_snapshot():
+    presence = PresenceRegistry()
+    presence.join("ana", "10.0.0.1")
+    presence.join("luis", "10.0.0.2")
+    snapshot = presence.snapshot()
+    presence.join("eva", "10.0.0.3")
+    presence.leave("eva")
+    presence.join("ana", "10.0.0.9")
+
+    delta = presence.flush()
+    assert delta["type"] == "presence_delta" and delta["from_version"] == 0
+    # Un cambio por usuario: el alta y baja de eva se reduce a la baja
+    assert [(c["user"], c["op"]) for c in delta["changes"]] == [("luis", "join"), ("eva", "leave"), ("ana", "join")]
+    assert presence.flush() is None
+
+    # El delta se solapa con el snapshot y el resultado es el estado actual
+    state = apply(apply(None, snapshot), delta)
+    assert state == (presence.version, presence.members)
+
+
+def test_sync_falls_back_to_snapshot_when_history_is_gone():
+    presence = PresenceRegistry(history=4)
+    for i in range(3):
+        presence.join(f"u{i}", "ip")
+    assert presence.sync(1)["changes"] == [{"op": "join", "user": "u1", "ip": "ip", "v": 2},
+                                           {"op": "join", "user": "u2", "ip": "ip", "v": 3}]
+    for i in range(3):
+        presence.leave(f"u{i}")
+    assert presence.sync(1)["type"] == "presence_snapshot"
+    assert presence.sync(presence.version)["changes"] == []
+    # Versión del futuro (p. ej. tras reiniciar el servidor): snapshot
+    assert presence.sync(presence.version + 5)["type"] == "presence_snapshot"
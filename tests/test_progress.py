@@ -0,0 +1,45 @@
+import asyncio
+
+from src.transporte.fragmentation import Reassembler, pack_chunks, unpack_chunks
+from src.transporte.progress import ProgressTracker
+
+
+def test_updates_are_rate_limited():
+    tracker = ProgressTracker(1000, 1_000_000, min_interval=60.0)
+    events = []
+    tracker.add_listener(events.append)
+    for i in range(1, 1000):
+        tracker.update(i, i * 1000)
+    # Solo el primero pasa el límite; el final siempre se publica
+    assert len(events) == 1
+    tracker.update(1000, 1_000_000, retransmits=2)
+    assert len(events) == 2 and events[-1].done
+    assert events[-1].percent == 100.0 and events[-1].retransmits == 2
+
+
+def test_reassembler_progress_stream_coalesces():
+    data = bytes(range(256)) * 40
+    frames = pack_chunks(data, 256)
+
+    async def run():
+        r = Reassembler(len(data), len(frames))
+        r.progress.min_interval = 0
+        received = []
+
+        async def consume():
+            async for event in r.progress.subscribe():
+                received.append(event)
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0)
+        # Sin ceder el loop: el consumidor solo ve el último evento
+        for meta, payload in unpack_chunks(frames):
+            r.add_chunk(meta['chunk_id'], meta['offset'], payload)
+        r.add_chunk(0, 0, bytes(data[:256]))
+        await asyncio.wait_for(task, 1.0)
+        return r, received
+
+    r, received = asyncio.run(run())
+    assert len(received) == 1
+    assert received[0].done and received[0].bytes_done == len(data)
+    assert r.duplicates == 1
@@ -0,0 +1,35 @@
+from src.app.rate_limit import RateLimiter, parse_limits
+
+
+def test_limits_per_type_and_shared_default():
+    limiter = RateLimiter(parse_limits("message=2/3,*=1/1"), close_after=5)
+    now = 100.0
+    # La ráfaga de message no consume del bucket compartido
+    assert [limiter.check("ana", "message", now) for _ in range(4)][:3] == [0, 0, 0]
+    assert limiter.check("ana", "message", now) == 0.5
+    assert limiter.check("ana", "list", now) == 0
+    assert limiter.check("ana", "raro", now) > 0
+    # Otro usuario tiene sus propios buckets
+    assert limiter.check("luis", "message", now) == 0
+    # Tras 1 s hay 2 tokens más
+    assert limiter.check("ana", "message", now + 1) == 0
+    assert limiter.should_notify("ana", 0.5, now) and not limiter.should_notify("ana", 0.5, now + 0.5)
+    # Los tipos sin límite propio se cuentan en su bucket, no por nombre
+    for i in range(100):
+        limiter.check("eva", f"tipo{i}", now)
+    assert limiter.get_stats()["throttled_by_type"] == {"message": 2, "*": 100}
+
+
+def test_reconnect_keeps_state_until_refilled_and_closes_abusers():
+    limiter = RateLimiter(parse_limits("message=1/2"), close_after=3)
+    for _ in range(2):
+        limiter.check("ana", "message", 0)
+    limiter.forget("ana", now=0.5)
+    # Reconectar enseguida no rellena el bucket
+    assert limiter.check("ana", "message", 0.5) > 0
+    assert not limiter.should_close("ana")
+    limiter.check("ana", "message", 0.5)
+    limiter.check("ana", "message", 0.5)
+    assert limiter.should_close("ana")
+    limiter.forget("ana", now=10)
+    assert "ana" not in limiter.users
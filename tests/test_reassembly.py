@@ -0,0 +1,102 @@
+import asyncio
+import os
+
+import pytest
+
+from src.transporte.fragmentation import pack_chunks, unpack_chunks
+from src.transporte.reassembly import ReassemblyManager, SpillReassembler, TransferRejected
+
+
+def _feed(reassembler, data, chunk_size):
+    for meta, payload in unpack_chunks(pack_chunks(data, chunk_size)):
+        reassembler.add_chunk(meta['chunk_id'], meta['offset'], payload)
+
+
+def test_budget_rejects_without_spill_dir():
+    manager = ReassemblyManager(memory_budget=1000)
+    manager.open("a", 800, 8)
+    with pytest.raises(TransferRejected):
+        manager.open("b", 400, 4)
+    manager.release("a")
+    manager.open("b", 400, 4)
+    assert manager.get_stats()["reserved_bytes"] == 400
+
+
+def test_budget_spills_to_disk(tmp_path):
+    manager = ReassemblyManager(memory_budget=1000, spill_dir=tmp_path / "spill")
+    manager.open("a", 800, 8)
+    data = os.urandom(5000)
+    r = manager.open("b", len(data), 10)
+    assert isinstance(r, SpillReassembler)
+    assert manager.get_status("b")["spilled"]
+
+    _feed(r, data, 500)
+    assert r.memory_footprint() == 0
+    out = tmp_path / "out.bin"
+    assert r.save(out)
+    assert out.read_bytes() == data
+    manager.release("b")
+    assert list((tmp_path / "spill").iterdir()) == []
+
+
+def test_spill_file_name_ignores_transfer_id(tmp_path):
+    manager = ReassemblyManager(memory_budget=0, spill_dir=tmp_path / "spill")
+    r = manager.open("../../fuera", 100, 1)
+    assert r.spill_path.parent == tmp_path / "spill"
+    assert not (tmp_path / "fuera.part").exists()
+    manager.release("../../fuera")
+
+
+def test_disk_limits_reject(tmp_path):
+    manager = ReassemblyManager(memory_budget=100, spill_dir=tmp_path / "spill",
+                                max_transfer_size=1000, spill_budget=1500)
+    with pytest.raises(TransferRejected):
+        manager.open("enorme", 1001, 1)
+    manager.open("a", 800, 8)
+    with pytest.raises(TransferRejected):
+        manager.open("b", 800, 8)
+    assert manager.get_stats()["spilled_bytes"] == 800
+    assert manager.get_stats()["rejected"] == 2
+    manager.release("a")
+    manager.open("b", 800, 8)
+    assert manager.get_stats()["spilled_bytes"] == 800
+
+
+def test_idle_transfers_expire():
+    async def scenario():
+        manager = ReassemblyManager(expiry_interval=0.05)
+        expired = []
+        manager.open("lento", 100, 10, timeout=0.1, on_expire=lambda: expired.append(True))
+        active = manager.open("activo", 100, 10, timeout=10)
+        manager.start()
+        await asyncio.sleep(0.3)
+        await manager.stop()
+        return manager, expired, active
+
+    manager, expired, active = asyncio.run(scenario())
+    assert expired == [True]
+    assert manager.get("lento") is None
+    assert manager.get("activo") is active
+    assert manager.get_stats()["expired"] == 1
+
+
+def test_chunk_count_must_match_size():
+    manager = ReassemblyManager()
+    with pytest.raises(ValueError):
+        manager.open("muchos", 10, 10 ** 9)
+    with pytest.raises(ValueError):
+        manager.open("desajuste", 1000, 5, chunk_size=100)
+    manager.open("ok", 1000, 10, chunk_size=100)
+    assert list(manager.transfers) == ["ok"]
+
+
+def test_incomplete_spill_saved_without_copy(tmp_path):
+    manager = ReassemblyManager(memory_budget=0, spill_dir=tmp_path / "spill")
+    data = os.urandom(1000)
+    r = manager.open("parcial", len(data), 2)
+    r.add_chunk(1, 500, data[500:])
+    out = tmp_path / "img.partial"
+    r.save_partial(out)
+    manager.release("parcial")
+    assert out.read_bytes() == bytes(500) + data[500:]
+    assert list((tmp_path / "spill").iterdir()) == []
@@ -0,0 +1,127 @@
+import asyncio
+import json
+
+from src.app.bus import LocalBus
+from src.app.connections import ConnectionHub
+from src.app.message_store import MemoryMessageStore
+from src.app.relay import FileRelay, pack_frame, unpack_frame
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.text = []
+        self.frames = []
+
+    async def send_text(self, text):
+        self.text.append(json.loads(text))
+
+    async def send_bytes(self, data):
+        self.frames.append(data)
+
+    async def close(self, code=1000):
+        pass
+
+    def last(self, kind):
+        return [m for m in self.text if m["type"] == kind][-1]
+
+
+async def _setup(tmp_path, **kwargs):
+    hub = ConnectionHub()
+    bus = LocalBus(MemoryMessageStore())
+    await bus.start(hub.send, hub.broadcast)
+    return hub, bus, FileRelay(hub, bus, str(tmp_path / "relay"), **kwargs)
+
+
+def test_live_relay_is_limited_by_credits_and_resumes(tmp_path):
+    data = bytes(range(256)) * 40     # 10240 bytes
+
+    async def run():
+        hub, bus, relay = await _setup(tmp_path, window=4096, chunk_size=1024)
+        ana, luis = FakeWebSocket(), FakeWebSocket()
+        hub.add("ana", ana)
+        hub.add("luis", luis)
+        await relay.handle("ana", {"type": "file_offer", "to": "luis", "name": "a.bin", "size": len(data)})
+        await asyncio.sleep(0)
+        file_id = ana.last("file_offer_ack")["file_id"]
+        assert ana.last("file_offer_ack")["mode"] == "live" and luis.last("file_offer")["file_id"] == file_id
+
+        await relay.handle("luis", {"type": "file_accept", "file_id": file_id})
+        await asyncio.sleep(0)
+        assert ana.last("file_credit")["limit"] == 4096
+        # Más allá del crédito no se reenvía nada
+        for offset in range(0, 6144, 1024):
+            await relay.on_frame("ana", pack_frame(file_id, offset, data[offset:offset + 1024]))
+        await asyncio.sleep(0)
+        assert len(luis.frames) == 4
+
+        # luis se reconecta con 2048 bytes: el emisor repite desde ahí
+        await relay.handle("luis", {"type": "file_accept", "file_id": file_id, "offset": 2048})
+        await asyncio.sleep(0)
+        credit = ana.last("file_credit")
+        assert credit["offset"] == 2048 and credit["limit"] == 6144
+        received = bytearray(data[:2048])
+        offset = 2048
+        while offset < len(data):
+            limit = ana.last("file_credit")["limit"]
+            while offset < limit:
+                await relay.on_frame("ana", pack_frame(file_id, offset, data[offset:offset + 1024]))
+                offset += 1024
+            await asyncio.sleep(0)
+            for frame in luis.frames[4:]:
+                _, frame_offset, chunk = unpack_frame(frame)
+                if frame_offset == len(received):
+                    received += chunk
+            luis.frames[4:] = []
+            await relay.handle("luis", {"type": "file_ack", "file_id": file_id, "offset": len(received)})
+            await asyncio.sleep(0)
+        return bytes(received), ana, luis, relay
+
+    received, ana, luis, relay = asyncio.run(run())
+    assert received == data
+    assert luis.last("file_end") and ana.last("file_complete")
+    assert relay.sessions == {}
+
+
+def test_store_and_forward_when_recipient_offline(tmp_path):
+    data = b"x" * 5000
+
+    async def run():
+        hub, bus, relay = await _setup(tmp_path, window=2048, chunk_size=1000)
+        ana = FakeWebSocket()
+        hub.add("ana", ana)
+        await relay.handle("ana", {"type": "file_offer", "to": "luis", "name": "../b.bin", "size": len(data)})
+        await asyncio.sleep(0)
+        file_id = ana.last("file_offer_ack")["file_id"]
+        assert ana.last("file_offer_ack")["mode"] == "store"
+        offset = 0
+        while offset < len(data):
+            limit = ana.last("file_credit")["limit"]
+            while offset < limit:
+                await relay.on_frame("ana", pack_frame(file_id, offset, data[offset:offset + 500]))
+                offset += 500
+            await asyncio.sleep(0.01)
+        assert ana.last("file_stored")
+
+        # luis vuelve: el aviso quedó guardado y el archivo se sirve desde disco
+        (_, offer), = await bus.fetch_offline("luis")
+        assert offer["name"] == "b.bin" and offer["stored"]
+        luis = FakeWebSocket()
+        hub.add("luis", luis)
+        await relay.handle("luis", {"type": "file_accept", "file_id": offer["file_id"]})
+        await asyncio.sleep(0.05)
+        # Sin confirmaciones solo llega una ventana
+        assert sum(len(unpack_frame(f)[2]) for f in luis.frames) == 2048
+        received = 0
+        while not [m for m in luis.text if m["type"] == "file_end"]:
+            received = sum(len(unpack_frame(f)[2]) for f in luis.frames)
+            await relay.handle("luis", {"type": "file_ack", "file_id": file_id, "offset": received})
+            await asyncio.sleep(0.05)
+        received = b"".join(bytes(unpack_frame(f)[2]) for f in luis.frames)
+        await relay.handle("luis", {"type": "file_ack", "file_id": file_id, "offset": len(received)})
+        await asyncio.sleep(0.05)
+        return received, ana, relay
+
+    received, ana, relay = asyncio.run(run())
+    assert received == data
+    assert ana.last("file_complete")
+    assert list((tmp_path / "relay").iterdir()) == []
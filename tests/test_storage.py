@@ -0,0 +1,68 @@
+import asyncio
+import random
+
+from src.transporte.fragmentation import Reassembler, pack_chunks, unpack_chunks
+from src.transporte.storage import AsyncStorage
+
+
+def test_incremental_file_out_of_order(tmp_path):
+    data = bytes(random.Random(3).getrandbits(8) for _ in range(20000))
+    frames = pack_chunks(data, 1024)
+    random.Random(4).shuffle(frames)
+    dest = tmp_path / "img.bin"
+
+    async def run():
+        storage = AsyncStorage(max_workers=2)
+        r = Reassembler(len(data), len(frames))
+        sink = storage.open_incremental(dest, len(data))
+        r.on_store = sink.submit
+        for meta, payload in unpack_chunks(frames):
+            r.add_frame(meta, bytes(payload))
+            await sink.wait_capacity()
+        # Nada visible con el nombre final hasta finalizar
+        assert not dest.exists()
+        await sink.finalize()
+        storage.shutdown()
+        return sink
+
+    sink = asyncio.run(run())
+    assert dest.read_bytes() == data
+    assert sink.bytes_written == len(data)
+    assert list(tmp_path.iterdir()) == [dest]
+
+
+def test_write_file_atomic_and_abort(tmp_path):
+    async def run():
+        storage = AsyncStorage(max_workers=1, fsync=False)
+        await storage.write_file(tmp_path / "a.txt", b"uno")
+        await storage.write_file(tmp_path / "a.txt", b"dos")
+        sink = storage.open_incremental(tmp_path / "b.bin", 10)
+        sink.submit(0, b"x" * 10)
+        await sink.abort()
+        storage.shutdown()
+
+    asyncio.run(run())
+    assert (tmp_path / "a.txt").read_bytes() == b"dos"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.txt"]
+
+
+def test_incremental_file_coalesces_contiguous_chunks(tmp_path):
+    data = bytes(range(256)) * 40
+    writes = []
+
+    async def run():
+        storage = AsyncStorage(max_workers=1, fsync=False)
+        sink = storage.open_incremental(tmp_path / "img.bin", len(data))
+        sink.coalesce_bytes = 4096
+        original = sink._write_at
+        sink._write_at = lambda offset, chunk: writes.append(offset) or original(offset, chunk)
+        for offset in range(0, 5120, 1024):         # Contiguos
+            sink.submit(offset, data[offset:offset + 1024])
+        sink.submit(8192, data[8192:])              # Salto
+        sink.submit(5120, data[5120:8192])          # Hueco rellenado
+        await sink.finalize()
+        storage.shutdown()
+
+    asyncio.run(run())
+    assert (tmp_path / "img.bin").read_bytes() == data
+    assert writes == [0, 4096, 8192, 5120]
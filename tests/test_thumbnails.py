@@ -0,0 +1,52 @@
+import asyncio
+
+from PIL import Image
+
+from src.transporte.thumbnails import ThumbnailCache, ThumbnailPipeline
+
+
+def test_pipeline_generates_and_caches_variants(tmp_path):
+    src = tmp_path / "foto.jpg"
+    Image.new("RGB", (2000, 1000), (200, 30, 30)).save(src, "JPEG")
+    copy = tmp_path / "copia.jpg"
+    copy.write_bytes(src.read_bytes())
+
+    async def run():
+        pipeline = ThumbnailPipeline(tmp_path / "cache", max_workers=1)
+        try:
+            await pipeline.generate_all(src)
+            thumb, file_hash = await pipeline.get(src, "thumb")
+            # Mismo contenido con otro nombre: se sirve de la caché
+            thumb2, hash2 = await pipeline.get(copy, "thumb")
+            return thumb, thumb2, file_hash == hash2, pipeline.get_stats()
+        finally:
+            pipeline.shutdown()
+
+    thumb, thumb2, same_hash, stats = asyncio.run(run())
+    assert same_hash and thumb == thumb2
+    with Image.open(thumb) as img:
+        assert img.format == "WEBP" and max(img.size) == 400
+    assert stats["entries"] == 2 and stats["hits"] == 2
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ThumbnailCache(tmp_path, max_bytes=250)
+    cache.put("aa/a.thumb.webp", b"a" * 100)
+    cache.put("bb/b.thumb.webp", b"b" * 100)
+    assert cache.get("aa/a.thumb.webp") is not None
+    cache.put("cc/c.thumb.webp", b"c" * 100)
+    # b era la menos usada
+    assert cache.get("bb/b.thumb.webp") is None
+    assert not (tmp_path / "bb/b.thumb.webp").exists()
+    assert cache.get_stats()["bytes"] == 200
+    # Una caché nueva sobre el mismo directorio recupera las entradas
+    assert ThumbnailCache(tmp_path, max_bytes=250).get_stats()["entries"] == 2
+
+
+def test_variants_fall_back_to_jpeg_without_webp(tmp_path, monkeypatch):
+    from src.transporte import thumbnails
+    monkeypatch.setattr(thumbnails, "webp_supported", lambda: False)
+    pipeline = ThumbnailPipeline(tmp_path / "cache")
+    spec = pipeline.variants["thumb"]
+    assert spec.fmt == "JPEG" and spec.media_type == "image/jpeg"
+    assert ThumbnailCache.key("ab" * 32, "thumb", spec).endswith(".jpg")
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from frontend_api.ws_load import LoadConfig, parse_mix, parse_size, percentile, run_load
+
+
+def test_mix_size_and_percentiles():
+    assert parse_mix("message=3,list=1") == {"message": 0.75, "list": 0.25}
+    with pytest.raises(ValueError):
+        parse_mix("borrar=1")
+    assert parse_size("256") == (256, 256) and parse_size("32-1024") == (32, 1024)
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50 and percentile(values, 99) == 99 and percentile(values, 100) == 100
+    assert percentile([], 50) is None
+
+
+def test_load_run_against_the_chat_server(monkeypatch):
+    monkeypatch.setenv("CHAT_STORE", "memory")
+    uvicorn = pytest.importorskip("uvicorn")
+    from frontend_api.main import app
+
+    async def run():
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning"))
+        task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        try:
+            cfg = LoadConfig(url=f"ws://127.0.0.1:{port}/ws", users=20, duration=1.0, rate=5.0,
+                             mix=parse_mix("message=4,list=1"), size=(100, 200), ramp=0.2, drain=0.5,
+                             stats_interval=0.2, seed=1)
+            return await run_load(cfg)
+        finally:
+            server.should_exit = True
+            await task
+
+    result = asyncio.run(run())
+    assert result["connected"] == 20
+    messages = result["messages"]
+    assert messages["sent"] > 0 and messages["delivered"] == messages["sent"]
+    assert messages["latency"]["p50_ms"] <= messages["latency"]["p99_ms"] <= messages["latency"]["max_ms"]
+    assert result["list_rtt"]["count"] == result["ops"]["list"]
+    assert result["server_memory"]["samples"] >= 2